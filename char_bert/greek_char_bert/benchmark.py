@@ -0,0 +1,350 @@
+"""Measures the throughput and latency of each stage of the CharMLM pipeline (tokenization, masking, featurization, collation, the forward pass, formatting the predictions and end to end prediction) on the CPU. Batch size, sequence length, thread count and decoding mode are swept and the results are written as JSON so that they can be compared between versions. Either a saved model or a randomly initialized model with the architecture options of train.py is used."""
+from greek_char_bert.predict import (
+    MLMPredicter,
+    DECODINGS,
+    replace_square_brackets,
+    sentences_to_dicts,
+)
+from greek_char_bert.run_eval import convert_masking
+from greek_char_bert.data_handler.tokenization import (
+    CharMLMTokenizer,
+    tokenize_with_metadata,
+)
+from greek_char_bert.data_handler.processor import (
+    CharMLMProcessor,
+    CharMLMPredProcessor,
+)
+from greek_char_bert.data_handler.input_features import (
+    samples_to_features_bert_char_mlm,
+    premasked_samples_to_features_bert_char_mlm,
+)
+from greek_char_bert.data_handler.samples import (
+    create_char_mlm_prediction_samples_sentence_pairs,
+)
+from greek_char_bert.data_handler.utils import char_mlm_mask_random_words
+from greek_char_bert.train import add_architecture_arguments, init_model
+from farm.data_handler.samples import Sample, SampleBasket
+from farm.data_handler.dataloader import NamedDataLoader
+from torch.utils.data.sampler import SequentialSampler
+from datetime import datetime
+import numpy as np
+import resource
+import logging
+import random
+import torch
+import json
+import time
+import os
+import argparse
+
+logger = logging.getLogger(__name__)
+
+
+def cumulative_peak_rss_mb():
+    """Returns the peak resident set size of the whole process so far in MB (ru_maxrss is in KB on Linux). It never decreases, so it is the peak over all the stages run so far rather than that of the current stage."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def time_calls(fn, args_list):
+    """Calls fn once for each entry in args_list and returns the duration of each call in seconds."""
+    durations = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def summarize(stage, durations, nb_of_items, **settings):
+    """Summarizes the durations of the calls made for a stage. nb_of_items is the total number of sequences processed by the calls. The throughput and latencies are None if no calls were made (e.g. if the stage had no items to process)."""
+    durations = np.array(durations)
+    total = durations.sum()
+    result = {"stage": stage}
+    result.update(settings)
+    result.update(
+        {
+            "items": nb_of_items,
+            "seconds": total,
+            "items_per_sec": nb_of_items / total if total > 0 else None,
+            "p50_ms": np.percentile(durations, 50) * 1000 if len(durations) else None,
+            "p99_ms": np.percentile(durations, 99) * 1000 if len(durations) else None,
+            "cumulative_peak_rss_mb": cumulative_peak_rss_mb(),
+        }
+    )
+    if result["items_per_sec"] is None or result["p50_ms"] is None:
+        logger.info(f"{stage} {settings}: no items processed")
+    else:
+        logger.info(
+            f"{stage} {settings}: {result['items_per_sec']:.1f} seq/s, p50 {result['p50_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms"
+        )
+    return result
+
+
+def make_sequences(path, seq_len, nb_of_sequences):
+    """Cuts the texts in path into windows of seq_len characters. Returns the masked windows (masks as #) and the windows with the masked characters removed (for the training stages)."""
+    with open(path, "r") as fp:
+        text = "_".join(fp.read().split())
+    text = replace_square_brackets(text)
+    masked = []
+    for i in range(nb_of_sequences):
+        start = (i * seq_len) % max(1, len(text) - seq_len)
+        masked.append(text[start : start + seq_len])
+    unmasked = [s.replace("#", "") for s in masked]
+    return masked, unmasked
+
+
+def batches(items, batch_size):
+    return [items[i : i + batch_size] for i in range(0, len(items), batch_size)]
+
+
+def load_predicter(model_path, random_init, vocab_file, max_seq_len, architecture):
+    """Loads the model in model_path or initializes a random model with the architecture given by the options of train.py (see add_architecture_arguments)."""
+    if not random_init:
+        predicter = MLMPredicter.load(model_path, gpu=False)
+        predicter.processor.max_seq_len = max_seq_len
+        return predicter
+    tokenizer = CharMLMTokenizer(vocab_file=vocab_file, do_lower_case=False)
+    processor = CharMLMProcessor(
+        tokenizer=tokenizer, max_seq_len=max_seq_len, data_dir="."
+    )
+    model = init_model(architecture, tokenizer, max_seq_len, torch.device("cpu"))
+    return MLMPredicter(model, processor, gpu=False)
+
+
+def benchmark_preprocessing(tokenizer, masked, unmasked, seq_len):
+    """Benchmarks the stages which run before the model, one call per sequence. Sequences without tokens are skipped by the training stages, so the number of items of each stage is its number of calls."""
+    results = []
+    settings = {"seq_len": seq_len}
+
+    durations = time_calls(
+        lambda s: tokenize_with_metadata(s, tokenizer, seq_len),
+        [(s,) for s in unmasked],
+    )
+    results.append(
+        summarize("tokenize_with_metadata", durations, len(durations), **settings)
+    )
+
+    tokens = [tokenize_with_metadata(s, tokenizer, seq_len)["tokens"] for s in unmasked]
+    durations = time_calls(
+        lambda t: char_mlm_mask_random_words(list(t)), [(t,) for t in tokens if t]
+    )
+    results.append(
+        summarize("char_mlm_mask_random_words", durations, len(durations), **settings)
+    )
+
+    def training_sample(t):
+        return Sample(
+            id=None,
+            clear_text={"is_next_label": False},
+            tokenized={"text_a": {"tokens": list(t)}, "text_b": {"tokens": ["_"]}},
+        )
+
+    durations = time_calls(
+        lambda t: samples_to_features_bert_char_mlm(
+            training_sample(t), seq_len, tokenizer
+        ),
+        [(t,) for t in tokens if t],
+    )
+    results.append(
+        summarize(
+            "samples_to_features_bert_char_mlm", durations, len(durations), **settings
+        )
+    )
+
+    baskets = [
+        SampleBasket(raw=d, id=str(i))
+        for i, d in enumerate(sentences_to_dicts(convert_masking(masked)))
+    ]
+    baskets = create_char_mlm_prediction_samples_sentence_pairs(
+        baskets, tokenizer, seq_len
+    )
+    durations = time_calls(
+        lambda s: premasked_samples_to_features_bert_char_mlm(s, seq_len, tokenizer),
+        [(b.samples[0],) for b in baskets],
+    )
+    results.append(
+        summarize(
+            "premasked_samples_to_features_bert_char_mlm",
+            durations,
+            len(durations),
+            **settings,
+        )
+    )
+    return results
+
+
+def benchmark_model(predicter, masked, seq_len, batch_size, threads, decoding_modes):
+    """Benchmarks collation, the forward pass, formatted_preds and end to end prediction, one call per batch."""
+    results = []
+    settings = {"seq_len": seq_len, "batch_size": batch_size, "threads": threads}
+    n = len(masked)
+    predicter.batch_size = batch_size
+    dicts = sentences_to_dicts(convert_masking(masked))
+
+    pred_processor = CharMLMPredProcessor(
+        tokenizer=predicter.processor.tokenizer,
+        max_seq_len=seq_len,
+        data_dir=predicter.processor.data_dir,
+    )
+    dataset, tensor_names, samples = pred_processor.dataset_and_samples_from_dicts(
+        dicts
+    )
+
+    data_loader = NamedDataLoader(
+        dataset=dataset,
+        sampler=SequentialSampler(dataset),
+        batch_size=batch_size,
+        tensor_names=tensor_names,
+    )
+    loader_iter = iter(data_loader)
+    durations = time_calls(lambda: next(loader_iter), [()] * len(data_loader))
+    results.append(summarize("collate", durations, n, **settings))
+
+    model_batches = list(data_loader)
+    with torch.no_grad():
+        # warm up
+        predicter.model.forward(**model_batches[0])
+        logits = []
+
+        def forward(batch):
+            logits.append(predicter.model.forward(**batch))
+
+        durations = time_calls(forward, [(b,) for b in model_batches])
+        results.append(summarize("forward", durations, n, **settings))
+
+        durations = time_calls(
+            lambda batch_logits, batch, batch_samples: predicter.model.formatted_preds(
+                logits=batch_logits,
+                label_maps=pred_processor.label_maps,
+                samples=batch_samples,
+                tokenizer=pred_processor.tokenizer,
+                **batch,
+            ),
+            [
+                (batch_logits, batch, samples_batch)
+                for batch_logits, batch, samples_batch in zip(
+                    logits, model_batches, batches(samples, batch_size)
+                )
+            ],
+        )
+        results.append(summarize("formatted_preds", durations, n, **settings))
+
+    for decoding in decoding_modes:
+        durations = time_calls(
+            lambda dicts_batch: predicter.decode(dicts_batch, decoding),
+            [(b,) for b in batches(dicts, batch_size)],
+        )
+        results.append(
+            summarize(
+                {
+                    "normal": "predict",
+                    "sequential": "predict_sequentially",
+                    "adaptive": "predict_adaptively",
+                }[decoding],
+                durations,
+                n,
+                decoding=decoding,
+                **settings,
+            )
+        )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark each stage of the CharMLM pipeline on the CPU and write the results as JSON."
+    )
+    parser.add_argument(
+        "-m",
+        "--model_path",
+        default="../../models/greek_char_BERT",
+        help="The saved model to benchmark.",
+    )
+    parser.add_argument(
+        "-r",
+        "--random_init",
+        default=False,
+        action="store_true",
+        help="Use a randomly initialized model (with the architecture options below, as in train.py) instead of a saved model.",
+    )
+    parser.add_argument(
+        "-v",
+        "--vocab_file",
+        default="../../data/greek_char_vocab.txt",
+        help="The vocab to use with a randomly initialized model.",
+    )
+    parser.add_argument(
+        "-f",
+        "--file",
+        default="../../data/PH2334_masked.txt",
+        help="The text the benchmark sequences are cut from. Missing characters are indicated as for run_prediction.py.",
+    )
+    parser.add_argument(
+        "-n",
+        "--nb_of_sequences",
+        type=int,
+        default=64,
+        help="The number of sequences to process for each setting.",
+    )
+    parser.add_argument("-b", "--batch_sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("-l", "--seq_lens", type=int, nargs="+", default=[64, 192])
+    parser.add_argument(
+        "-t", "--threads", type=int, nargs="+", default=[1, os.cpu_count()]
+    )
+    parser.add_argument(
+        "-d",
+        "--decoding",
+        nargs="+",
+        default=DECODINGS,
+        choices=DECODINGS,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="The file to write the JSON results to (by default they are printed).",
+    )
+    add_architecture_arguments(parser, "Only used with a randomly initialized model.")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    random.seed(42)
+    torch.manual_seed(42)
+
+    predicter = load_predicter(
+        args.model_path, args.random_init, args.vocab_file, max(args.seq_lens), args
+    )
+    tokenizer = predicter.processor.tokenizer
+
+    results = []
+    for seq_len in args.seq_lens:
+        # leave room for [CLS], [SEP], the placeholder and the final [SEP]
+        masked, unmasked = make_sequences(args.file, seq_len - 4, args.nb_of_sequences)
+        torch.set_num_threads(max(args.threads))
+        results.extend(benchmark_preprocessing(tokenizer, masked, unmasked, seq_len))
+        predicter.processor.max_seq_len = seq_len
+        for threads in args.threads:
+            torch.set_num_threads(threads)
+            for batch_size in args.batch_sizes:
+                results.extend(
+                    benchmark_model(
+                        predicter, masked, seq_len, batch_size, threads, args.decoding
+                    )
+                )
+
+    report = {
+        "date": datetime.now().isoformat(),
+        "model": "random_init" if args.random_init else args.model_path,
+        "torch_version": torch.__version__,
+        "cpu_count": os.cpu_count(),
+        "nb_of_sequences": args.nb_of_sequences,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
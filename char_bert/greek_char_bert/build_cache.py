@@ -0,0 +1,53 @@
+"""Tokenizes the train, dev and test sets once and writes them to the binary cache which CharMLMProcessor loads them from (see data_handler/dataset_cache.py). The cache has to be rebuilt if the vocab or max_seq_len change, and is ignored once the dataset has changed."""
+from greek_char_bert.data_handler.tokenization import CharMLMTokenizer
+from greek_char_bert.data_handler.dataset_cache import build_cache
+import logging
+import os
+import argparse
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Build the binary dataset cache used by train.py."
+    )
+    parser.add_argument(
+        "-d", "--data_dir", default="../../data", help="The directory of the dataset."
+    )
+    parser.add_argument(
+        "-v",
+        "--vocab_file",
+        default="../../data/greek_char_vocab.txt",
+        help="The vocab of the model which will be trained.",
+    )
+    parser.add_argument(
+        "-l",
+        "--max_seq_len",
+        type=int,
+        default=192,
+        help="The max_seq_len of the model which will be trained.",
+    )
+    parser.add_argument(
+        "-p",
+        "--pack",
+        default=False,
+        action="store_true",
+        help="Pack consecutive sentences into full length sequences (for use with train.py -p).",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    tokenizer = CharMLMTokenizer(vocab_file=args.vocab_file, do_lower_case=False)
+
+    for filename in ["train.txt", "dev.txt", "test.txt"]:
+        build_cache(
+            os.path.join(args.data_dir, filename),
+            tokenizer,
+            args.max_seq_len,
+            pack_sequences=args.pack,
+        )
@@ -0,0 +1,53 @@
+"""A DataSilo which works with cached datasets."""
+import logging
+
+import numpy as np
+from farm.data_handler.data_silo import DataSilo
+from farm.utils import MLFlowLogger as MlLogger
+
+from greek_char_bert.data_handler.dataset_cache import CharMLMCachedDataset
+
+logger = logging.getLogger(__name__)
+
+
+class CharMLMDataSilo(DataSilo):
+    """Identical to the superclass (located at farm/data_handler/data_silo.py) except that the statistics of cached datasets are calculated from the offsets index rather than by featurizing the whole train set."""
+
+    def _calculate_statistics(self):
+        """This is a modified version of DataSilo._calculate_statistics from farm/data_handler/data_silo.py. -BN"""
+        if not isinstance(self.data["train"], CharMLMCachedDataset):
+            return super()._calculate_statistics()
+
+        self.counts = {
+            "train": len(self.data["train"]),
+            "dev": len(self.data["dev"]) if self.data["dev"] else 0,
+            "test": len(self.data["test"]) if self.data["test"] else 0,
+        }
+
+        seq_lens = self.data["train"].seq_lens()
+        self.ave_len = np.mean(seq_lens)
+        self.clipped = np.mean(seq_lens == self.processor.max_seq_len)
+
+        logger.info("Examples in train: {}".format(self.counts["train"]))
+        logger.info("Examples in dev  : {}".format(self.counts["dev"]))
+        logger.info("Examples in test : {}".format(self.counts["test"]))
+        logger.info("")
+        logger.info("Max sequence length:     {}".format(max(seq_lens)))
+        logger.info("Average sequence length: {}".format(self.ave_len))
+        logger.info("Proportion clipped:      {}".format(self.clipped))
+
+        MlLogger.log_params(
+            {
+                "n_samples_train": self.counts["train"],
+                "n_samples_dev": self.counts["dev"],
+                "n_samples_test": self.counts["test"],
+                "batch_size": self.batch_size,
+                "ave_seq_len": self.ave_len,
+                "clipped": self.clipped,
+            }
+        )
+
+    def _calculate_class_weights(self, dataset):
+        """Class weights are only used for sequence classification, so there is no need to featurize a cached dataset to find that out."""
+        if not isinstance(dataset, CharMLMCachedDataset):
+            super()._calculate_class_weights(dataset)
@@ -0,0 +1,176 @@
+"""A binary cache of the tokenized training data. Each sentence is stored as a run of token ids in a flat array (uint8 or uint16, depending on the size of the vocab) and an offsets index marks where each sentence starts. The arrays are memory-mapped, so loading a cached dataset is nearly instant and each sample is a zero-copy slice. Masking and featurization happen when a sample is fetched, so a new masking is drawn every epoch."""
+from array import array
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from tqdm import tqdm
+
+from greek_char_bert.data_handler.input_features import remove_unknown_chars
+from greek_char_bert.data_handler.samples import CharSample
+from greek_char_bert.data_handler.tokenization import tokenize_with_metadata
+from greek_char_bert.data_handler.utils import pack_sentences, padding_ratio
+
+logger = logging.getLogger(__name__)
+
+TENSOR_NAMES = ["input_ids", "padding_mask", "segment_ids", "lm_label_ids", "label_ids"]
+# [CLS], [SEP], the placeholder second sequence and the final [SEP]
+NB_OF_EXTRA_TOKENS = 4
+
+
+def ids_dtype(tokenizer):
+    """Returns the smallest unsigned integer type which can hold every id in the vocab."""
+    return np.uint8 if len(tokenizer.vocab) <= 2**8 else np.uint16
+
+
+def get_cache_prefix(filename, tokenizer, max_seq_len, pack_sequences=False):
+    """Returns the path prefix of the cache files for filename. The prefix includes a hash of the vocab, max_seq_len and whether the sentences are packed, so a cache is never used with settings it wasn't built for."""
+    vocab_hash = hashlib.md5("\n".join(tokenizer.vocab).encode("utf-8")).hexdigest()
+    prefix = f"{filename}.{vocab_hash[:10]}.{max_seq_len}"
+    if pack_sequences:
+        prefix += ".packed"
+    return prefix
+
+
+def cache_exists(cache_prefix):
+    return os.path.exists(cache_prefix + ".ids") and os.path.exists(
+        cache_prefix + ".offsets.npy"
+    )
+
+
+def source_stamp(filename):
+    """Returns the size and modification time of filename, which tie a cache to the contents of the file it was built from."""
+    stat = os.stat(filename)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def cache_is_current(cache_prefix, filename):
+    """Checks whether the cache exists and was built from filename as it is now (e.g. not before the dataset was regenerated)."""
+    if not (
+        cache_exists(cache_prefix) and os.path.exists(cache_prefix + ".source.json")
+    ):
+        return False
+    with open(cache_prefix + ".source.json", "r") as fp:
+        return json.load(fp) == source_stamp(filename)
+
+
+def read_docs(filename):
+    """Lazily reads a file in the BERT format (one sentence per line, docs separated by empty lines), yielding one list of sentences per doc."""
+    doc = []
+    with open(filename, "r", encoding="utf-8") as fp:
+        for line in fp:
+            line = line.strip()
+            if line == "":
+                if doc:
+                    yield doc
+                doc = []
+            else:
+                doc.append(line)
+    if doc:
+        yield doc
+
+
+def build_cache(filename, tokenizer, max_seq_len, pack_sequences=False):
+    """Tokenizes filename and writes the token ids and the offsets index to the cache. If pack_sequences is set, consecutive sentences are packed into sequences of up to max_seq_len tokens. Returns the cache prefix."""
+    cache_prefix = get_cache_prefix(filename, tokenizer, max_seq_len, pack_sequences)
+    dtype = ids_dtype(tokenizer)
+    # taken before the file is read, so that changes made while the cache is built make it out of date
+    stamp = source_stamp(filename)
+    max_tokens = max_seq_len - NB_OF_EXTRA_TOKENS
+    offsets = array("q", [0])
+    nb_of_sentences = 0
+    nb_of_unpacked_tokens = 0
+    nb_of_tokens = 0
+    with open(cache_prefix + ".ids.tmp", "wb") as fp:
+        for doc in tqdm(read_docs(filename), desc=f"Caching {filename}"):
+            # the last sentence of each doc is skipped, as is the case in create_samples_sentence_pairs_using_placeholder
+            sentences = doc[:-1]
+            nb_of_sentences += len(sentences)
+            nb_of_unpacked_tokens += sum(min(len(s), max_tokens) for s in sentences)
+            if pack_sequences:
+                sentences = pack_sentences(sentences, max_tokens)
+            for sentence in sentences:
+                tokens = tokenize_with_metadata(sentence, tokenizer, max_seq_len)[
+                    "tokens"
+                ]
+                tokens = remove_unknown_chars(tokens[:max_tokens], tokenizer)
+                ids = np.array(tokenizer.convert_tokens_to_ids(tokens), dtype=dtype)
+                fp.write(ids.tobytes())
+                offsets.append(offsets[-1] + len(ids))
+                nb_of_tokens += len(ids)
+    np.save(cache_prefix + ".offsets.tmp.npy", np.frombuffer(offsets, dtype=np.int64))
+    with open(cache_prefix + ".source.tmp.json", "w") as fp:
+        json.dump(stamp, fp)
+    # only replace an existing cache once the new one is complete
+    os.replace(cache_prefix + ".ids.tmp", cache_prefix + ".ids")
+    os.replace(cache_prefix + ".offsets.tmp.npy", cache_prefix + ".offsets.npy")
+    os.replace(cache_prefix + ".source.tmp.json", cache_prefix + ".source.json")
+    logger.info(
+        f"Cached {nb_of_sentences} sentences as {len(offsets) - 1} sequences from {filename} in {cache_prefix}"
+    )
+    if nb_of_sentences:
+        # each sentence would otherwise have been a sequence of its own
+        logger.info(
+            "Padding ratio: {:.3f} (unpacked: {:.3f})".format(
+                padding_ratio(
+                    nb_of_tokens + NB_OF_EXTRA_TOKENS * (len(offsets) - 1),
+                    len(offsets) - 1,
+                    max_seq_len,
+                ),
+                padding_ratio(
+                    nb_of_unpacked_tokens + NB_OF_EXTRA_TOKENS * nb_of_sentences,
+                    nb_of_sentences,
+                    max_seq_len,
+                ),
+            )
+        )
+    return cache_prefix
+
+
+class CharMLMCachedDataset(Dataset):
+    """A dataset which reads its samples from a cache created with build_cache. The samples are featurized on the fly with the processor's _sample_to_features."""
+
+    def __init__(self, cache_prefix, processor):
+        self.processor = processor
+        self.offsets = np.load(cache_prefix + ".offsets.npy")
+        if self.offsets[-1] > 0:
+            self.ids = np.memmap(
+                cache_prefix + ".ids", dtype=ids_dtype(processor.tokenizer), mode="r"
+            )
+        else:
+            # numpy can't memory-map an empty file
+            self.ids = np.zeros(0, dtype=ids_dtype(processor.tokenizer))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def seq_lens(self):
+        """Returns the length of each sample (including the special tokens and placeholder) without featurizing it."""
+        return np.diff(self.offsets) + NB_OF_EXTRA_TOKENS
+
+    def _features(self, idx):
+        ids = self.ids[self.offsets[idx] : self.offsets[idx + 1]]
+        sample = CharSample(
+            id=str(idx), text_a=None, text_b="_", is_next_label=False, token_ids=ids
+        )
+        return self.processor._sample_to_features(sample)[0]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            features = [self._features(i) for i in range(*idx.indices(len(self)))]
+            return tuple(
+                torch.tensor([f[name] for f in features], dtype=torch.long)
+                for name in TENSOR_NAMES
+            )
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        features = self._features(idx)
+        return tuple(
+            torch.tensor(features[name], dtype=torch.long) for name in TENSOR_NAMES
+        )
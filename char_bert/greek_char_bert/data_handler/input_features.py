@@ -1,6 +1,7 @@
 """Modified utility functions for use with the CharMLM."""
 from farm.data_handler.utils import truncate_seq_pair
 from greek_char_bert.data_handler.utils import char_mlm_mask_random_words
+from greek_char_bert.data_handler.samples import sample_tokens
 
 
 def remove_unknown_chars(tokens, tokenizer):
@@ -27,19 +28,21 @@ def samples_to_features_bert_char_mlm(sample, max_seq_len, tokenizer):
     Convert a raw sample (pair of sentences as tokenized strings) into a proper training sample with
     IDs, LM labels, padding_mask, CLS and SEP tokens etc.
 
-    :param sample: Sample, containing sentence input as strings and is_next label
+    :param sample: CharSample or Sample, containing sentence input as strings and is_next label
     :param max_seq_len: int, maximum length of sequence.
     :param tokenizer: Tokenizer
     :return: InputFeatures, containing all inputs and labels of one sample as IDs (as used for model training)
     """
 
-    tokens_a = sample.tokenized["text_a"]["tokens"]
-    tokens_b = sample.tokenized["text_b"]["tokens"]
+    tokens_a, tokens_b = sample_tokens(sample, tokenizer, max_seq_len)
     # Modifies `tokens_a` and `tokens_b` in place so that the total
     # length is less than the specified length.
     # Account for [CLS], [SEP], [SEP] with "- 3"
     truncate_seq_pair(tokens_a, tokens_b, max_seq_len - 3)
 
+    # characters left out of the vocab (see generate_char_vocab.py) are mapped to [UNK]
+    tokens_a = remove_unknown_chars(tokens_a, tokenizer)
+
     tokens_a, t1_label = char_mlm_mask_random_words(tokens_a)
     # TODO don't make a function call here, tokens_b should always just be '_'
     tokens_b, t2_label = char_mlm_mask_random_words(tokens_b)
@@ -127,14 +130,13 @@ def premasked_samples_to_features_bert_char_mlm(sample, max_seq_len, tokenizer):
     Convert a raw sample (pair of sentences as tokenized strings) into a proper training sample with
     IDs, LM labels, padding_mask, CLS and SEP tokens etc.
 
-    :param sample: Sample, containing sentence input as strings and is_next label
+    :param sample: CharSample or Sample, containing sentence input as strings and is_next label
     :param max_seq_len: int, maximum length of sequence.
     :param tokenizer: Tokenizer
     :return: InputFeatures, containing all inputs and labels of one sample as IDs (as used for model training)
     """
 
-    tokens_a = sample.tokenized["text_a"]["tokens"]
-    tokens_b = sample.tokenized["text_b"]["tokens"]
+    tokens_a, tokens_b = sample_tokens(sample, tokenizer, max_seq_len)
     # Modifies `tokens_a` and `tokens_b` in place so that the total
     # length is less than the specified length.
     # Account for [CLS], [SEP], [SEP] with "- 3"
@@ -144,9 +146,9 @@ def premasked_samples_to_features_bert_char_mlm(sample, max_seq_len, tokenizer):
     tokens_a = remove_unknown_chars(tokens_a, tokenizer)
     tokens_b = remove_unknown_chars(tokens_b, tokenizer)
 
-    # usually t1_label and t2_label would contain the original unmasked tokens, as the tokens are already masked when running prediction, they labels here are simple copies of the original tokens.
-    t1_label = tokens_a.copy()
-    t2_label = tokens_b.copy()
+    # usually t1_label and t2_label would contain the original unmasked tokens, as the tokens are already masked when running prediction, only the masked tokens are labelled (with the [MASK] token itself) so that the head is only computed at the masked positions (see CharMLMHead.select_positions).
+    t1_label = [tok if tok == "[MASK]" else "" for tok in tokens_a]
+    t2_label = ["" for _ in tokens_b]
 
     # convert lm labels to ids
     t1_label_ids = [-1 if tok == "" else tokenizer.vocab[tok] for tok in t1_label]
@@ -236,14 +238,13 @@ def premasked_samples_with_answers_to_features_bert_char_mlm(
     Convert a raw sample (pair of sentences as tokenized strings) into a proper training sample with
     IDs, LM labels, padding_mask, CLS and SEP tokens etc.
 
-    :param sample: Sample, containing sentence input as strings and is_next label
+    :param sample: CharSample or Sample, containing sentence input as strings and is_next label
     :param max_seq_len: int, maximum length of sequence.
     :param tokenizer: Tokenizer
     :return: InputFeatures, containing all inputs and labels of one sample as IDs (as used for model training)
     """
 
-    tokens_a = sample.tokenized["text_a"]["tokens"]
-    tokens_b = sample.tokenized["text_b"]["tokens"]
+    tokens_a, tokens_b = sample_tokens(sample, tokenizer, max_seq_len)
 
     seq_and_ans = "".join(tokens_a).split("\t")
     tokens_a = seq_and_ans[0]
@@ -3,7 +3,7 @@ from farm.data_handler.processor import BertStyleLMProcessor, TOKENIZER_MAP
 import random
 import logging
 
-from farm.data_handler.samples import Sample
+from farm.data_handler.samples import Sample, SampleBasket
 from farm.modeling.tokenization import tokenize_with_metadata
 from greek_char_bert.data_handler.input_features import (
     samples_to_features_bert_char_mlm,
@@ -14,8 +14,20 @@ from greek_char_bert.data_handler.samples import (
     create_char_mlm_prediction_samples_sentence_pairs,
     create_samples_sentence_pairs_using_placeholder,
 )
-from greek_char_bert.data_handler.utils import read_docs_from_txt
+from greek_char_bert.data_handler.utils import (
+    read_docs_from_txt,
+    pack_sentences,
+    padding_ratio,
+)
 from greek_char_bert.data_handler.tokenization import CharMLMTokenizer
+from greek_char_bert.data_handler.dataset_cache import (
+    CharMLMCachedDataset,
+    NB_OF_EXTRA_TOKENS,
+    TENSOR_NAMES,
+    cache_exists,
+    cache_is_current,
+    get_cache_prefix,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -26,6 +38,35 @@ TOKENIZER_MAP["CharMLMTokenizer"] = CharMLMTokenizer
 class CharMLMProcessor(BertStyleLMProcessor):
     """Prepares data for a CharMLM."""
 
+    def __init__(
+        self, tokenizer, max_seq_len, data_dir, pack_sequences=False, **kwargs
+    ):
+        """
+        :param pack_sequences: Pack consecutive sentences of a doc (separated by "_") into sequences of up to max_seq_len tokens, rather than padding each sentence to max_seq_len.
+        :type pack_sequences: bool
+        """
+        self.pack_sequences = pack_sequences
+        super().__init__(
+            tokenizer=tokenizer, max_seq_len=max_seq_len, data_dir=data_dir, **kwargs
+        )
+
+    # whether datasets are loaded from the binary cache created by build_cache.py (if it exists)
+    _use_dataset_cache = True
+
+    def dataset_from_file(self, file, log_time=True):
+        """Loads the dataset from the binary cache if one has been built for this file (as it is now), vocab and max_seq_len. Otherwise the file is processed as in Processor.dataset_from_file from farm/data_handler/processor.py."""
+        cache_prefix = get_cache_prefix(
+            file, self.tokenizer, self.max_seq_len, self.pack_sequences
+        )
+        if self._use_dataset_cache and cache_exists(cache_prefix):
+            if cache_is_current(cache_prefix, file):
+                logger.info(f"Loading cached dataset from {cache_prefix}")
+                return CharMLMCachedDataset(cache_prefix, self), TENSOR_NAMES
+            logger.warning(
+                f"Not using the cached dataset {cache_prefix}, {file} has changed since it was built. Rebuild it with build_cache.py."
+            )
+        return super().dataset_from_file(file, log_time=log_time)
+
     def _log_samples(self, n_samples):
         """This is a modified version of Processor._log_samples from farm/data_handler/processor.py. It works around a bug where some baskets are not initialized correctly. -BN"""
         # TODO check whether this bug still occurs.
@@ -49,7 +90,7 @@ class CharMLMProcessor(BertStyleLMProcessor):
     def _dict_to_samples(cls, dict, all_dicts=None):
         """
         Converts a dict with a document to a sample (which will subsequently be featurized). It is used during prediction.
-        
+
         This is a modified version of BertStyleLMProcessor._dict_to_samples from farm/data_handler/processor.py. It has been modified to create samples with just a single text, rather than two, as is the case for a normal BERT model.
         """
         doc = dict["doc"]
@@ -60,13 +101,49 @@ class CharMLMProcessor(BertStyleLMProcessor):
                 doc[idx], cls.tokenizer, cls.max_seq_len
             )
             samples.append(
-                Sample(id=None, clear_text={"doc": doc[idx]}, tokenized=tokenized)
+                Sample(id=None, clear_text={"text_a": doc[idx]}, tokenized=tokenized)
             )
         return samples
 
     def _file_to_dicts(self, file: str) -> list:
         """This function is a copy of BertStyleLMProcessor._file_to_dicts from farm/data_handler/processor.py except that it calls a modified version of read_docs_from_txt - BN"""
         dicts = read_docs_from_txt(filename=file, delimiter=self.delimiter)
+        if self.pack_sequences:
+            dicts = self._pack_dicts(dicts)
+        return dicts
+
+    def _pack_dicts(self, dicts):
+        """Packs the sentences of each doc and logs how much this reduces the padding."""
+        max_tokens = self.max_seq_len - NB_OF_EXTRA_TOKENS
+        nb_of_sentences = 0
+        nb_of_sequences = 0
+        nb_of_unpacked_tokens = 0
+        nb_of_tokens = 0
+        for d in dicts:
+            # the last sentence of each doc is never turned into a sample (see create_samples_sentence_pairs_using_placeholder), so it is left out of the packing
+            sentences = d["doc"][:-1]
+            packed = pack_sentences(sentences, max_tokens)
+            d["doc"] = packed + d["doc"][-1:]
+            nb_of_sentences += len(sentences)
+            nb_of_sequences += len(packed)
+            nb_of_unpacked_tokens += sum(min(len(s), max_tokens) for s in sentences)
+            nb_of_tokens += sum(min(len(s), max_tokens) for s in packed)
+        logger.info(
+            "Packed {} sentences into {} sequences. Padding ratio: {:.3f} (unpacked: {:.3f})".format(
+                nb_of_sentences,
+                nb_of_sequences,
+                padding_ratio(
+                    nb_of_tokens + NB_OF_EXTRA_TOKENS * nb_of_sequences,
+                    nb_of_sequences,
+                    self.max_seq_len,
+                ),
+                padding_ratio(
+                    nb_of_unpacked_tokens + NB_OF_EXTRA_TOKENS * nb_of_sentences,
+                    nb_of_sentences,
+                    self.max_seq_len,
+                ),
+            )
+        )
         return dicts
 
     @classmethod
@@ -81,6 +158,36 @@ class CharMLMProcessor(BertStyleLMProcessor):
 class CharMLMPredProcessor(CharMLMProcessor):
     """A modified processor for predictions. It modifies _sample_to_features to not mask the input sequences."""
 
+    _use_dataset_cache = False
+
+    def dataset_and_samples_from_dicts(self, dicts):
+        """
+        This is a modified version of Processor.dataset_from_dicts from farm/data_handler/processor.py which also returns the samples in the same order as the dataset, so that they don't have to be recreated (and the texts tokenized a second time) for formatted_preds. Only the clear text of each sample is kept. -BN
+
+        :param dicts: List of dictionaries where each contains the data of one input sample.
+        :type dicts: list of dicts
+        :return: a Pytorch dataset, a list of tensor names and a list of samples.
+        """
+        self.baskets = [
+            SampleBasket(raw=tr, id="infer - {}".format(i))
+            for i, tr in enumerate(dicts)
+        ]
+        self._init_samples_in_baskets()
+        self._featurize_samples()
+        samples = [sample for basket in self.baskets for sample in basket.samples]
+        dataset, tensor_names = self._create_dataset()
+        # the token ids and features are in the dataset now
+        for sample in samples:
+            sample.token_ids = None
+            sample.features = None
+        return dataset, tensor_names, samples
+
+    def _featurize_samples(self):
+        """This is a modified version of Processor._featurize_samples from farm/data_handler/processor.py which featurizes the samples in the calling process instead of a multiprocessing Pool. Prediction featurizes one batch at a time (see MLMPredicter._predict), for which starting a Pool costs more than it saves, and forking from the featurization thread isn't safe. -BN"""
+        for basket in self.baskets:
+            for f, s in zip(self._multiproc_featurize(basket), basket.samples):
+                s.features = f
+
     @classmethod
     def _sample_to_features(cls, sample) -> dict:
         """This function is a copy of the function of the same name in farm/data_handler/input_features.py. It has been modifed to call a modified featurization function. -BN"""
@@ -97,6 +204,8 @@ class CharMLMPredProcessor(CharMLMProcessor):
 
 
 class PremaskedCharMLMProcessor(CharMLMProcessor):
+    _use_dataset_cache = False
+
     def _init_samples_in_baskets(self):
         """This function is a copy of Processor._init_samples_in_baskets from farm/data_handler/processor.py except that it calls a modified version of create_sample_sentence_pairs - BN"""
         # TODO what are the advantages of this over create_mlm_prediction_samples_sentence_pairs
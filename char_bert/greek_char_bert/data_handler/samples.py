@@ -1,34 +1,88 @@
-from farm.data_handler.samples import Sample
 from greek_char_bert.data_handler.utils import get_sentence_pair_with_placeholder
 from greek_char_bert.data_handler.tokenization import tokenize_with_metadata
+from array import array
 from tqdm import tqdm
 
 
+class CharSample:
+    """
+    A lean replacement for Sample (located at farm/data_handler/samples.py) for the CharMLM. Instead of dicts with the clear text and the tokens, offsets and start_of_word flags of both texts, it only keeps the texts and the token ids of the first text in an array (the featurizers never use the offsets or start_of_word flags). Tokens which aren't in the vocab are stored as vocab size + their code point (they are single chars), so that they can be recovered for featurizers which need them (see token_ids_to_tokens). This takes about an order of magnitude less memory per sentence and creates far fewer objects for the garbage collector to track.
+    """
+
+    __slots__ = ("id", "text_a", "text_b", "is_next_label", "token_ids", "features")
+
+    def __init__(self, id, text_a, text_b, is_next_label, token_ids, features=None):
+        self.id = id
+        self.text_a = text_a
+        self.text_b = text_b
+        self.is_next_label = is_next_label
+        self.token_ids = token_ids
+        self.features = features
+
+    @classmethod
+    def from_text(cls, id, text_a, text_b, is_next_label, tokenizer, max_seq_len):
+        tokens = tokenize_with_metadata(text_a, tokenizer, max_seq_len)["tokens"]
+        token_ids = tokens_to_token_ids(tokens, tokenizer.vocab)
+        return cls(id, text_a, text_b, is_next_label, token_ids)
+
+    @property
+    def clear_text(self):
+        """The clear text in the same format as that of a Sample."""
+        return {
+            "text_a": self.text_a,
+            "text_b": self.text_b,
+            "is_next_label": self.is_next_label,
+        }
+
+    def tokens(self, tokenizer, max_seq_len):
+        """Returns the tokens of both texts (as new lists, which the featurizers can modify)."""
+        tokens_a = token_ids_to_tokens(self.token_ids, tokenizer.ids_to_tokens)
+        tokens_b = tokenize_with_metadata(self.text_b, tokenizer, max_seq_len)["tokens"]
+        return tokens_a, tokens_b
+
+    def __str__(self):
+        return f"ID: {self.id}\nClear Text: {self.clear_text}\nToken ids: {self.token_ids}\nFeatures: {self.features}"
+
+
+def tokens_to_token_ids(tokens, vocab):
+    """Converts tokens to an array of ids. Tokens which aren't in the vocab are converted to len(vocab) + their code point."""
+    ids = [vocab[t] if t in vocab else len(vocab) + ord(t) for t in tokens]
+    return array("H" if max(ids, default=0) < 2**16 else "I", ids)
+
+
+def token_ids_to_tokens(token_ids, ids_to_tokens):
+    """The inverse of tokens_to_token_ids. token_ids can be an array or a numpy array."""
+    return [
+        ids_to_tokens[i] if i < len(ids_to_tokens) else chr(i - len(ids_to_tokens))
+        for i in token_ids.tolist()
+    ]
+
+
+def sample_tokens(sample, tokenizer, max_seq_len):
+    """Returns the tokens of both texts of a CharSample or a Sample."""
+    if isinstance(sample, CharSample):
+        return sample.tokens(tokenizer, max_seq_len)
+    return sample.tokenized["text_a"]["tokens"], sample.tokenized["text_b"]["tokens"]
+
+
 def create_char_mlm_prediction_samples_sentence_pairs(baskets, tokenizer, max_seq_len):
-    """A modified version of create_samples_sentence_pairs from farm/data_handlers/samples.py which simply assigns the first text as text_a and the second text as text_b. This only works becauses the docs contain a sentence to be predicted and a placeholder as the second text."""
+    """A modified version of create_samples_sentence_pairs from farm/data_handlers/samples.py which simply assigns the first text as text_a and the second text as text_b. This only works becauses the docs contain a sentence to be predicted and a placeholder as the second text. The samples are CharSamples."""
     for basket in tqdm(baskets):
         doc = basket.raw["doc"]
-        basket.samples = []
         id = "%s" % (basket.id)
         text_a = doc[0]
         text_b = doc[1]
         is_next_label = 1
-        sample_in_clear_text = {
-            "text_a": text_a,
-            "text_b": text_b,
-            "is_next_label": is_next_label,
-        }
-        tokenized = {}
-        tokenized["text_a"] = tokenize_with_metadata(text_a, tokenizer, max_seq_len)
-        tokenized["text_b"] = tokenize_with_metadata(text_b, tokenizer, max_seq_len)
-        basket.samples.append(
-            Sample(id=id, clear_text=sample_in_clear_text, tokenized=tokenized)
-        )
+        basket.samples = [
+            CharSample.from_text(
+                id, text_a, text_b, is_next_label, tokenizer, max_seq_len
+            )
+        ]
     return baskets
 
 
 def create_samples_sentence_pairs_using_placeholder(baskets, tokenizer, max_seq_len):
-    """A modified version of create_samples_sentence_pairs from farm/data_handlers/samples.py which calls a modified version of get_sentence_pair which just fetches a placeholder for the second sentence."""
+    """A modified version of create_samples_sentence_pairs from farm/data_handlers/samples.py which calls a modified version of get_sentence_pair which just fetches a placeholder for the second sentence. The samples are CharSamples."""
     # TODO why not just use create_char_mlm_prediction_samples_sentence_pairs? Check if it makes a difference.
     for basket in tqdm(baskets):
         doc = basket.raw["doc"]
@@ -36,15 +90,9 @@ def create_samples_sentence_pairs_using_placeholder(baskets, tokenizer, max_seq_
         for idx in range(len(doc) - 1):
             id = "%s-%s" % (basket.id, idx)
             text_a, text_b, is_next_label = get_sentence_pair_with_placeholder(doc, idx)
-            sample_in_clear_text = {
-                "text_a": text_a,
-                "text_b": text_b,
-                "is_next_label": is_next_label,
-            }
-            tokenized = {}
-            tokenized["text_a"] = tokenize_with_metadata(text_a, tokenizer, max_seq_len)
-            tokenized["text_b"] = tokenize_with_metadata(text_b, tokenizer, max_seq_len)
             basket.samples.append(
-                Sample(id=id, clear_text=sample_in_clear_text, tokenized=tokenized)
+                CharSample.from_text(
+                    id, text_a, text_b, is_next_label, tokenizer, max_seq_len
+                )
             )
     return baskets
@@ -116,3 +116,36 @@ def get_sentence_pair_with_placeholder(doc, idx):
     assert len(sent_1) > 0
     assert len(sent_2) > 0
     return sent_1, sent_2, label
+
+
+def pack_sentences(sentences, max_len, separator="_"):
+    """
+    Packs consecutive sentences, joined by the separator, into sequences of at most max_len characters, so that less of each sequence is padding. Sentences which are longer than max_len are left as they are (they are truncated during featurization).
+
+    :param sentences: the sentences to pack, in order.
+    :type sentences: [str]
+    :param max_len: maximum length of a packed sequence.
+    :type max_len: int
+    :param separator: the string placed between two sentences.
+    :type separator: str
+    :return: [str], the packed sequences.
+    """
+    packed = []
+    current = ""
+    for sentence in sentences:
+        if current and len(current) + len(separator) + len(sentence) <= max_len:
+            current += separator + sentence
+        else:
+            if current:
+                packed.append(current)
+            current = sentence
+    if current:
+        packed.append(current)
+    return packed
+
+
+def padding_ratio(nb_of_tokens, nb_of_sequences, max_seq_len):
+    """Returns the proportion of padding in nb_of_sequences sequences of max_seq_len which contain nb_of_tokens tokens in total."""
+    if nb_of_sequences == 0:
+        return 0.0
+    return 1 - nb_of_tokens / (nb_of_sequences * max_seq_len)
@@ -0,0 +1,192 @@
+"""Vectorized evaluation metrics for CharMLM predictions. The predictions are first flattened into aligned arrays with one entry per masked character (the predicted id, the gold id, the id of the mask span and the id of the sequence it belongs to). Every metric is then computed from these arrays with numpy."""
+import numpy as np
+
+
+def find_spans(masked_texts):
+    """Finds every run of masked characters (#) in masked_texts. Returns arrays with the start, length and sequence id of each span."""
+    # all the texts are joined so that the spans can be found in a single pass
+    joined = "\n".join(masked_texts)
+    codes = np.frombuffer(joined.encode("utf-32-le"), dtype=np.uint32)
+    is_mask = (codes == ord("#")).astype(np.int8)
+    # the spans start and end where is_mask changes
+    changes = np.flatnonzero(np.diff(np.concatenate(([0], is_mask, [0]))))
+    starts, ends = changes[::2], changes[1::2]
+    text_starts = np.cumsum([0] + [len(t) + 1 for t in masked_texts[:-1]])
+    seq_ids = np.searchsorted(text_starts, starts, side="right") - 1
+    return starts - text_starts[seq_ids], ends - starts, seq_ids
+
+
+def align_predictions(predictions, answers):
+    """
+    Flattens the predictions and answers of several sequences into aligned arrays. Sequences where the number of predictions, answers and masked characters don't match are skipped.
+
+    :param predictions: the predictions as returned by MLMPredicter.predict.
+    :type predictions: [dict]
+    :param answers: the original characters for each masked character, one string per sequence.
+    :type answers: [str]
+    :return: (dict, [int]) a dict with the aligned arrays "pred_ids", "gold_ids", "span_ids" and "seq_ids", the arrays "span_lens" and "span_seq_ids" (the length and sequence id of each span), "chars" (which maps ids back to characters), "nb_of_seqs" and "skipped", plus the indices of the skipped sequences.
+    """
+    nb_of_seqs = len(predictions)
+    masked_texts = [pred["predictions"]["masked_text"] for pred in predictions]
+    _, span_lens, span_seq_ids = find_spans(masked_texts)
+    nb_of_masked_chars = np.bincount(
+        span_seq_ids, weights=span_lens, minlength=nb_of_seqs
+    )
+    nb_of_preds = np.array(
+        [len(pred["predictions"]["predictions"]) for pred in predictions], dtype=int
+    )
+    nb_of_answers = np.array([len(ans) for ans in answers], dtype=int)
+    is_valid = (nb_of_preds == nb_of_answers) & (nb_of_preds == nb_of_masked_chars)
+    skipped = np.flatnonzero(~is_valid).tolist()
+    keep_span = is_valid[span_seq_ids]
+    span_lens = span_lens[keep_span].astype(np.int64)
+    span_seq_ids = span_seq_ids[keep_span].astype(np.int64)
+
+    char_ids = {}
+    pred_ids = [
+        char_ids.setdefault(c, len(char_ids))
+        for i in np.flatnonzero(is_valid)
+        for c in predictions[i]["predictions"]["predictions"]
+    ]
+    gold_ids = [
+        char_ids.setdefault(c, len(char_ids))
+        for i in np.flatnonzero(is_valid)
+        for c in answers[i]
+    ]
+    span_ids = np.repeat(np.arange(len(span_lens)), span_lens)
+    aligned = {
+        "pred_ids": np.array(pred_ids, dtype=np.int64),
+        "gold_ids": np.array(gold_ids, dtype=np.int64),
+        "span_ids": span_ids,
+        "seq_ids": span_seq_ids[span_ids],
+        "span_lens": span_lens,
+        "span_seq_ids": span_seq_ids,
+        "chars": list(char_ids),
+        "nb_of_seqs": nb_of_seqs,
+        "skipped": skipped,
+    }
+    return aligned, skipped
+
+
+def char_errors(aligned):
+    """Returns a boolean array which is True for every incorrectly predicted char."""
+    return aligned["pred_ids"] != aligned["gold_ids"]
+
+
+def accuracy_per_char(aligned):
+    """Returns the proportion of masked chars which were predicted correctly."""
+    if len(aligned["pred_ids"]) == 0:
+        return 0.0
+    return 1.0 - np.mean(char_errors(aligned))
+
+
+def errors_per_span(aligned):
+    """Returns the number of incorrectly predicted chars in each span."""
+    return np.bincount(
+        aligned["span_ids"],
+        weights=char_errors(aligned),
+        minlength=len(aligned["span_lens"]),
+    ).astype(np.int64)
+
+
+def errors_per_seq(aligned):
+    """Returns the number of incorrectly predicted chars in each sequence (including the skipped ones, which have none)."""
+    return np.bincount(
+        aligned["seq_ids"],
+        weights=char_errors(aligned),
+        minlength=aligned["nb_of_seqs"],
+    ).astype(np.int64)
+
+
+def accuracy_per_seq(aligned):
+    """Returns the proportion of sequences in which every masked char was predicted correctly. The skipped sequences aren't counted."""
+    seq_errors = errors_per_seq(aligned)
+    seq_errors[aligned["skipped"]] = -1
+    nb_of_seqs = (seq_errors >= 0).sum()
+    if nb_of_seqs == 0:
+        return 0.0
+    return (seq_errors == 0).sum() / nb_of_seqs
+
+
+def accuracy_per_span(aligned):
+    """Returns the proportion of spans in which every char was predicted correctly."""
+    if len(aligned["span_lens"]) == 0:
+        return 0.0
+    return np.mean(errors_per_span(aligned) == 0)
+
+
+def mask_length_histogram(aligned):
+    """Returns a dict mapping each mask length to the number of spans of that length."""
+    counts = np.bincount(aligned["span_lens"])
+    return {int(length): int(counts[length]) for length in np.flatnonzero(counts)}
+
+
+def accuracy_per_mask_length(aligned):
+    """Returns a dict mapping each mask length to a dict with the total number of chars and masks, the number of char errors and the number of correct masks."""
+    span_errors = errors_per_span(aligned)
+    span_lens = aligned["span_lens"]
+    nb_of_lengths = span_lens.max() + 1 if len(span_lens) else 0
+    total_masks = np.bincount(span_lens, minlength=nb_of_lengths)
+    char_errors_per_length = np.bincount(
+        span_lens, weights=span_errors, minlength=nb_of_lengths
+    )
+    correct_masks = np.bincount(
+        span_lens, weights=span_errors == 0, minlength=nb_of_lengths
+    )
+    return {
+        int(length): {
+            "total_chars": int(total_masks[length] * length),
+            "total_masks": int(total_masks[length]),
+            "char_errors": int(char_errors_per_length[length]),
+            "correct_masks": int(correct_masks[length]),
+        }
+        for length in np.flatnonzero(total_masks)
+    }
+
+
+def bootstrap_ci(correct, total, nb_of_resamples=1000, confidence=0.95, seed=42):
+    """
+    Estimates a confidence interval for an accuracy with the percentile bootstrap. Whole groups (e.g. sequences or spans) are resampled, since the chars within a group aren't independent.
+
+    :param correct: the number of correct predictions in each group.
+    :type correct: np.ndarray
+    :param total: the number of predictions in each group.
+    :type total: np.ndarray
+    :param nb_of_resamples: how many times to resample the groups.
+    :type nb_of_resamples: int
+    :param confidence: the confidence level of the interval.
+    :type confidence: float
+    :param seed: the seed of the random number generator.
+    :type seed: int
+    :return: (float, float), the lower and upper bound of the interval.
+    """
+    correct = np.asarray(correct, dtype=np.float64)
+    total = np.asarray(total, dtype=np.float64)
+    if total.sum() == 0:
+        return 0.0, 0.0
+    rng = np.random.RandomState(seed)
+    accuracies = np.empty(nb_of_resamples)
+    for i in range(nb_of_resamples):
+        # how often each group was drawn in this resample
+        weights = np.bincount(
+            rng.randint(0, len(total), len(total)), minlength=len(total)
+        )
+        accuracies[i] = weights @ correct / max(weights @ total, 1.0)
+    alpha = (1.0 - confidence) / 2
+    low, high = np.percentile(accuracies, [alpha * 100, (1.0 - alpha) * 100])
+    return low, high
+
+
+def accuracy_per_char_ci(aligned, **kwargs):
+    """Returns a bootstrap confidence interval for the per char accuracy, resampling sequences."""
+    total = np.bincount(aligned["seq_ids"], minlength=aligned["nb_of_seqs"])
+    correct = total - errors_per_seq(aligned)
+    # sequences without predictions (e.g. skipped ones) don't contribute
+    has_preds = total > 0
+    return bootstrap_ci(correct[has_preds], total[has_preds], **kwargs)
+
+
+def accuracy_per_span_ci(aligned, **kwargs):
+    """Returns a bootstrap confidence interval for the per span accuracy, resampling spans."""
+    span_correct = errors_per_span(aligned) == 0
+    return bootstrap_ci(span_correct, np.ones(len(span_correct)), **kwargs)
@@ -4,6 +4,45 @@ from greek_char_bert.modelling.prediction_head import CharMLMHead
 
 
 class CharMLMAdaptiveModel(AdaptiveModel):
+    def forward(self, **kwargs):
+        """
+        This method is a copy of AdaptiveModel.forward() from farm/modeling/adaptive_model.py. It has been modified to only pass the hidden states at the positions which have to be predicted to a CharMLMHead. - BN
+
+        Push data through the whole model and returns logits. The data will propagate through the language
+        model and each of the attached prediction heads.
+
+        :param kwargs: Holds all arguments that need to be passed to the language model and prediction head(s).
+        :return: all logits as torch.tensor or multiple tensors.
+        """
+        # Run language model
+        sequence_output, pooled_output = self.language_model(
+            **kwargs, output_all_encoded_layers=False
+        )
+
+        # Run (multiple) prediction heads
+        all_logits = []
+        for head, lm_out in zip(self.prediction_heads, self.lm_output_types):
+            # Choose relevant vectors from LM as output and perform dropout
+            if isinstance(head, CharMLMHead):
+                output = self.dropout(sequence_output[head.select_positions(**kwargs)])
+            elif lm_out == "per_token":
+                output = self.dropout(sequence_output)
+            elif lm_out == "per_sequence":
+                output = self.dropout(pooled_output)
+            elif (
+                lm_out == "per_token_squad"
+            ):  # we need a per_token_squad because of variable metric computation later on...
+                output = self.dropout(sequence_output)
+            else:
+                raise ValueError(
+                    "Unknown extraction strategy from language model: {}".format(lm_out)
+                )
+
+            # Do the actual forward pass of a single head
+            all_logits.append(head(output))
+
+        return all_logits
+
     @classmethod
     def load(cls, load_dir, device):
         """
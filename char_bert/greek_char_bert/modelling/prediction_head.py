@@ -1,34 +1,77 @@
 import logging
+import numpy as np
+import torch
 from farm.modeling.prediction_head import PredictionHead, BertLMHead
 
 logger = logging.getLogger(__name__)
 
+# the vocabs created by generate_char_vocab.py start with [PAD], [UNK], [CLS], [SEP], [MASK]
+DEFAULT_MASK_TOKEN_ID = 4
+
 
 class CharMLMHead(BertLMHead):
-    """A prediction head for CharMLM. It handels transforming the raw model output logits into human-readable predictions."""
+    """A prediction head for CharMLM. It handels transforming the raw model output logits into human-readable predictions.
+
+    The head is only computed at the positions which have to be predicted (see select_positions), rather than at every position, so the logits have the shape (number of selected positions, vocab size). The CharMLMAdaptiveModel gathers the hidden states at these positions before passing them to the head.
+    """
+
+    def __init__(
+        self, hidden_size, vocab_size, mask_token_id=DEFAULT_MASK_TOKEN_ID, **kwargs
+    ):
+        super().__init__(hidden_size, vocab_size, **kwargs)
+        self.mask_token_id = mask_token_id
+        # BertLMHead generates the config before mask_token_id is set
+        self.generate_config()
+
+    def select_positions(self, input_ids, lm_label_ids, **kwargs):
+        """Returns a boolean tensor which is True at the positions which have to be predicted: the labelled positions during training and the masked ones during prediction.
+
+        Note that the training featurizers (samples_to_features_bert_char_mlm and premasked_samples_with_answers_to_features_bert_char_mlm) label every real token, not only the masked ones, as the model is trained to reconstruct the whole sequence. So during training every non-padding position is selected and only the padding is skipped. Computing the loss at the masked positions only would change the training objective. The head is only computed at the masked positions during prediction, where premasked_samples_to_features_bert_char_mlm only labels the [MASK] tokens."""
+        return (lm_label_ids != -1) | (input_ids == self.mask_token_id)
+
+    def logits_to_loss(self, logits, lm_label_ids, **kwargs):
+        """
+        This method is a modified version of BertLMHead.logits_to_loss from farm/modeling/prediction_head.py which takes the logits of the selected positions only. -BN
 
-    def logits_to_preds(self, logits, label_map, input_ids, **kwargs):
+        The loss of each sample is the sum of the losses of its labelled positions divided by the sequence length, so that the mean over the batch is the same as in BertLMHead (where the unlabelled positions add a loss of 0).
+        """
+        selected = self.select_positions(lm_label_ids=lm_label_ids, **kwargs)
+        masked_lm_loss = self.loss_fct(logits, lm_label_ids[selected])
+        seq_ids = selected.nonzero()[:, 0]
+        per_sample_loss = torch.zeros(
+            lm_label_ids.shape[0], dtype=masked_lm_loss.dtype, device=logits.device
+        ).index_add_(0, seq_ids, masked_lm_loss)
+        return per_sample_loss / lm_label_ids.shape[1]
+
+    def masked_rows(self, input_ids, lm_label_ids):
+        """Returns the sequence id of each row of the logits and a boolean array which is True for the rows of masked tokens."""
+        selected = self.select_positions(input_ids=input_ids, lm_label_ids=lm_label_ids)
+        seq_ids, positions = np.nonzero(selected.cpu().numpy())
+        is_masked = input_ids.cpu().numpy()[seq_ids, positions] == self.mask_token_id
+        return seq_ids, is_masked
+
+    def logits_to_preds(self, logits, label_map, input_ids, lm_label_ids, **kwargs):
         """Converts the raw output logits into a list of predicted characters.
 
-        This method is a modified version of BertLMHead.logits_to_loss from farm/modeling/prediction_head.py. It extracts the logits for the masked tokens by checking the indices rather than using lm_label_ids.
+        This method is a modified version of BertLMHead.logits_to_preds from farm/modeling/prediction_head.py. It extracts the logits for the masked tokens by checking the indices rather than using lm_label_ids.
         """
-        logits = logits.cpu().numpy()
-        input_ids = input_ids.cpu().numpy()
-        lm_preds_ids = logits.argmax(2)
-        # apply mask to get rid of predictions for non-masked tokens
-        assert lm_preds_ids.shape == input_ids.shape
-        char_indices = dict([(v, k) for k, v in label_map.items()])
-        mask_index = char_indices["[MASK]"]
-        lm_preds_ids[input_ids != mask_index] = -1
-        lm_preds_ids = lm_preds_ids.tolist()
-        preds = []
-        # we have a batch of sequences here. we need to convert for each token in each sequence.
-        for pred_ids_for_sequence in lm_preds_ids:
-            preds.append(
-                [label_map[int(x)] for x in pred_ids_for_sequence if int(x) != -1]
-            )
+        lm_preds_ids = logits.argmax(-1).cpu().numpy()
+        seq_ids, is_masked = self.masked_rows(input_ids, lm_label_ids)
+        # get rid of predictions for non-masked tokens
+        preds = [[] for _ in range(input_ids.shape[0])]
+        for seq_id, pred_id in zip(seq_ids[is_masked], lm_preds_ids[is_masked]):
+            preds[seq_id].append(label_map[int(pred_id)])
         return preds
 
+    def logits_to_probs(self, logits, input_ids, lm_label_ids, **kwargs):
+        """Returns the probability (according to the softmax) of each predicted character, in the same order as logits_to_preds."""
+        probs = torch.softmax(logits.float(), dim=-1).max(-1)[0].cpu().numpy()
+        seq_ids, is_masked = self.masked_rows(input_ids, lm_label_ids)
+        seq_probs = [[] for _ in range(input_ids.shape[0])]
+        for seq_id, prob in zip(seq_ids[is_masked], probs[is_masked]):
+            seq_probs[seq_id].append(float(prob))
+        return seq_probs
+
     def prepare_labels(self, label_map, lm_label_ids, **kwargs):
         """Returns a list of the ids of characters which were originally masked. Based on BertLMHead.prepare_labels() (located at farm/modeling/prediction_head.py)."""
         label_ids = lm_label_ids.cpu().numpy().tolist()
@@ -93,20 +136,22 @@ class CharMLMHead(BertLMHead):
         return text.replace("][", "")
 
     def formatted_preds(self, logits, label_map, samples, **kwargs):
-        """Take the raw logits and produce json output containing the original text, the text with predictions, the masked text and the predicted characters."""
+        """Take the raw logits and produce json output containing the original text, the text with predictions, the masked text, the predicted characters and their probabilities."""
         input_ids = kwargs["input_ids"]
         lm_label_ids = kwargs["lm_label_ids"]
         padding_mask = kwargs["padding_mask"]
-        preds = self.logits_to_preds(logits, label_map, input_ids)
+        preds = self.logits_to_preds(logits, label_map, input_ids, lm_label_ids)
+        probs = self.logits_to_probs(logits, input_ids, lm_label_ids)
         res = []
         for (
             sample,
             sample_preds,
+            sample_probs,
             sample_input_ids,
             sample_lm_labels,
             sample_padding_mask,
-        ) in zip(samples, preds, input_ids, lm_label_ids, padding_mask):
-            original_text = "".join(sample.clear_text["doc"])
+        ) in zip(samples, preds, probs, input_ids, lm_label_ids, padding_mask):
+            original_text = sample.clear_text["text_a"]
             masked_text = self.tokens_as_text(
                 original_text,
                 sample_input_ids,
@@ -123,6 +168,7 @@ class CharMLMHead(BertLMHead):
                         "text_with_preds": text_with_preds,
                         "masked_text": masked_text,
                         "predictions": sample_preds,
+                        "probabilities": sample_probs,
                     },
                 }
             )
@@ -1,17 +1,299 @@
 """The CharMLMPredicter class plus various functions needed to predict missing chars."""
 from greek_char_bert.infer import CharMLMInferencer
 from greek_char_bert.data_handler.processor import CharMLMPredProcessor
-from farm.data_handler.dataloader import NamedDataLoader
-from torch.utils.data.sampler import SequentialSampler
+from greek_char_bert.prediction_cache import model_fingerprint, ngram_fingerprint
+from greek_char_bert.data_handler.dataset_cache import NB_OF_EXTRA_TOKENS
+from farm.data_handler.utils import truncate_seq_pair
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Thread, Event
+import cProfile
+import queue
+import numpy as np
 import torch
+import time
 import re
+import os
 import copy
 
+# set to "time", "cprofile" or "torch" to profile every MLMPredicter (see MLMPredicter.__init__)
+PROFILE_ENV_VAR = "CHAR_MLM_PROFILE"
+PROFILE_MODES = ["time", "cprofile", "torch"]
+DECODINGS = ["normal", "sequential", "adaptive"]
+# the token of a masked char, as in greek_data_prep/char_ngram.py
+MASK = "[MASK]"
+
+# marks the end of the items passed between the stages of run_pipeline
+_DONE = object()
+
 
 class MLMPredicter(CharMLMInferencer):
+    def __init__(
+        self,
+        *args,
+        profile=None,
+        profile_output="predict_profile",
+        cache=None,
+        pipeline_depth=2,
+        ngram_model=None,
+        ngram_threshold=0.9,
+        confidence_threshold=0.9,
+        max_iterations=8,
+        parallel_index=None,
+        **kwargs,
+    ):
+        """
+        Takes the same arguments as Inferencer.__init__ (located at farm/infer.py) plus:
+
+        :param profile: None to disable profiling, "time" to record the wall time and the number of items of each stage of prediction in self.metrics (and the wall time of all the calls in self.wall_seconds), "cprofile" or "torch" to also capture a cProfile of all the calls to predict or a torch profile of each call. Defaults to the value of the CHAR_MLM_PROFILE environment variable. When profiling, the stages of prediction run one after the other in the calling thread (see pipeline_depth), so that the stage times don't overlap and cProfile sees all of them.
+        :type profile: str
+        :param profile_output: path (without extension) which the cProfile (.prof) or the torch profiles (_1.json, _2.json, ..., chrome traces) are written to.
+        :type profile_output: str
+        :param cache: a PredictionCache in which the predictions are stored, so that sequences which have already been predicted (with the same model and decoding mode) aren't run through the model again. None to disable caching.
+        :type cache: PredictionCache
+        :param pipeline_depth: the number of batches which can wait between the stages of prediction (featurization, forward pass and formatting, see run_pipeline), which run in parallel. 0 to run the stages one after the other. Ignored when profiling.
+        :type pipeline_depth: int
+        :param ngram_model: a CharNgramModel (see greek_data_prep/char_ngram.py) which answers the masked chars it is confident about before the rest are predicted by the BERT model (see _cascade). None to only use the BERT model.
+        :type ngram_model: CharNgramModel
+        :param ngram_threshold: the minimum probability of an n-gram prediction for it to be used.
+        :type ngram_threshold: float
+        :param confidence_threshold: the minimum probability of every char in a gap for the adaptive decoder to accept the gap's predictions (see predict_adaptively).
+        :type confidence_threshold: float
+        :param max_iterations: the maximum number of passes the adaptive decoder makes after the first one.
+        :type max_iterations: int
+        :param parallel_index: a SuffixArrayIndex (see greek_data_prep/suffix_array.py) over the training corpus, in which parallel passages of the context of a gap are looked up (see find_parallels and rank_supplements). None to disable the lookup.
+        :type parallel_index: SuffixArrayIndex
+        """
+        super().__init__(*args, **kwargs)
+        if profile is None:
+            profile = os.environ.get(PROFILE_ENV_VAR) or None
+        if profile is not None and profile not in PROFILE_MODES:
+            raise ValueError(
+                f"Unknown profile mode {profile}, choose from {PROFILE_MODES}."
+            )
+        self.profile = profile
+        self.profile_output = profile_output
+        self.metrics = {}
+        self.wall_seconds = 0.0
+        self._wall_depth = 0
+        # only created when a cProfile is captured (see _profiled_predict)
+        self._profiler = None
+        self._nb_of_traces = 0
+        self.cache = cache
+        self.pipeline_depth = pipeline_depth
+        self.ngram_model = ngram_model
+        self.ngram_threshold = ngram_threshold
+        self.confidence_threshold = confidence_threshold
+        self.max_iterations = max_iterations
+        self.parallel_index = parallel_index
+        self._fingerprint = None
+        self._ngram_fingerprint = None
+
+    def reset_metrics(self):
+        self.metrics = {}
+        self.wall_seconds = 0.0
+
+    @contextmanager
+    def _wall_time(self):
+        """Adds the wall time of the outermost call to self.wall_seconds, if profiling is enabled. Unlike the sum of the stage times, it includes the time spent between the stages."""
+        if not self.profile or self._wall_depth:
+            yield
+            return
+        self._wall_depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.wall_seconds += time.perf_counter() - start
+            self._wall_depth -= 1
+
+    @contextmanager
+    def _stage(self, name, nb_of_items):
+        """Adds the wall time and the number of items of a stage to self.metrics, if profiling is enabled."""
+        if not self.profile:
+            yield
+            return
+        start = time.perf_counter()
+        yield
+        stage = self.metrics.setdefault(name, {"seconds": 0.0, "calls": 0, "items": 0})
+        stage["seconds"] += time.perf_counter() - start
+        stage["calls"] += 1
+        stage["items"] += nb_of_items
+
+    def fingerprint(self):
+        """Returns the fingerprint of the model used in the cache keys. It is only computed once, so the cache should be cleared if the weights are changed in place."""
+        if self._fingerprint is None:
+            self._fingerprint = model_fingerprint(self.model, self.processor)
+        return self._fingerprint
+
+    def ngram_fingerprint(self):
+        """Returns the fingerprint of the n-gram model used in the cache keys. Like fingerprint, it is only computed once per n-gram model."""
+        if self._ngram_fingerprint is None or self._ngram_fingerprint[0] is not (
+            self.ngram_model
+        ):
+            self._ngram_fingerprint = (
+                self.ngram_model,
+                ngram_fingerprint(self.ngram_model),
+            )
+        return self._ngram_fingerprint[1]
+
+    def _cached(self, dicts, decoding, predict, cascade=False):
+        """Returns the cached predictions for dicts, running predict only on the dicts which aren't in the cache (each distinct one only once). If cascade is True and an n-gram model is set, it answers the masked chars it is confident about before predict is run (see _cascade)."""
+        with self._wall_time():
+            return self._cached_predictions(dicts, decoding, predict, cascade)
+
+    def _cached_predictions(self, dicts, decoding, predict, cascade):
+        cascade = cascade and self.ngram_model is not None
+        if cascade:
+            bert_predict = predict
+
+            def predict(dicts):
+                return self._cascade(dicts, bert_predict)
+
+        if self.cache is None:
+            return predict(dicts)
+        with self._stage("cache_lookup", len(dicts)):
+            fingerprint = self.fingerprint()
+            if cascade:
+                decoding = f"{decoding}+ngram_{self.ngram_fingerprint()}_{self.ngram_threshold}"
+            keys = [self.cache.key(fingerprint, decoding, d) for d in dicts]
+            results = {}
+            missing = OrderedDict()
+            for key, d in zip(keys, dicts):
+                if key in results or key in missing:
+                    continue
+                prediction = self.cache.get(key)
+                if prediction is None:
+                    missing[key] = d
+                else:
+                    results[key] = prediction
+        if missing:
+            predictions = predict(list(missing.values()))
+            for key, prediction in zip(missing, predictions):
+                self.cache.put(key, prediction)
+                results[key] = prediction
+        # duplicates get their own copy
+        seen = set()
+        predictions = []
+        for key in keys:
+            predictions.append(
+                copy.deepcopy(results[key]) if key in seen else results[key]
+            )
+            seen.add(key)
+        return predictions
+
     def predict(self, dicts):
+        """Runs prediction on dicts (see _predict), using the cache if one is set and profiling the call if a profile mode is set."""
+        return self._cached(dicts, "normal", self._profiled_predict, cascade=True)
+
+    def _cascade(self, dicts, predict):
+        """Answers the masked chars which the n-gram model predicts with a probability of at least ngram_threshold and runs predict only on the dicts in which masked chars are left, with the n-gram predictions filled in. The predictions are merged and a list of the stage ("ngram" or "bert") which answered each masked char is added to them under "stages"."""
+        with self._stage("ngram", len(dicts)):
+            texts = [split_masked_text(d["doc"][0]) for d in dicts]
+            ngram_preds = []
+            for chars in texts:
+                preds = {}
+                for i, c in enumerate(chars):
+                    if c == MASK:
+                        pred = self.ngram_model.predict(chars, i)
+                        if pred is not None and pred[1] >= self.ngram_threshold:
+                            preds[i] = pred
+                ngram_preds.append(preds)
+        remaining = [
+            j
+            for j, (chars, preds) in enumerate(zip(texts, ngram_preds))
+            if chars.count(MASK) > len(preds)
+        ]
+        bert_dicts = []
+        for j in remaining:
+            filled_text = "".join(
+                ngram_preds[j][i][0] if i in ngram_preds[j] else c
+                for i, c in enumerate(texts[j])
+            )
+            bert_dicts.append({**dicts[j], "doc": [filled_text] + dicts[j]["doc"][1:]})
+        bert_preds = dict(zip(remaining, predict(bert_dicts))) if bert_dicts else {}
+        results = []
+        for j, (d, preds) in enumerate(zip(dicts, ngram_preds)):
+            if j in bert_preds:
+                # mask the chars answered by the n-gram model again (the masked text may have been truncated)
+                masked_text = list(bert_preds[j]["predictions"]["masked_text"])
+                for i in preds:
+                    if i < len(masked_text):
+                        masked_text[i] = "#"
+                masked_text = "".join(masked_text)
+                bert_chars = iter(bert_preds[j]["predictions"]["predictions"])
+                bert_probs = iter(bert_preds[j]["predictions"]["probabilities"])
+            else:
+                # the masked text of formatted_preds includes the second segment and is truncated like the features
+                chars_a = list(texts[j])
+                chars_b = [c for text in d["doc"][1:] for c in split_masked_text(text)]
+                truncate_seq_pair(chars_a, chars_b, self.processor.max_seq_len - 3)
+                masked_text = "".join(
+                    "#" if c == MASK else c for c in chars_a + chars_b
+                )
+                bert_chars = iter([])
+                bert_probs = iter([])
+            predicted_chars = []
+            probabilities = []
+            stages = []
+            for i, c in enumerate(masked_text):
+                if c != "#":
+                    continue
+                if i in preds:
+                    pred, prob = preds[i]
+                    stage = "ngram"
+                else:
+                    pred = next(bert_chars, None)
+                    prob = next(bert_probs, None)
+                    stage = "bert"
+                    if pred is None:
+                        break
+                predicted_chars.append(pred)
+                probabilities.append(prob)
+                stages.append(stage)
+            results.append(
+                {
+                    "task": "mlm",
+                    "predictions": {
+                        "original_text": d["doc"][0],
+                        "text_with_preds": insert_preds(masked_text, predicted_chars),
+                        "masked_text": masked_text,
+                        "predictions": predicted_chars,
+                        "probabilities": probabilities,
+                        "stages": stages,
+                    },
+                }
+            )
+        return results
+
+    def _profiled_predict(self, dicts):
+        if self.profile == "cprofile":
+            # the stats are accumulated over all calls, e.g. during sequential decoding
+            if self._profiler is None:
+                self._profiler = cProfile.Profile()
+            self._profiler.enable()
+            try:
+                return self._predict(dicts)
+            finally:
+                self._profiler.disable()
+                self._profiler.dump_stats(f"{self.profile_output}.prof")
+        if self.profile == "torch":
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device.type == "cuda":
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            with torch.profiler.profile(activities=activities) as profiler:
+                result = self._predict(dicts)
+            # one trace per call
+            self._nb_of_traces += 1
+            profiler.export_chrome_trace(
+                f"{self.profile_output}_{self._nb_of_traces}.json"
+            )
+            return result
+        return self._predict(dicts)
+
+    def _predict(self, dicts):
         """
-        This function is a simple modification of the MLMInferencer/Inferencer's run_inference method (located at farm/infer.py) except that it uses a custom processor which does not mask the input (which is already masked when running prediction).
+        This function is a modification of the MLMInferencer/Inferencer's run_inference method (located at farm/infer.py) except that it uses a custom processor which does not mask the input (which is already masked when running prediction) and that the dicts are featurized, run through the model and formatted batch by batch in a pipeline (see run_pipeline).
         :param dicts: Masked samples to run prediction on provided as a list of dicts. One dict per sample.
         :type dicst: [dict]
         :return: dict of predictions
@@ -22,32 +304,52 @@ class MLMPredicter(CharMLMInferencer):
             max_seq_len=self.processor.max_seq_len,
             data_dir=self.processor.data_dir,
         )
-        dataset, tensor_names = pred_processor.dataset_from_dicts(dicts)
-        samples = []
-        for dict in dicts:
-            samples.extend(pred_processor._dict_to_samples(dict, dicts))
-
-        data_loader = NamedDataLoader(
-            dataset=dataset,
-            sampler=SequentialSampler(dataset),
-            batch_size=self.batch_size,
-            tensor_names=tensor_names,
-        )
+        batches = [
+            dicts[i : i + self.batch_size]
+            for i in range(0, len(dicts), self.batch_size)
+        ]
 
-        preds_all = []
-        for i, batch in enumerate(data_loader):
-            batch = {key: batch[key].to(self.device) for key in batch}
-            batch_samples = samples[i * self.batch_size : (i + 1) * self.batch_size]
+        def featurize(batch_dicts):
+            with self._stage("dataset_from_dicts", len(batch_dicts)):
+                (
+                    dataset,
+                    tensor_names,
+                    samples,
+                ) = pred_processor.dataset_and_samples_from_dicts(batch_dicts)
+            batch = {
+                name: tensor.to(self.device)
+                for name, tensor in zip(tensor_names, dataset.tensors)
+            }
+            return batch, samples
+
+        def forward(featurized):
+            batch, samples = featurized
             with torch.no_grad():
-                logits = self.model.forward(**batch)
-                preds = self.model.formatted_preds(
-                    logits=logits,
-                    label_maps=pred_processor.label_maps,
-                    samples=batch_samples,
-                    tokenizer=pred_processor.tokenizer,
-                    **batch,
-                )
-                preds_all.append(preds)
+                with self._stage("forward", len(samples)):
+                    return self.model.forward(**batch)
+
+        def decode(featurized, logits):
+            batch, samples = featurized
+            with torch.no_grad():
+                with self._stage("formatted_preds", len(samples)):
+                    return self.model.formatted_preds(
+                        logits=logits,
+                        label_maps=pred_processor.label_maps,
+                        samples=samples,
+                        tokenizer=pred_processor.tokenizer,
+                        **batch,
+                    )
+
+        # the stages only run in parallel without profiling, since the stage times would overlap and cProfile only sees the calling thread
+        if self.pipeline_depth and len(batches) > 1 and not self.profile:
+            preds_all = run_pipeline(
+                batches, featurize, forward, decode, self.pipeline_depth
+            )
+        else:
+            preds_all = []
+            for batch_dicts in batches:
+                featurized = featurize(batch_dicts)
+                preds_all.append(decode(featurized, forward(featurized)))
         # flatten list
         preds_all = [
             p for outer_list in preds_all for pred_dict in outer_list for p in pred_dict
@@ -56,24 +358,33 @@ class MLMPredicter(CharMLMInferencer):
 
     def predict_sequentially(self, dicts):
         """An experimental sequential decoder, with recursively decoders one character at a time. A very slow implementation best thought of as a proof of concept."""
+        return self._cached(
+            dicts, "sequential", self._predict_sequentially, cascade=True
+        )
+
+    def _predict_sequentially(self, dicts):
         nb_of_sequences = len(dicts)
         nb_finished = 0
-        predictions = self.predict(dicts=dicts)
+        # the n-gram cascade (if any) has already been applied to the dicts
+        predictions = self._cached(dicts, "normal", self._profiled_predict)
         final_predictions = copy.deepcopy(predictions)
+        # the probability of each char when it was filled in
+        probabilities = [[] for _ in predictions]
         while nb_finished < nb_of_sequences:
             nb_finished = 0
             new_masked_sequences = []
-            for pred in predictions:
+            for i, pred in enumerate(predictions):
                 masked_seq = pred["predictions"]["masked_text"]
                 if masked_seq.find("#") == -1:
                     nb_finished += 1
                 else:
                     first_predicted_char = pred["predictions"]["predictions"][0]
+                    probabilities[i].append(pred["predictions"]["probabilities"][0])
                     masked_seq = masked_seq.replace("#", first_predicted_char, 1)
                 masked_seq = convert_masks(masked_seq)
                 new_masked_sequences.append(masked_seq)
             dicts = sentences_to_dicts(new_masked_sequences)
-            predictions = self.predict(dicts=dicts)
+            predictions = self._cached(dicts, "normal", self._profiled_predict)
         # ensure that we output a well formated list of prediction dicts
         for i, (pred_dict, predicted_seq) in enumerate(
             zip(final_predictions, predictions)
@@ -90,8 +401,353 @@ class MLMPredicter(CharMLMInferencer):
                 "][", ""
             )
             final_predictions[i]["predictions"]["predictions"] = predicted_chars
+            final_predictions[i]["predictions"]["probabilities"] = probabilities[i]
         return final_predictions
 
+    def predict_adaptively(self, dicts):
+        """A decoder which only decodes the gaps (runs of masked chars) which the model isn't confident about sequentially (see _predict_adaptively). It is much faster than predict_sequentially when most gaps are easy."""
+        return self._cached(
+            dicts,
+            f"adaptive_{self.confidence_threshold}_{self.max_iterations}",
+            self._predict_adaptively,
+            cascade=True,
+        )
+
+    def _predict_adaptively(self, dicts):
+        """
+        Runs one pass over all the dicts and accepts the predictions of the gaps in which every char was predicted with a probability of at least confidence_threshold. In each further pass, the most probable char of every remaining gap is filled in and the rest of these gaps are predicted again, with all the dicts which still have open gaps in the same batches. The gaps which have become confident are accepted after each pass. After max_iterations passes, the remaining chars keep their last predictions.
+        """
+        # the n-gram cascade (if any) has already been applied to the dicts
+        predictions = self._cached(dicts, "normal", self._profiled_predict)
+        texts = [split_masked_text(d["doc"][0]) for d in dicts]
+        # the current (char, probability) of the open and the accepted masked chars of each text, by position
+        open_chars = []
+        accepted = []
+        gaps = []
+        for chars, pred in zip(texts, predictions):
+            positions = [i for i, c in enumerate(chars) if c == MASK]
+            # masked chars which didn't fit into the model aren't predicted
+            open_chars.append(
+                {
+                    i: (c, p)
+                    for i, c, p in zip(
+                        positions,
+                        pred["predictions"]["predictions"],
+                        pred["predictions"]["probabilities"],
+                    )
+                }
+            )
+            accepted.append({})
+            text_gaps = []
+            for i in sorted(open_chars[-1]):
+                if text_gaps and text_gaps[-1][-1] == i - 1:
+                    text_gaps[-1].append(i)
+                else:
+                    text_gaps.append([i])
+            gaps.append(text_gaps)
+
+        def open_gaps(j):
+            for gap in gaps[j]:
+                positions = [i for i in gap if i in open_chars[j]]
+                if positions:
+                    yield positions
+
+        def accept_confident_gaps(j):
+            for positions in open_gaps(j):
+                if all(
+                    open_chars[j][i][1] >= self.confidence_threshold for i in positions
+                ):
+                    for i in positions:
+                        accepted[j][i] = open_chars[j].pop(i)
+
+        for j in range(len(dicts)):
+            accept_confident_gaps(j)
+        for _ in range(self.max_iterations):
+            uncertain = [j for j in range(len(dicts)) if open_chars[j]]
+            if not uncertain:
+                break
+            for j in uncertain:
+                for positions in list(open_gaps(j)):
+                    best = max(positions, key=lambda i: open_chars[j][i][1])
+                    accepted[j][best] = open_chars[j].pop(best)
+            uncertain = [j for j in uncertain if open_chars[j]]
+            new_dicts = []
+            for j in uncertain:
+                text = "".join(
+                    accepted[j][i][0] if i in accepted[j] else c
+                    for i, c in enumerate(texts[j])
+                )
+                new_dicts.append({**dicts[j], "doc": [text] + dicts[j]["doc"][1:]})
+            new_predictions = self._cached(new_dicts, "normal", self._profiled_predict)
+            for j, pred in zip(uncertain, new_predictions):
+                for i, c, p in zip(
+                    sorted(open_chars[j]),
+                    pred["predictions"]["predictions"],
+                    pred["predictions"]["probabilities"],
+                ):
+                    open_chars[j][i] = (c, p)
+                accept_confident_gaps(j)
+        final_predictions = copy.deepcopy(predictions)
+        for pred, chars, open_text_chars in zip(
+            final_predictions, accepted, open_chars
+        ):
+            chars.update(open_text_chars)
+            predicted_chars = [chars[i][0] for i in sorted(chars)]
+            pred["predictions"]["predictions"] = predicted_chars
+            pred["predictions"]["probabilities"] = [chars[i][1] for i in sorted(chars)]
+            pred["predictions"]["text_with_preds"] = insert_preds(
+                pred["predictions"]["masked_text"], predicted_chars
+            )
+        return final_predictions
+
+    def score_candidates(self, masked_text, candidates, pseudo_log_likelihood=False):
+        """
+        Ranks candidate supplements for the gap in masked_text. Each candidate is scored by its log-likelihood at the masked positions: the gap is replaced by as many masked chars as the candidate has and the log probabilities of the candidate's chars are summed. Optionally, the pseudo-log-likelihood of the filled in text is computed too: the candidate is inserted and each of its chars is masked in turn. Both are also given per char, and as the sums favour shorter candidates, the candidates are ranked by the per char values if they differ in length (and by the sums otherwise). All the inputs are run through the model in one batched pass, and identical inputs (e.g. those of candidates with the same length) only once.
+
+        :param masked_text: a text with a single gap, marked by # or [MASK] (spaces can be given as spaces or underscores). Long texts are cropped around the gap.
+        :type masked_text: str
+        :param candidates: the supplements to score, which can be longer or shorter than the gap (but not empty).
+        :type candidates: [str]
+        :param pseudo_log_likelihood: whether to also compute the pseudo-log-likelihood and rank the candidates by it.
+        :type pseudo_log_likelihood: bool
+        :return: a dict per candidate with the "candidate", its "log_likelihood", "pseudo_log_likelihood" (if requested), the same per char ("log_likelihood_per_char" and "pseudo_log_likelihood_per_char") and the "score" it is ranked by, best first.
+        :rtype: [dict]
+        """
+        left, right, _ = split_gap(masked_text)
+        vocab = self.processor.tokenizer.vocab
+        # the row of each distinct input and the (input, index of the masked char, char id) of each term of each score
+        inputs = OrderedDict()
+        terms = {}
+        candidates = list(OrderedDict.fromkeys(candidates))
+        if "" in candidates:
+            raise ValueError("The candidates can't be empty.")
+        for candidate in candidates:
+            chars = candidate.replace(" ", "_")
+            left_context, right_context = self._crop_context(left, right, len(chars))
+            char_ids = [vocab.get(c, vocab["[UNK]"]) for c in chars]
+            masked_input = left_context + MASK * len(chars) + right_context
+            inputs.setdefault(masked_input, len(inputs))
+            terms[candidate, "log_likelihood"] = [
+                (masked_input, j, char_id) for j, char_id in enumerate(char_ids)
+            ]
+            if pseudo_log_likelihood:
+                terms[candidate, "pseudo_log_likelihood"] = []
+                for j, char_id in enumerate(char_ids):
+                    masked_input = (
+                        left_context + chars[:j] + MASK + chars[j + 1 :] + right_context
+                    )
+                    inputs.setdefault(masked_input, len(inputs))
+                    terms[candidate, "pseudo_log_likelihood"].append(
+                        (masked_input, 0, char_id)
+                    )
+        log_probs = self._masked_log_probs(list(inputs))
+        scores = []
+        for candidate in candidates:
+            score = {"candidate": candidate}
+            for name in ["log_likelihood", "pseudo_log_likelihood"]:
+                if (candidate, name) in terms:
+                    score[name] = float(
+                        sum(
+                            log_probs[inputs[masked_input]][j, char_id]
+                            for masked_input, j, char_id in terms[candidate, name]
+                        )
+                    )
+                    score[name + "_per_char"] = score[name] / len(candidate)
+            name = (
+                "pseudo_log_likelihood" if pseudo_log_likelihood else "log_likelihood"
+            )
+            if len({len(c) for c in candidates}) > 1:
+                name += "_per_char"
+            score["score"] = score[name]
+            scores.append(score)
+        return sorted(scores, key=lambda score: score["score"], reverse=True)
+
+    def find_parallels(self, masked_text, context_len=32, max_results=100):
+        """Looks up the passages of the corpus of parallel_index in which the context of the gap in masked_text occurs verbatim (using up to context_len chars on either side, see SuffixArrayIndex.find_parallels). Returns a dict per passage with the chars it has at the gap under "fill"."""
+        if self.parallel_index is None:
+            raise ValueError("The MLMPredicter has no parallel_index.")
+        left, right, gap_len = split_gap(masked_text)
+        with self._stage("find_parallels", 1):
+            return self.parallel_index.find_parallels(
+                left[max(0, len(left) - context_len) :] if context_len else "",
+                right[:context_len],
+                gap_len,
+                max_results=max_results,
+            )
+
+    def rank_supplements(
+        self,
+        masked_text,
+        candidates=(),
+        parallel_weight=1.0,
+        pseudo_log_likelihood=False,
+        context_len=32,
+    ):
+        """
+        Ranks supplements for the gap in masked_text, drawing candidates from the model and from the parallel passages in the corpus. The candidates are the given ones, the fills of the parallels of the gap's context (see find_parallels) and the model's own prediction. They are scored with score_candidates (per char, if not all of them have the length of the gap) and the score of each is increased by parallel_weight * log(1 + the number of parallels with that fill).
+
+        :param candidates: additional supplements to rank.
+        :type candidates: [str]
+        :param parallel_weight: the weight of the parallels in the score. 0 to only use them as a source of candidates.
+        :type parallel_weight: float
+        :return: a dict per candidate as returned by score_candidates plus the number of "parallels" with it as fill, best first.
+        :rtype: [dict]
+        """
+        left, right, gap_len = split_gap(masked_text)
+        parallels = {}
+        if self.parallel_index is not None:
+            for parallel in self.find_parallels(masked_text, context_len):
+                parallels[parallel["fill"]] = parallels.get(parallel["fill"], 0) + 1
+        left, right = self._crop_context(left, right, gap_len)
+        dicts = sentences_to_dicts([left + MASK * gap_len + right])
+        model_candidate = "".join(self.predict(dicts)[0]["predictions"]["predictions"])
+        candidates = list(candidates) + list(parallels) + [model_candidate]
+        scores = self.score_candidates(
+            masked_text, candidates, pseudo_log_likelihood=pseudo_log_likelihood
+        )
+        for score in scores:
+            score["parallels"] = parallels.get(score["candidate"].replace(" ", "_"), 0)
+            score["score"] += parallel_weight * float(np.log1p(score["parallels"]))
+        return sorted(scores, key=lambda score: score["score"], reverse=True)
+
+    def _crop_context(self, left, right, gap_len):
+        """Crops the context on either side of a gap of gap_len chars so that the whole sequence fits into the model, keeping as much context as possible on both sides."""
+        available = self.processor.max_seq_len - NB_OF_EXTRA_TOKENS - gap_len
+        if available < 0:
+            raise ValueError(f"A gap of {gap_len} chars doesn't fit into the model.")
+        nb_left = min(len(left), max(available // 2, available - len(right)))
+        nb_right = min(len(right), available - nb_left)
+        return left[len(left) - nb_left :], right[:nb_right]
+
+    def _masked_log_probs(self, sequences):
+        """Runs the sequences (in which the masked chars are [MASK] tokens) through the model in batches. Returns an array of shape (number of masked chars, vocab size) with the log probabilities at the masked positions for each sequence."""
+        pred_processor = CharMLMPredProcessor(
+            tokenizer=self.processor.tokenizer,
+            max_seq_len=self.processor.max_seq_len,
+            data_dir=self.processor.data_dir,
+        )
+        with self._stage("dataset_from_dicts", len(sequences)):
+            dataset, tensor_names, _ = pred_processor.dataset_and_samples_from_dicts(
+                sentences_to_dicts(sequences)
+            )
+        head = self.model.prediction_heads[0]
+        log_probs = []
+        for start in range(0, len(sequences), self.batch_size):
+            batch = {
+                name: tensor[start : start + self.batch_size].to(self.device)
+                for name, tensor in zip(tensor_names, dataset.tensors)
+            }
+            nb_of_sequences = batch["input_ids"].shape[0]
+            with torch.no_grad():
+                with self._stage("forward", nb_of_sequences):
+                    logits = self.model.forward(**batch)[0]
+                batch_log_probs = torch.log_softmax(logits.float(), dim=-1)
+            seq_ids, is_masked = head.masked_rows(
+                batch["input_ids"], batch["lm_label_ids"]
+            )
+            nb_of_masks = np.bincount(seq_ids[is_masked], minlength=nb_of_sequences)
+            log_probs.extend(
+                np.split(
+                    batch_log_probs.cpu().numpy()[is_masked],
+                    np.cumsum(nb_of_masks)[:-1],
+                )
+            )
+        return log_probs
+
+    def decode(self, dicts, decoding="normal"):
+        """Runs prediction on dicts with one of the DECODINGS: predict, predict_sequentially or predict_adaptively."""
+        if decoding == "sequential":
+            return self.predict_sequentially(dicts)
+        if decoding == "adaptive":
+            return self.predict_adaptively(dicts)
+        return self.predict(dicts)
+
+
+def run_pipeline(items, featurize, forward, decode, queue_size):
+    """Runs featurize on the items in a background thread, forward on the featurized items in the calling thread and decode on the featurized items and the output of forward in another background thread. The stages are connected by queues of queue_size items, so that the next batch is featurized and the previous one decoded while the model runs (torch releases the GIL during the forward pass). Returns the decoded items in the same order as items. An exception in any stage stops the others and is raised again."""
+    to_forward = queue.Queue(queue_size)
+    to_decode = queue.Queue(queue_size)
+    stop = Event()
+    errors = []
+    results = []
+
+    def put(q, item):
+        # give up if another stage has failed, so that no thread waits forever
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def featurizer():
+        try:
+            for item in items:
+                if not put(to_forward, featurize(item)):
+                    return
+            put(to_forward, _DONE)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    def decoder():
+        try:
+            while True:
+                item = get(to_decode)
+                if item is _DONE:
+                    return
+                results.append(decode(*item))
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    threads = [
+        Thread(target=featurizer, daemon=True),
+        Thread(target=decoder, daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            featurized = get(to_forward)
+            if featurized is _DONE:
+                break
+            put(to_decode, (featurized, forward(featurized)))
+        put(to_decode, _DONE)
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def format_metrics(metrics, wall_seconds=None):
+    """Formats the metrics recorded by an MLMPredicter as a table with one line per stage, followed by the sum of the stage times and, if given, the wall time."""
+    total = sum(stage["seconds"] for stage in metrics.values())
+    lines = [f"{'stage':<20}{'seconds':>10}{'share':>8}{'calls':>8}{'items':>8}"]
+    for name, stage in metrics.items():
+        share = stage["seconds"] / total if total else 0.0
+        lines.append(
+            f"{name:<20}{stage['seconds']:>10.3f}{share:>8.1%}{stage['calls']:>8}{stage['items']:>8}"
+        )
+    lines.append(f"{'stages total':<20}{total:>10.3f}")
+    if wall_seconds is not None:
+        lines.append(f"{'wall time':<20}{wall_seconds:>10.3f}")
+    return "\n".join(lines)
+
 
 def replace_square_brackets(sent):
     """Converts sentences where missing characters are indicated by full stops enclosed by square brackets to sentences where the missing characaters are indicated by hash symbols."""
@@ -107,6 +763,29 @@ def replace_square_brackets(sent):
     return "".join(masked_sent)
 
 
+def split_masked_text(text):
+    """Splits a text into a list of chars in which each [MASK] token is a single item."""
+    return re.findall(r"\[MASK\]|.", text, flags=re.S)
+
+
+def split_gap(masked_text):
+    """Splits a text with a single gap, marked by # or [MASK] (spaces can be given as spaces or underscores), into the context on either side of the gap (with underscores for spaces) and the length of the gap."""
+    text = masked_text.replace(MASK, "#").replace(" ", "_")
+    gaps = list(re.finditer(r"#+", text))
+    if len(gaps) != 1:
+        raise ValueError(
+            f"The masked text should contain exactly one gap, not {len(gaps)}."
+        )
+    return text[: gaps[0].start()], text[gaps[0].end() :], len(gaps[0].group())
+
+
+def insert_preds(masked_text, preds):
+    """Inserts the predicted chars into masked_text (in which the masked chars are #), enclosing them in square brackets."""
+    for p in preds:
+        masked_text = masked_text.replace("#", f"[{p}]", 1)
+    return masked_text.replace("][", "")
+
+
 def convert_masks(seq):
     """Converts # masking to the [MASK] symbol used by BERT."""
     seq = list(seq)
@@ -0,0 +1,141 @@
+"""A cache for the predictions of an MLMPredicter. The predictions are keyed by a fingerprint of the model, the decoding mode and the normalized masked sequence, so that texts (or windows of texts) which have already been predicted don't have to be featurized and run through the model again. The cache is an in-memory LRU, optionally backed by a directory on disk so that it persists between runs."""
+from collections import OrderedDict
+import hashlib
+import logging
+import json
+import copy
+import os
+
+logger = logging.getLogger(__name__)
+
+# part of every key, so that predictions stored in an older format aren't reused
+CACHE_FORMAT = 2
+
+
+def model_fingerprint(model, processor):
+    """Returns a hash of the model's weights, the vocab and max_seq_len, which together determine the predictions."""
+    md5 = hashlib.md5()
+    for name, tensor in model.state_dict().items():
+        md5.update(name.encode("utf-8"))
+        md5.update(tensor.detach().cpu().numpy().tobytes())
+    md5.update("\n".join(processor.tokenizer.vocab).encode("utf-8"))
+    md5.update(str(processor.max_seq_len).encode("utf-8"))
+    return md5.hexdigest()
+
+
+def ngram_fingerprint(ngram_model):
+    """Returns a hash of the counts and the config of a CharNgramModel."""
+    md5 = hashlib.md5()
+    md5.update(memoryview(ngram_model.counts))
+    config = [
+        ngram_model.chars,
+        ngram_model.order,
+        ngram_model.nb_of_bits,
+        ngram_model.min_count,
+    ]
+    md5.update(json.dumps(config).encode("utf-8"))
+    return md5.hexdigest()
+
+
+def normalize_masked_doc(doc):
+    """Normalizes a doc (as created by sentences_to_dicts) so that the different ways of masking a char (# or [MASK]) give the same key."""
+    return "\n".join(sent.replace("#", "[MASK]") for sent in doc)
+
+
+class PredictionCache:
+    """An LRU cache of predictions with size-bounded eviction in memory and (optionally) on disk."""
+
+    def __init__(self, max_entries=10000, cache_dir=None, max_disk_entries=100000):
+        """
+        :param max_entries: the maximum number of predictions kept in memory.
+        :type max_entries: int
+        :param cache_dir: a directory in which the predictions are also stored (one JSON file per prediction). None to only keep them in memory.
+        :type cache_dir: str
+        :param max_disk_entries: the maximum number of predictions stored in cache_dir. The least recently used ones are removed first.
+        :type max_disk_entries: int
+        """
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.nb_of_disk_entries = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.nb_of_disk_entries = len(self._disk_files())
+
+    def key(self, fingerprint, decoding, d):
+        """Returns the key of the prediction for the dict d."""
+        key = "\t".join(
+            [str(CACHE_FORMAT), fingerprint, decoding, normalize_masked_doc(d["doc"])]
+        )
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Returns a copy of the prediction stored under key, or None if there isn't one."""
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(self.entries[key])
+        if self.cache_dir is not None:
+            path = self._path(key)
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as fp:
+                    prediction = json.load(fp)
+                # mark the file as recently used
+                os.utime(path)
+                self._put_in_memory(key, prediction)
+                self.hits += 1
+                return copy.deepcopy(prediction)
+        self.misses += 1
+        return None
+
+    def put(self, key, prediction):
+        prediction = copy.deepcopy(prediction)
+        self._put_in_memory(key, prediction)
+        if self.cache_dir is not None:
+            path = self._path(key)
+            if not os.path.exists(path):
+                self.nb_of_disk_entries += 1
+            # write to a temporary file first, so that a crash never leaves a corrupt entry
+            with open(path + ".tmp", "w", encoding="utf-8") as fp:
+                json.dump(prediction, fp, ensure_ascii=False)
+            os.replace(path + ".tmp", path)
+            if self.nb_of_disk_entries > self.max_disk_entries:
+                self._evict_from_disk()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self.entries),
+            "disk_entries": self.nb_of_disk_entries,
+        }
+
+    def _put_in_memory(self, key, prediction):
+        self.entries[key] = prediction
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def _disk_files(self):
+        return [
+            os.path.join(self.cache_dir, f)
+            for f in os.listdir(self.cache_dir)
+            if f.endswith(".json")
+        ]
+
+    def _evict_from_disk(self):
+        """Removes the least recently used files until a tenth of max_disk_entries is free, so that the directory doesn't have to be listed on every put."""
+        files = sorted(self._disk_files(), key=os.path.getmtime)
+        nb_to_keep = int(self.max_disk_entries * 0.9)
+        for path in files[: max(0, len(files) - nb_to_keep)]:
+            os.remove(path)
+        self.nb_of_disk_entries = min(len(files), nb_to_keep)
+        logger.info(f"Evicted {len(files) - self.nb_of_disk_entries} predictions")
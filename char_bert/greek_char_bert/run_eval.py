@@ -1,23 +1,44 @@
-"""Evaluate a model using several different datasets and produce a simple accuracy report. Accuracy is reported per mask length and both the per character accuracy and the per sequence (or per mask) accuracy are reported. Two types of evaluation data are supported, tsv files with two fields (masked sentences, answers) and with three fields (maksed sentences, original sentences, answers.). The files is currently set up to evaluate on two dataset, char-gaps, brackets and pythia. Note that the decoding style has to be changed manually."""
+"""Evaluate a model using several different datasets and produce a simple accuracy report. Accuracy is reported per mask length and both the per character accuracy and the per sequence (or per mask) accuracy are reported. Two types of evaluation data are supported, tsv files with two fields (masked sentences, answers) and with three fields (maksed sentences, original sentences, answers.). The files is currently set up to evaluate on three datasets, char-gaps, brackets and pythia. All the datasets are predicted in a single pass, optionally sharded across several worker processes."""
 from greek_char_bert.predict import MLMPredicter, sentences_to_dicts
+from greek_char_bert.metrics import (
+    accuracy_per_char,
+    accuracy_per_char_ci,
+    accuracy_per_mask_length,
+    accuracy_per_seq,
+    align_predictions,
+    char_errors,
+    errors_per_seq,
+    errors_per_span,
+)
+from greek_data_prep.char_ngram import CharNgramModel
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import re
+import time
+import os
 import random as rn
+import torch
+import argparse
 
+# the model and the n-gram model used by each worker process when prediction is sharded
+worker_model = None
+worker_ngram_model = None
 
-def load_data(path):
-    """Loads data, skipping lines with fewer than two fields."""
+
+def load_data(path, sample_size=None):
+    """Loads data, skipping lines with fewer than two fields. By default the whole file is loaded, if sample_size is set a random sample of at most sample_size lines is returned instead."""
+    sents_and_answers = []
     with open(path, "r") as fp:
-        data = fp.read().splitlines()
-        sents_and_answers = []
-        for sent in data:
-            sent = sent.replace(" ", "_")
+        for sent in fp:
+            sent = sent.rstrip("\n").replace(" ", "_")
             sent = sent.split("\t")
             if len(sent) < 2:
                 continue
             sents_and_answers.append(sent)
-    data = rn.sample(sents_and_answers, min(10, len(sents_and_answers)))
-    return np.array(data)
+    if sample_size:
+        sents_and_answers = rn.sample(
+            sents_and_answers, min(sample_size, len(sents_and_answers))
+        )
+    return np.array(sents_and_answers)
 
 
 def convert_masking(sentences):
@@ -32,31 +53,26 @@ def convert_masking(sentences):
     return converted_sentences
 
 
-def evaluate_predictions_per_char(predictions, original_sentences, answers):
-    """Evaluates predictions per char, returning the accuracy and lists of correct and incorrect sentences."""
-    predicted_chars = []
-    sentences_with_preds = []
+def evaluate_predictions_per_char(
+    predictions, original_sentences, answers, aligned=None
+):
+    """Evaluates predictions per char, returning the accuracy and lists of correct and incorrect sentences. The predictions can be passed already aligned (see metrics.align_predictions)."""
+    if aligned is None:
+        aligned, _ = align_predictions(predictions, answers)
+    skipped = aligned["skipped"]
+    if skipped:
+        print(f"Skipped {len(skipped)} malformed samples.")
+    acc = accuracy_per_char(aligned)
+    seq_errors = errors_per_seq(aligned)
+    seq_errors[skipped] = -1
     errors = set()
-    correct_sentences = []
-    total = 0
-    correct = 0
-    for pred in predictions:
-        predicted_chars.append(pred["predictions"]["predictions"])
-        sentences_with_preds.append(pred["predictions"]["text_with_preds"])
-    for pred_chars, sent_with_pred, ans, orig_sent in zip(
-        predicted_chars, sentences_with_preds, answers, original_sentences
-    ):
-        sent_correct = True
-        for p, a in zip(pred_chars, ans):
-            total += 1
-            if p != a:
-                errors.add(f"{sent_with_pred}\t{orig_sent}\t{ans}")
-                sent_correct = False
-            else:
-                correct += 1
-        if sent_correct:
-            correct_sentences.append(sent_with_pred)
-    acc = correct / total
+    for i in np.flatnonzero(seq_errors > 0):
+        sent_with_pred = predictions[i]["predictions"]["text_with_preds"]
+        errors.add(f"{sent_with_pred}\t{original_sentences[i]}\t{answers[i]}")
+    correct_sentences = [
+        predictions[i]["predictions"]["text_with_preds"]
+        for i in np.flatnonzero(seq_errors == 0)
+    ]
     return acc, errors, correct_sentences
 
 
@@ -70,97 +86,67 @@ def prepare_data(data):
     return dicts, sentences, original_sents, answers
 
 
-def eval_char_gaps(model):
-    """Iterates through the char-gap files and uses them to evaluate the model."""
+def eval_char_gaps(eval_sets, predictions):
+    """Evaluates the predictions for the char-gap sets."""
     accuracies = []
     errors = []
     all_correct_sentences = []
     for i in range(1, 11):
-        eval_data_path = f"../../data/eval/eval_{i}_char_gaps.tsv"
-        data = load_data(eval_data_path)
-        dicts, sentences, original_sents, answers = prepare_data(data)
-        predictions = model.predict(dicts=dicts)
-        # predictions = model.predict_sequentially(dicts=dicts)
+        _, original_sents, answers = eval_sets[f"char_gaps_{i}"]
+        aligned, _ = align_predictions(predictions[f"char_gaps_{i}"], answers)
         acc_per_char, errs, correct_sentences = evaluate_predictions_per_char(
-            predictions, original_sents, answers
+            predictions[f"char_gaps_{i}"], original_sents, answers, aligned
         )
-        acc_per_seq = 1.0 - len(errs) / len(original_sents)
-        acc_string = [acc_per_char, acc_per_seq]
+        acc_per_seq = accuracy_per_seq(aligned)
+        acc_string = [acc_per_char, acc_per_seq, accuracy_per_char_ci(aligned)]
         accuracies.append(acc_string)
         errors.append(errs)
         all_correct_sentences.append(correct_sentences)
     return accuracies, errors, all_correct_sentences
 
 
-def evaluate_predictions_per_mask(predictions, original_sents, answers):
-    """Evaluates per mask, returning dicts of accuracies per mask length, correct and incorrect sentences per mask length."""
-    predicted_chars = []
-    sentences_with_preds = []
+def evaluate_predictions_per_mask(predictions, original_sents, answers, aligned=None):
+    """Evaluates per mask, returning dicts of accuracies per mask length, correct and incorrect sentences per mask length. The predictions can be passed already aligned (see metrics.align_predictions)."""
+    if aligned is None:
+        aligned, _ = align_predictions(predictions, answers)
+    acc_per_mask_length = accuracy_per_mask_length(aligned)
+    span_correct = errors_per_span(aligned) == 0
     all_errors = {}
     correct_masks = {}
-    acc_per_mask_length = {}
-    for pred in predictions:
-        predicted_chars.append(pred["predictions"]["predictions"])
-        sentences_with_preds.append(pred["predictions"]["text_with_preds"])
-    for preds, ans, sent_with_preds, orig_sent in zip(
-        predicted_chars, answers, sentences_with_preds, original_sents
+    # each sentence is listed once per mask length, however many of its masks have that length
+    for length, seq_id, correct in set(
+        zip(aligned["span_lens"], aligned["span_seq_ids"], span_correct)
     ):
-        chars_checked = 0
-        # iterate over every mask in the sentence with predictions
-        try:
-            for match in re.finditer(r"\[[^[]*\]", sent_with_preds):
-                mask_len = (
-                    match.end() - match.start() - 2
-                )  # length without the brackets
-                mask_correct = True
-                # initialize dict if needed
-                if mask_len not in acc_per_mask_length:
-                    acc_per_mask_length[mask_len] = {
-                        "total_chars": 0,
-                        "total_masks": 0,
-                        "char_errors": 0,
-                        "correct_masks": 0,
-                    }
-                acc_per_mask_length[mask_len]["total_masks"] += 1
-                # check every predicted char against the original chars
-                for i in range(chars_checked, mask_len + chars_checked):
-                    chars_checked += 1
-                    acc_per_mask_length[mask_len]["total_chars"] += 1
-                    if preds[i] != ans[i]:
-                        mask_correct = False
-                        # initialize if needed
-                        if mask_len not in all_errors:
-                            all_errors[mask_len] = set()
-                        all_errors[mask_len].add(f"{sent_with_preds}\t{orig_sent}")
-                        acc_per_mask_length[mask_len]["char_errors"] += 1
-                if mask_correct:
-                    acc_per_mask_length[mask_len]["correct_masks"] += 1
-                    # initialize if needed
-                    if mask_len not in correct_masks:
-                        correct_masks[mask_len] = set()
-                    correct_masks[mask_len].add(f"{sent_with_preds}")
-        except IndexError:
-            # skip malformed samples in the pythia datasest
-            continue
+        sent_with_preds = predictions[seq_id]["predictions"]["text_with_preds"]
+        if correct:
+            correct_masks.setdefault(int(length), set()).add(sent_with_preds)
+        else:
+            all_errors.setdefault(int(length), set()).add(
+                f"{sent_with_preds}\t{original_sents[seq_id]}"
+            )
     return acc_per_mask_length, all_errors, correct_masks
 
 
-def eval_sentences_with_brackets(model):
-    """Runs evaluation on the brackets dataset."""
-    eval_data_path = "../../data/eval/eval_masked_square_brackets.tsv"
-    data = load_data(eval_data_path)
-    dicts, sentences, original_sents, answers = prepare_data(data)
-    predictions = model.predict(dicts=dicts)
-    # predictions = model.predict_sequentially(dicts=dicts)
+def eval_masked_sequences(predictions, original_sents, answers):
+    """Evaluates the predictions for a set with masks of various lengths (the brackets and pythia sets) both per mask and per char. Also returns a bootstrap confidence interval for the per char accuracy."""
+    aligned, _ = align_predictions(predictions, answers)
     (
         acc_per_mask,
         errs_per_mask,
         correct_sentences_per_mask,
-    ) = evaluate_predictions_per_mask(predictions, original_sents, answers)
+    ) = evaluate_predictions_per_mask(predictions, original_sents, answers, aligned)
     acc_per_char, errs, _ = evaluate_predictions_per_char(
-        predictions, original_sents, answers
+        predictions, original_sents, answers, aligned
+    )
+    acc_ci = accuracy_per_char_ci(aligned)
+    return (
+        acc_per_char,
+        errs,
+        acc_per_mask,
+        errs_per_mask,
+        correct_sentences_per_mask,
+        acc_ci,
     )
-    return acc_per_char, errs, acc_per_mask, errs_per_mask, correct_sentences_per_mask
 
 
 def prepare_pythia_data(data):
@@ -178,22 +164,215 @@ def prepare_pythia_data(data):
     return dicts, masked_sequences, np.array(original_sentences), answers
 
 
-def eval_pythia_sequences(model):
-    """Evaluate on the pythia test dataset."""
-    eval_data_path = "/../../data/pythia/test.txt"
-    data = load_data(eval_data_path)
-    dicts, sentences, original_sents, answers = prepare_pythia_data(data)
-    predictions = model.predict(dicts=dicts)
-    # predictions = model.predict_sequentially(dicts=dicts)
-    (
-        acc_per_mask,
-        errs_per_mask,
-        correct_sentences_per_mask,
-    ) = evaluate_predictions_per_mask(predictions, original_sents, answers)
-    acc_per_char, errs, _ = evaluate_predictions_per_char(
-        predictions, original_sents, answers
+def load_eval_sets(eval_dir, pythia_path, sample_size=None):
+    """Loads and prepares the pythia, brackets and char-gap sets. Returns a dict which maps the name of each set to its dicts, original sentences and answers."""
+    eval_sets = {}
+    data = load_data(pythia_path, sample_size)
+    dicts, _, original_sents, answers = prepare_pythia_data(data)
+    eval_sets["pythia"] = (dicts, original_sents, answers)
+    data = load_data(f"{eval_dir}/eval_masked_square_brackets.tsv", sample_size)
+    dicts, _, original_sents, answers = prepare_data(data)
+    eval_sets["brackets"] = (dicts, original_sents, answers)
+    for i in range(1, 11):
+        data = load_data(f"{eval_dir}/eval_{i}_char_gaps.tsv", sample_size)
+        dicts, _, original_sents, answers = prepare_data(data)
+        eval_sets[f"char_gaps_{i}"] = (dicts, original_sents, answers)
+    return eval_sets
+
+
+def load_model(model_path, batch_size, decoding_options=None, **kwargs):
+    """Loads the model. decoding_options are set as attributes of the model (e.g. confidence_threshold)."""
+    model = MLMPredicter.load(model_path, batch_size=batch_size, **kwargs)
+    for name, value in (decoding_options or {}).items():
+        setattr(model, name, value)
+    return model
+
+
+def init_worker(
+    model_path,
+    batch_size,
+    nb_of_threads,
+    ngram_model_path,
+    ngram_threshold,
+    decoding_options,
+):
+    """Loads the model (and the n-gram model, if any) in a worker process."""
+    global worker_model, worker_ngram_model
+    torch.set_num_threads(nb_of_threads)
+    worker_model = load_model(model_path, batch_size, decoding_options, gpu=False)
+    worker_model.ngram_threshold = ngram_threshold
+    if ngram_model_path:
+        worker_ngram_model = CharNgramModel.load(ngram_model_path)
+
+
+def worker_ready(_):
+    """Returns the id of the worker process once it has loaded the model (see EvalPredictor.__init__)."""
+    time.sleep(0.1)
+    return os.getpid()
+
+
+def predict_shard(args):
+    """Runs prediction on a shard of dicts in a worker process, with the n-gram model in front of the model if cascade is True."""
+    dicts, decoding, cascade = args
+    worker_model.ngram_model = worker_ngram_model if cascade else None
+    return worker_model.decode(dicts, decoding)
+
+
+class EvalPredictor:
+    """
+    Runs prediction with one of the DECODINGS of MLMPredicter, either in this process or sharded across worker processes, each with its own copy of the model. The model (and the n-gram model, if any) is loaded once when the EvalPredictor is created, so that only prediction is timed when predict is called several times (e.g. with and without the n-gram cascade). Use it as a context manager or call close to stop the worker processes.
+    """
+
+    def __init__(
+        self,
+        model_path,
+        batch_size=32,
+        decoding="normal",
+        processes=1,
+        ngram_model_path=None,
+        ngram_threshold=0.9,
+        decoding_options=None,
+    ):
+        self.batch_size = batch_size
+        self.decoding = decoding
+        self.processes = processes
+        self.model = None
+        self.ngram_model = None
+        self.executor = None
+        if processes == 1:
+            self.model = load_model(model_path, batch_size, decoding_options)
+            self.model.ngram_threshold = ngram_threshold
+            if ngram_model_path:
+                self.ngram_model = CharNgramModel.load(ngram_model_path)
+            return
+        nb_of_threads = max(1, os.cpu_count() // processes)
+        # unlike a multiprocessing.Pool, the executor raises BrokenProcessPool if a worker dies (e.g. killed for running out of memory while loading the model) instead of waiting forever for its results
+        self.executor = ProcessPoolExecutor(
+            max_workers=processes,
+            initializer=init_worker,
+            initargs=(
+                model_path,
+                batch_size,
+                nb_of_threads,
+                ngram_model_path,
+                ngram_threshold,
+                decoding_options,
+            ),
+        )
+        # a worker only runs a task once it has loaded the model, so every worker has loaded it once each has answered
+        ready = set()
+        while len(ready) < processes:
+            ready.update(self.executor.map(worker_ready, range(processes)))
+
+    def predict(self, dicts, cascade=False):
+        """Runs prediction on dicts, returning the predictions in the order of the dicts. If cascade is True, the n-gram model answers the masked chars it is confident about first."""
+        if self.executor is None:
+            self.model.ngram_model = self.ngram_model if cascade else None
+            return self.model.decode(dicts, self.decoding)
+        # several shards per process, so that a process which finishes early isn't left idle
+        shard_size = self.batch_size * 4
+        shards = [dicts[i : i + shard_size] for i in range(0, len(dicts), shard_size)]
+        results = self.executor.map(
+            predict_shard, [(shard, self.decoding, cascade) for shard in shards]
+        )
+        return [pred for result in results for pred in result]
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def predict_dicts(
+    model_path,
+    dicts,
+    batch_size=32,
+    decoding="normal",
+    processes=1,
+    ngram_model_path=None,
+    ngram_threshold=0.9,
+    decoding_options=None,
+):
+    """Runs prediction on dicts with one of the DECODINGS of MLMPredicter (see EvalPredictor). The predictions are returned in the order of the dicts. If ngram_model_path is set, the n-gram model answers the masked chars it is confident about first."""
+    with EvalPredictor(
+        model_path,
+        batch_size,
+        decoding,
+        processes,
+        ngram_model_path,
+        ngram_threshold,
+        decoding_options,
+    ) as predictor:
+        return predictor.predict(dicts, cascade=ngram_model_path is not None)
+
+
+def predict_eval_sets(eval_sets, predict):
+    """Runs prediction on all the evaluation sets at once, so that batches aren't limited to a single set. Returns a dict which maps the name of each set to its predictions."""
+    all_dicts = [d for dicts, _, _ in eval_sets.values() for d in dicts]
+    all_predictions = predict(all_dicts)
+    predictions = {}
+    start = 0
+    for name, (dicts, _, _) in eval_sets.items():
+        predictions[name] = all_predictions[start : start + len(dicts)]
+        start += len(dicts)
+    return predictions
+
+
+def ngram_answered(predictions, aligned):
+    """Returns a boolean array aligned with the masked chars (see metrics.align_predictions) which is True for the chars answered by the n-gram model."""
+    skipped = set(aligned["skipped"])
+    return np.array(
+        [
+            stage == "ngram"
+            for i, pred in enumerate(predictions)
+            if i not in skipped
+            for stage in pred["predictions"].get("stages", [])
+        ],
+        dtype=bool,
     )
-    return acc_per_char, errs, acc_per_mask, errs_per_mask, correct_sentences_per_mask
+
+
+def compare_cascade(eval_sets, bert_predictions, cascade_predictions):
+    """Compares the predictions of the BERT model alone with those of the n-gram cascade. Returns a dict which maps the name of each set to the per char accuracy of both, the proportion of the masked chars answered by the n-gram model and its accuracy on them."""
+    comparison = {}
+    for name, (_, _, answers) in eval_sets.items():
+        bert_aligned, _ = align_predictions(bert_predictions[name], answers)
+        cascade_aligned, _ = align_predictions(cascade_predictions[name], answers)
+        answered = ngram_answered(cascade_predictions[name], cascade_aligned)
+        correct = ~char_errors(cascade_aligned)
+        comparison[name] = {
+            "bert_acc": accuracy_per_char(bert_aligned),
+            "cascade_acc": accuracy_per_char(cascade_aligned),
+            "ngram_share": answered.mean() if len(answered) else 0.0,
+            "ngram_acc": correct[answered].mean() if answered.any() else 0.0,
+        }
+    return comparison
+
+
+def generate_cascade_report(fp, comparison, bert_seconds, cascade_seconds, nb_of_chars):
+    """Writes the comparison of the BERT model alone and the n-gram cascade (see compare_cascade) and the throughput of both to fp."""
+    fp.write("==== N-gram cascade ====\n")
+    for name, c in comparison.items():
+        fp.write(
+            "%s: BERT accuracy %.2f%%, cascade accuracy %.2f%%, answered by the n-gram model %.2f%% (accuracy %.2f%%)\n"
+            % (
+                name,
+                c["bert_acc"] * 100,
+                c["cascade_acc"] * 100,
+                c["ngram_share"] * 100,
+                c["ngram_acc"] * 100,
+            )
+        )
+    for desc, seconds in [("BERT", bert_seconds), ("Cascade", cascade_seconds)]:
+        fp.write(
+            "%s: %.2f seconds (%.1f masked chars per second)\n"
+            % (desc, seconds, nb_of_chars / seconds)
+        )
 
 
 def generate_char_gap_report(fp, char_gap_accuracies):
@@ -204,11 +383,12 @@ def generate_char_gap_report(fp, char_gap_accuracies):
     for i, acc in enumerate(char_gap_accuracies):
         pc_acc = acc[0] * 100
         ps_acc = acc[1] * 100
+        ci_low, ci_high = acc[2]
         all_pc_accs.append(pc_acc)
         all_ps_accs.append(ps_acc)
         fp.write(
-            "%d char gaps: accuracy per character %.2f%%, accuracy per sequence %.2f%%\n"
-            % (i + 1, pc_acc, ps_acc)
+            "%d char gaps: accuracy per character %.2f%% (95%% CI %.2f-%.2f%%), accuracy per sequence %.2f%%\n"
+            % (i + 1, pc_acc, ci_low * 100, ci_high * 100, ps_acc)
         )
     fp.write(
         "Character gaps average per character accuracy: %.2f%%\n"
@@ -220,8 +400,8 @@ def generate_char_gap_report(fp, char_gap_accuracies):
     )
 
 
-def generate_per_mask_report(fp, title, desc, acc_per_mask_len, acc):
-    """Uses per mask data to generate a report which break down the accuracy per mask length."""
+def generate_per_mask_report(fp, title, desc, acc_per_mask_len, acc, acc_ci=None):
+    """Uses per mask data to generate a report which break down the accuracy per mask length. If acc_ci is given, the confidence interval of the per character accuracy is included."""
     fp.write(f"==== {title} ====\n")
     all_correct_masks = 0
     all_total_masks = 0
@@ -240,7 +420,13 @@ def generate_per_mask_report(fp, title, desc, acc_per_mask_len, acc):
             "Mask length %d: per character accuracy: %.2f%%, per mask accuracy %.2f%% (%d/%d)\n"
             % (length, pc_acc * 100, pm_acc * 100, correct_masks, total_masks)
         )
-    fp.write(f"{desc} average per character accuracy: %.2f%%\n" % (acc * 100))
+    if acc_ci:
+        fp.write(
+            f"{desc} average per character accuracy: %.2f%% (95%% CI %.2f-%.2f%%)\n"
+            % (acc * 100, acc_ci[0] * 100, acc_ci[1] * 100)
+        )
+    else:
+        fp.write(f"{desc} average per character accuracy: %.2f%%\n" % (acc * 100))
     fp.write(
         f"{desc} average per mask accuracy: %.2f%%\n"
         % ((all_correct_masks / all_total_masks) * 100)
@@ -276,31 +462,139 @@ def print_pred_specimens(fp, desc, specimens):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Evaluate a model on the pythia, brackets and char-gap datasets."
+    )
+    parser.add_argument(
+        "-m",
+        "--model_name",
+        default="greek_char_BERT",
+        help="The name of the model to evaluate (located in the save folder).",
+    )
+    parser.add_argument(
+        "-n",
+        "--sample_size",
+        type=int,
+        help="Evaluate on a random sample of this many sentences from each dataset, rather than the whole dataset.",
+    )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        default=1,
+        help="The number of worker processes to shard prediction across.",
+    )
+    parser.add_argument(
+        "-b", "--batch_size", type=int, default=32, help="The batch size to use."
+    )
+    parser.add_argument(
+        "-s",
+        "--sequential_decoding",
+        default=False,
+        action="store_true",
+        help="Use sequential decoding (warning: very slow).",
+    )
+    parser.add_argument(
+        "-d",
+        "--adaptive_decoding",
+        default=False,
+        action="store_true",
+        help="Only decode the gaps in which the model isn't confident sequentially.",
+    )
+    parser.add_argument(
+        "--confidence_threshold",
+        type=float,
+        default=0.9,
+        help="The minimum probability of every character in a gap for its predictions to be accepted by the adaptive decoder.",
+    )
+    parser.add_argument(
+        "--max_iterations",
+        type=int,
+        default=8,
+        help="The maximum number of extra passes of the adaptive decoder.",
+    )
+    parser.add_argument(
+        "--ngram_model",
+        help="Also evaluate the cascade of this character n-gram model and the BERT model, comparing its accuracy and throughput with the BERT model alone.",
+    )
+    parser.add_argument(
+        "--ngram_threshold",
+        type=float,
+        default=0.9,
+        help="The minimum probability of an n-gram prediction for it to be used.",
+    )
+    args = parser.parse_args()
+
     rn.seed(42)
-    model_name = "greek_char_BERT"
+    if args.sequential_decoding:
+        decoding = "sequential"
+    elif args.adaptive_decoding:
+        decoding = "adaptive"
+    else:
+        decoding = "normal"
+    decoding_options = {
+        "confidence_threshold": args.confidence_threshold,
+        "max_iterations": args.max_iterations,
+    }
+    model_name = args.model_name
     save_dir = f"save/{model_name}"
-    accuracy_report_dir = f"../../data/eval/bert_acc_report_{model_name}.txt"
-    errors_path = f"../../data/eval/bert_errors_{model_name}.txt"
-    correct_sentences_path = (
-        f"../../data/eval/bert_correct_sentences_{model_name}.txt"
-    )
-    model = MLMPredicter.load(save_dir, batch_size=32)
+    eval_dir = "../../data/eval"
+    pythia_path = "../../data/pythia/test.txt"
+    accuracy_report_dir = f"{eval_dir}/bert_acc_report_{model_name}.txt"
+    errors_path = f"{eval_dir}/bert_errors_{model_name}.txt"
+    correct_sentences_path = f"{eval_dir}/bert_correct_sentences_{model_name}.txt"
+    cascade_report_path = f"{eval_dir}/ngram_cascade_report_{model_name}.txt"
+
+    eval_sets = load_eval_sets(eval_dir, pythia_path, args.sample_size)
+    with EvalPredictor(
+        save_dir,
+        batch_size=args.batch_size,
+        decoding=decoding,
+        processes=args.processes,
+        ngram_model_path=args.ngram_model,
+        ngram_threshold=args.ngram_threshold,
+        decoding_options=decoding_options,
+    ) as predictor:
+        # the model is loaded once, so only prediction is timed
+        start = time.perf_counter()
+        predictions = predict_eval_sets(eval_sets, predictor.predict)
+        bert_seconds = time.perf_counter() - start
+        if args.ngram_model:
+            start = time.perf_counter()
+            cascade_predictions = predict_eval_sets(
+                eval_sets, lambda dicts: predictor.predict(dicts, cascade=True)
+            )
+            cascade_seconds = time.perf_counter() - start
+    if args.ngram_model:
+        nb_of_chars = sum(
+            len(answer) for _, _, answers in eval_sets.values() for answer in answers
+        )
+        with open(cascade_report_path, "w") as fp:
+            generate_cascade_report(
+                fp,
+                compare_cascade(eval_sets, predictions, cascade_predictions),
+                bert_seconds,
+                cascade_seconds,
+                nb_of_chars,
+            )
     (
         pythia_acc,
         _,
         pythia_acc_per_mask_len,
         pythia_errors,
         pythia_correct_sentences,
-    ) = eval_pythia_sequences(model)
+        pythia_acc_ci,
+    ) = eval_masked_sequences(predictions["pythia"], *eval_sets["pythia"][1:])
     (
         brackets_acc,
         _,
         brackets_acc_per_mask_len,
         brackets_errors,
         brackets_correct_sentences,
-    ) = eval_sentences_with_brackets(model)
+        brackets_acc_ci,
+    ) = eval_masked_sequences(predictions["brackets"], *eval_sets["brackets"][1:])
     char_gap_accuracies, char_gap_errors, char_gap_correct_sentences = eval_char_gaps(
-        model
+        eval_sets, predictions
     )
     with open(accuracy_report_dir, "w") as fp:
         generate_char_gap_report(fp, char_gap_accuracies)
@@ -310,9 +604,15 @@ if __name__ == "__main__":
             "Bracketed sentences",
             brackets_acc_per_mask_len,
             brackets_acc,
+            brackets_acc_ci,
         )
         generate_per_mask_report(
-            fp, "Pythia", "Pythia sentences", pythia_acc_per_mask_len, pythia_acc
+            fp,
+            "Pythia",
+            "Pythia sentences",
+            pythia_acc_per_mask_len,
+            pythia_acc,
+            pythia_acc_ci,
         )
     with open(errors_path, "w") as fp:
         print_char_gap_specimens(fp, "character gap errors", char_gap_errors)
@@ -2,25 +2,234 @@
 
 from greek_char_bert.predict import (
     MLMPredicter,
+    PROFILE_MODES,
+    format_metrics,
     replace_square_brackets,
     sentences_to_dicts,
 )
+from greek_char_bert.prediction_cache import PredictionCache
 from greek_char_bert.run_eval import convert_masking
+from greek_char_bert.data_handler.dataset_cache import NB_OF_EXTRA_TOKENS
 from greek_data_prep.clean_data import clean_texts, CHARS_TO_REMOVE, CHARS_TO_REPLACE
+from greek_data_prep.char_ngram import CharNgramModel
 from cltk.corpus.utils.formatter import cltk_normalize
+from contextlib import redirect_stdout
+from itertools import islice
+import json
+import time
 import re
+import os
+import sys
 import argparse
 
 
-def predict_from_file(path, model, use_sequential_decoding, align, step_len):
-    """Runs prediction using the model on the texts located in the file given in path."""
+def find_lacunae(text):
+    """Returns the start and end of each run of masked characters (#) in text."""
+    return [(m.start(), m.end()) for m in re.finditer(r"#+", text)]
+
+
+def crop_window(start, end, text_len, max_len, left_context, right_context):
+    """Returns the start and end of the window around the chars from start to end with up to left_context and right_context chars on either side. If the window would be longer than max_len, the remaining room is shared between both sides."""
+    left = min(left_context, start)
+    right = min(right_context, text_len - end)
+    excess = (end - start) + left + right - max_len
+    if excess > 0:
+        room = left + right - excess
+        left = min(left, max(room // 2, room - right))
+        right = room - left
+    return start - left, end + right
+
+
+def lacuna_windows(text, max_len, left_context, right_context):
+    """Returns windows of at most max_len chars centred on the lacunae in text as (start, end, lacunae_start, lacunae_end), where the lacunae from lacunae_start to lacunae_end are the ones the window is for (the context can contain other lacunae). Lacunae whose contexts overlap share a window (if they fit in one) and stretches of text without lacunae are skipped."""
+    windows = []
+    group = None
+    for lacuna_start, lacuna_end in find_lacunae(text):
+        # lacunae longer than a window are split up
+        for start in range(lacuna_start, lacuna_end, max_len):
+            end = min(start + max_len, lacuna_end)
+            if (
+                group
+                and start - group[1] <= left_context + right_context
+                and end - group[0] <= max_len
+            ):
+                group = (group[0], end)
+                continue
+            if group:
+                windows.append(
+                    crop_window(*group, len(text), max_len, left_context, right_context)
+                    + group
+                )
+            group = (start, end)
+    if group:
+        windows.append(
+            crop_window(*group, len(text), max_len, left_context, right_context) + group
+        )
+    return windows
+
+
+def predict_lacunae(texts, model, decoding, left_context, right_context):
+    """Runs prediction only on the windows around the lacunae in texts (see lacuna_windows), so that the amount of work depends on the number of lacunae rather than on the length of the texts. Returns a dict for each text which maps the position of each masked char to its prediction."""
+    max_len = model.processor.max_seq_len - NB_OF_EXTRA_TOKENS
+    windows = [
+        (i, window)
+        for i, text in enumerate(texts)
+        for window in lacuna_windows(text, max_len, left_context, right_context)
+    ]
+    results = []
+    if windows:
+        sequences = convert_masking(
+            [texts[i][start:end] for i, (start, end, _, _) in windows]
+        )
+        dicts = sentences_to_dicts(sequences)
+        results = model.decode(dicts, decoding)
+    predictions = [{} for _ in texts]
+    for (i, (start, end, lacunae_start, lacunae_end)), result in zip(windows, results):
+        masked_positions = [
+            start + j for j, c in enumerate(texts[i][start:end]) if c == "#"
+        ]
+        for position, pred in zip(
+            masked_positions, result["predictions"]["predictions"]
+        ):
+            # the lacunae in the context are filled in by their own windows
+            if lacunae_start <= position < lacunae_end:
+                predictions[i][position] = pred
+    return predictions
+
+
+def fill_lacunae(text, predictions):
+    """Inserts the predictions (as returned by predict_lacunae) into text, enclosing them in square brackets."""
+    chars = list(text)
+    for position, pred in predictions.items():
+        chars[position] = f"[{pred}]"
+    return "".join(chars).replace("][", "")
+
+
+def predict_cropped(texts, model, decoding, left_context, right_context):
+    """Runs prediction on the neighbourhood of the lacunae in texts (see predict_lacunae) and returns the texts with the predictions inserted in square brackets."""
+    predictions = predict_lacunae(texts, model, decoding, left_context, right_context)
+    return [fill_lacunae(text, preds) for text, preds in zip(texts, predictions)]
+
+
+def prepare_texts(texts):
+    """Cleans and normalizes texts and converts them to the format the model expects (missing chars as # and spaces as _)."""
+    # the progress of clean_texts would otherwise be mixed up with the predictions on stdout
+    with redirect_stdout(sys.stderr):
+        texts = clean_texts(texts, CHARS_TO_REMOVE, CHARS_TO_REPLACE)
+    texts = [cltk_normalize(replace_square_brackets(t)) for t in texts]
+    return [t.replace(" ", "_") for t in texts]
+
+
+def read_texts(path, start=0):
+    """Lazily yields the line number and the text of each line in path, starting at line start."""
+    with open(path, "r") as fp:
+        for i, line in enumerate(fp):
+            if i >= start:
+                yield i, line.rstrip("\n")
+
+
+def count_records(path):
+    """Returns the number of complete records in a JSONL file, removing a partially written last record (e.g. after a crash)."""
+    if not os.path.exists(path):
+        return 0
+    nb_of_records = 0
+    end_of_last_record = 0
+    with open(path, "rb+") as fp:
+        for line in fp:
+            if line.endswith(b"\n"):
+                nb_of_records += 1
+                end_of_last_record += len(line)
+        fp.truncate(end_of_last_record)
+    return nb_of_records
+
+
+def predict_to_jsonl(
+    path,
+    output_path,
+    model,
+    decoding,
+    left_context,
+    right_context,
+    batch_size=64,
+    resume=False,
+):
+    """
+    Runs prediction on the texts in path in batches of batch_size texts, writing one JSON record per text to output_path as soon as its batch is done, so that memory use doesn't grow with the size of the file. Only the neighbourhood of each lacuna is predicted (see predict_lacunae).
+
+    Each record contains the line number, the original text, the masked text (after cleaning and normalization, missing chars as #), the text with the predictions, the start (in the masked text), length and prediction of each gap and the time taken per text (the time of the batch divided by its size).
+
+    :param resume: continue after the last complete record in output_path rather than overwriting it.
+    :type resume: bool
+    """
+    start = count_records(output_path) if resume else 0
+    if start:
+        print(f"Resuming after {start} texts", file=sys.stderr)
+    texts = read_texts(path, start)
+    with open(output_path, "a" if resume else "w", encoding="utf-8") as out:
+        while True:
+            batch = list(islice(texts, batch_size))
+            if not batch:
+                break
+            batch_start = time.perf_counter()
+            line_numbers, originals = zip(*batch)
+            masked_texts = prepare_texts(originals)
+            predictions = predict_lacunae(
+                masked_texts,
+                model,
+                decoding,
+                left_context,
+                right_context,
+            )
+            seconds = (time.perf_counter() - batch_start) / len(batch)
+            for line_number, original, masked_text, preds in zip(
+                line_numbers, originals, masked_texts, predictions
+            ):
+                gaps = [
+                    {
+                        "start": gap_start,
+                        "length": gap_end - gap_start,
+                        "prediction": "".join(
+                            preds.get(i, "#") for i in range(gap_start, gap_end)
+                        ).replace("_", " "),
+                    }
+                    for gap_start, gap_end in find_lacunae(masked_text)
+                ]
+                record = {
+                    "line": line_number,
+                    "original_text": original,
+                    "masked_text": masked_text.replace("_", " "),
+                    "text_with_preds": fill_lacunae(masked_text, preds).replace(
+                        "_", " "
+                    ),
+                    "gaps": gaps,
+                    "seconds": seconds,
+                }
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            # the records of each batch are on disk before the next one starts
+            out.flush()
+
+
+def predict_from_file(
+    path,
+    model,
+    decoding,
+    align,
+    step_len,
+    crop=False,
+    left_context=None,
+    right_context=None,
+):
+    """Runs prediction using the model on the texts located in the file given in path. If crop is set, only the neighbourhood of each lacuna is used (see predict_cropped)."""
     max_seq_len = model.processor.max_seq_len - 2
     with open(path, "r") as fp:
         texts = fp.read().splitlines()
-    # prepare texts
-    texts = clean_texts(texts, CHARS_TO_REMOVE, CHARS_TO_REPLACE)
-    texts = [cltk_normalize(replace_square_brackets(t)) for t in texts]
-    texts = [t.replace(" ", "_") for t in texts]
+    texts = prepare_texts(texts)
+    if crop:
+        for text in predict_cropped(
+            texts, model, decoding, left_context, right_context
+        ):
+            print(text.replace("_", " "))
+        return
     results = []
     # break up long texts
     for t in texts:
@@ -36,10 +245,7 @@ def predict_from_file(path, model, use_sequential_decoding, align, step_len):
             sequences.append(t)
         sequences = convert_masking(sequences)
         dicts = sentences_to_dicts(sequences)
-        if use_sequential_decoding:
-            result = model.predict_sequentially(dicts=dicts)
-        else:
-            result = model.predict(dicts=dicts)
+        result = model.decode(dicts, decoding)
         results.append(result)
     # output results
     for result in results:
@@ -83,6 +289,25 @@ if __name__ == "__main__":
         action="store_true",
         help="Use sequential decoding (warning: very slow, especially without a GPU).",
     )
+    parser.add_argument(
+        "-d",
+        "--adaptive_decoding",
+        default=False,
+        action="store_true",
+        help="Only decode the gaps in which the model isn't confident sequentially (see --confidence_threshold and --max_iterations).",
+    )
+    parser.add_argument(
+        "--confidence_threshold",
+        type=float,
+        default=0.9,
+        help="The minimum probability of every character in a gap for its predictions to be accepted by the adaptive decoder.",
+    )
+    parser.add_argument(
+        "--max_iterations",
+        type=int,
+        default=8,
+        help="The maximum number of extra passes of the adaptive decoder.",
+    )
     parser.add_argument(
         "-a",
         "--align",
@@ -95,13 +320,121 @@ if __name__ == "__main__":
         type=int,
         help="The step length to use when handling texts longer than the model's maximum input length.",
     )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="time",
+        choices=PROFILE_MODES,
+        help="Print the time spent in each stage of prediction to stderr. Optionally also capture a cProfile (cprofile) or torch profile (torch) of the prediction, which is written to the current directory.",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        help="Cache the predictions in this directory, so that texts (or parts of texts) which have already been predicted with the same model and decoder aren't predicted again.",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=int,
+        default=100000,
+        help="The maximum number of predictions kept in the cache directory.",
+    )
+    parser.add_argument(
+        "-c",
+        "--crop",
+        default=False,
+        action="store_true",
+        help="Only predict windows centred on the missing characters (nearby ones share a window) instead of sliding a window over the whole text. The output is the whole text with the predictions.",
+    )
+    parser.add_argument(
+        "--left_context",
+        type=int,
+        default=64,
+        help="The number of characters to the left of the missing characters to use when cropping.",
+    )
+    parser.add_argument(
+        "--right_context",
+        type=int,
+        default=64,
+        help="The number of characters to the right of the missing characters to use when cropping.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Stream the predictions to this file as JSON lines (one record per text, written batch by batch) instead of printing them. Only the neighbourhood of each lacuna is predicted, as with -c.",
+    )
+    parser.add_argument(
+        "--batch_texts",
+        type=int,
+        default=64,
+        help="The number of texts to process at once when streaming to a file.",
+    )
+    parser.add_argument(
+        "--resume",
+        default=False,
+        action="store_true",
+        help="Continue after the last complete record in the output file instead of overwriting it.",
+    )
+    parser.add_argument(
+        "--ngram_model",
+        help="A character n-gram model (trained with greek_data_prep/char_ngram.py) which answers the missing characters it is confident about, so that only the rest are predicted by the BERT model.",
+    )
+    parser.add_argument(
+        "--ngram_threshold",
+        type=float,
+        default=0.9,
+        help="The minimum probability of an n-gram prediction for it to be used.",
+    )
     args = parser.parse_args()
 
     file = args.file
     model_path = args.model_path
-    use_sequential_decoding = args.sequential_decoding
+    if args.sequential_decoding:
+        decoding = "sequential"
+    elif args.adaptive_decoding:
+        decoding = "adaptive"
+    else:
+        decoding = "normal"
     align = args.align
     step_len = args.step_len
     model = MLMPredicter.load(model_path, batch_size=32)
+    model.confidence_threshold = args.confidence_threshold
+    model.max_iterations = args.max_iterations
+    if args.profile:
+        model.profile = args.profile
+    if args.ngram_model:
+        model.ngram_model = CharNgramModel.load(args.ngram_model)
+        model.ngram_threshold = args.ngram_threshold
+    if args.cache_dir:
+        model.cache = PredictionCache(
+            cache_dir=args.cache_dir, max_disk_entries=args.cache_size
+        )
+
+    if args.output:
+        predict_to_jsonl(
+            file,
+            args.output,
+            model,
+            decoding,
+            args.left_context,
+            args.right_context,
+            args.batch_texts,
+            args.resume,
+        )
+    else:
+        predict_from_file(
+            file,
+            model,
+            decoding,
+            align,
+            step_len,
+            args.crop,
+            args.left_context,
+            args.right_context,
+        )
 
-    predict_from_file(file, model, use_sequential_decoding, align, step_len)
+    if model.profile:
+        print(format_metrics(model.metrics, model.wall_seconds), file=sys.stderr)
+    if model.cache:
+        print(
+            "Cache hits: {hits}, misses: {misses}".format(**model.cache.stats()),
+            file=sys.stderr,
+        )
@@ -1,21 +1,30 @@
-"""Trains a CharMLM from scratch or finetunes an existing model. Can also be used to resume training on the same datasest."""
+"""Trains a CharMLM from scratch or finetunes an existing model. Can also be used to resume training on the same datasest, either from the final model (-f) or from a checkpoint (-r)."""
 from greek_char_bert.data_handler.tokenization import CharMLMTokenizer
 from greek_char_bert.data_handler.processor import CharMLMProcessor
-from farm.data_handler.data_silo import DataSilo
+from greek_char_bert.data_handler.data_silo import CharMLMDataSilo
 from farm.modeling.language_model import BertModel
 from farm.eval import Evaluator
 from greek_char_bert.modelling.language_model import PretrainingBERT
 from greek_char_bert.modelling.prediction_head import CharMLMHead
 from greek_char_bert.modelling.adaptive_model import CharMLMAdaptiveModel
 from farm.experiment import initialize_optimizer
-from farm.train import Trainer
+from greek_char_bert.trainer import (
+    CharMLMTrainer,
+    PRECISIONS,
+    grad_acc_steps_for,
+    find_checkpoint,
+    init_distributed,
+)
 from pytorch_transformers.modeling_bert import BertConfig
 from farm.utils import set_all_seeds, initialize_device_settings
 from datetime import datetime
 import logging
 from shutil import copyfile
 import pathlib
+import os
 import argparse
+import torch
+import json
 
 
 def setup_evaluator(dataset_name, data_silo, device):
@@ -29,6 +38,72 @@ def setup_evaluator(dataset_name, data_silo, device):
     return evaluator
 
 
+def count_parameters(model):
+    """Returns the number of trainable parameters of the model (shared weights are only counted once)."""
+    return sum(p.numel() for p in model.parameters() if p.requires_grad)
+
+
+def estimate_flops_per_token(config, max_seq_len):
+    """Estimates the number of floating point operations of the forward pass per token: the matrix multiplications of the encoder layers (projections, attention over max_seq_len tokens and feed forward) and of the MLM head (which only runs at the masked positions, so this is an upper bound). Training costs roughly three times as much (forward plus backward)."""
+    hidden_size = config.hidden_size
+    per_layer = (
+        # query, key, value and output projections
+        2 * 4 * hidden_size * hidden_size
+        # attention scores and weighted sum of the values
+        + 2 * 2 * max_seq_len * hidden_size
+        # feed forward
+        + 2 * 2 * hidden_size * config.intermediate_size
+    )
+    head = 2 * hidden_size * (hidden_size + config.vocab_size)
+    return config.num_hidden_layers * per_layer + head
+
+
+def add_architecture_arguments(parser, description):
+    """Adds the options for the architecture of a new model (see init_model) to parser."""
+    architecture = parser.add_argument_group("architecture", description)
+    architecture.add_argument("--hidden_size", type=int, default=768)
+    architecture.add_argument("--num_hidden_layers", type=int, default=12)
+    architecture.add_argument("--num_attention_heads", type=int, default=12)
+    architecture.add_argument(
+        "--intermediate_size",
+        type=int,
+        help="The size of the feed forward layers (4 * hidden_size by default).",
+    )
+    architecture.add_argument("--embeds_dropout_prob", type=float, default=0.1)
+
+
+def init_model(args, tokenizer, max_seq_len, device):
+    """Initializes a new CharMLM with the architecture given by the options added by add_architecture_arguments."""
+    config = BertConfig(
+        vocab_size_or_config_json_file=tokenizer.vocab_size,
+        hidden_size=args.hidden_size,
+        num_hidden_layers=args.num_hidden_layers,
+        num_attention_heads=args.num_attention_heads,
+        intermediate_size=args.intermediate_size or 4 * args.hidden_size,
+        max_position_embeddings=max(512, max_seq_len),
+    )
+    language_model = PretrainingBERT(BertModel(config=config))
+    language_model.language = "ancient-greek"
+    prediction_head = CharMLMHead(
+        hidden_size=args.hidden_size,
+        vocab_size=tokenizer.vocab_size,
+        mask_token_id=tokenizer.vocab["[MASK]"],
+    )
+    return CharMLMAdaptiveModel(
+        language_model=language_model,
+        prediction_heads=[prediction_head],
+        embeds_dropout_prob=args.embeds_dropout_prob,
+        lm_output_types=["per_token"],
+        device=device,
+    )
+
+
+def load_config(path):
+    """Loads the options saved in a JSON file (e.g. the train_config.json of an earlier run)."""
+    with open(path, "r") as fp:
+        return json.load(fp)
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(
@@ -39,16 +114,102 @@ if __name__ == "__main__":
         "--finetune",
         default=False,
         action="store_true",
-        help="Load an existing model (specified in the load_dir variable within the script).",
+        help="Load an existing model (specified with --load_dir).",
+    )
+    parser.add_argument(
+        "-p",
+        "--pack",
+        default=False,
+        action="store_true",
+        help="Pack consecutive sentences into full length sequences instead of padding each sentence.",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch_size",
+        type=int,
+        default=32,
+        help="The number of sequences per forward pass (per process when training in parallel).",
     )
+    parser.add_argument(
+        "-e",
+        "--effective_batch_size",
+        type=int,
+        help="The number of sequences per optimizer step (summed over all processes when training in parallel). Gradients are accumulated over as many batches as are needed to reach it (by default no gradients are accumulated).",
+    )
+    parser.add_argument(
+        "--precision",
+        default="fp32",
+        choices=PRECISIONS,
+        help="Train in fp32 or with bf16 autocast (fast on CPUs with native bf16 support).",
+    )
+    parser.add_argument(
+        "--checkpoint_every",
+        type=int,
+        help="Save a checkpoint every N steps, from which training can be resumed with --resume.",
+    )
+    parser.add_argument(
+        "--max_checkpoints",
+        type=int,
+        default=3,
+        help="The number of checkpoints to keep (older ones are deleted).",
+    )
+    parser.add_argument(
+        "-r",
+        "--resume",
+        help="Resume training from a checkpoint, or from the newest checkpoint in the save dir of an interrupted run. The other options should be the same as in the interrupted run.",
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        help="A JSON file with options (using the long names, e.g. hidden_size), e.g. the train_config.json saved with every model. Options passed on the command line take precedence.",
+    )
+    parser.add_argument("--model_name", default="test_ancient_greek_char_MLM")
+    parser.add_argument("--data_dir", default="../../data")
+    parser.add_argument("--vocab_file", default="../../data/greek_char_vocab.txt")
+    parser.add_argument(
+        "--load_dir",
+        default="../../models/greek_char_BERT",
+        help="The model to finetune.",
+    )
+    parser.add_argument(
+        "--save_root",
+        default="save",
+        help="The directory in which the directory of each run is created.",
+    )
+    parser.add_argument("-l", "--max_seq_len", type=int, default=192)
+    parser.add_argument("--n_epochs", type=int, default=1)
+    parser.add_argument("--learning_rate", type=float, default=1e-4)
+    parser.add_argument("--warmup_proportion", type=float, default=0.1)
+    parser.add_argument(
+        "--evaluate_every",
+        type=int,
+        default=6000,
+        help="Evaluate on the dev set every N steps.",
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    add_architecture_arguments(parser, "Only used when training a new model.")
+    args, _ = parser.parse_known_args()
+    if args.config:
+        parser.set_defaults(**load_config(args.config))
     args = parser.parse_args()
 
     finetune = args.finetune
 
-    model_name = "test_ancient_greek_char_MLM"
-    load_dir = "../../models/greek_char_BERT"
+    model_name = args.model_name
+    load_dir = args.load_dir
 
-    device, n_gpu = initialize_device_settings(use_cuda=True)
+    if args.resume:
+        # the checkpoints contain the model and processor, which are loaded like when finetuning
+        checkpoint_dir = find_checkpoint(args.resume)
+        load_dir = checkpoint_dir
+        finetune = True
+
+    # when launched with torchrun, e.g. torchrun --nproc_per_node=4 train.py, the processes train in parallel on the CPU
+    rank, world_size = init_distributed()
+    if world_size > 1:
+        device, n_gpu = torch.device("cpu"), 0
+    else:
+        device, n_gpu = initialize_device_settings(use_cuda=True)
     print("Devices available: {}".format(device))
 
     # logging setup:
@@ -60,79 +221,103 @@ if __name__ == "__main__":
     )
 
     # set seeds
-    set_all_seeds(seed=42)
+    set_all_seeds(seed=args.seed)
 
     # save a copy of source code files before training
 
-    save_dir = f"save/{model_name}_{datetime.now().strftime('%Y-%m-%d_%H:%M:%S')}"
-    pathlib.Path(save_dir).mkdir(parents=True, exist_ok=True)
-    for file in ["train"]:
-        copyfile(f"{file}.py", f"{save_dir}/{file}.py")
+    if args.resume:
+        # continue saving in the directory of the interrupted run
+        save_dir = os.path.dirname(os.path.abspath(checkpoint_dir))
+    else:
+        save_dir = os.path.join(
+            args.save_root,
+            f"{model_name}_{datetime.now().strftime('%Y-%m-%d_%H:%M:%S')}",
+        )
+    if rank == 0:
+        pathlib.Path(save_dir).mkdir(parents=True, exist_ok=True)
+        for file in ["train"]:
+            copyfile(f"{file}.py", f"{save_dir}/{file}.py")
+        # the options can be reused with -c
+        with open(f"{save_dir}/train_config.json", "w") as fp:
+            json.dump(
+                {k: v for k, v in vars(args).items() if k not in ["config", "resume"]},
+                fp,
+                indent=2,
+            )
 
     # tokenizer setup
 
-    tokenizer = CharMLMTokenizer(
-        vocab_file="../../data/greek_char_vocab.txt", do_lower_case=False
-    )
+    tokenizer = CharMLMTokenizer(vocab_file=args.vocab_file, do_lower_case=False)
 
     # data handling setup
 
-    data_dir = "../../data"
+    data_dir = args.data_dir
 
     if finetune:
         # load existing processor
         processor = CharMLMProcessor.load_from_dir(load_dir)
+        processor.pack_sequences = args.pack
     else:
         # init new processor
         processor = CharMLMProcessor(
-            tokenizer=tokenizer, max_seq_len=192, data_dir=data_dir
+            tokenizer=tokenizer,
+            max_seq_len=args.max_seq_len,
+            data_dir=data_dir,
+            pack_sequences=args.pack,
         )
 
-    batch_size = 32
-
-    data_silo = DataSilo(processor=processor, batch_size=batch_size)
-
-    # model setup
+    batch_size = args.batch_size
+    grad_acc_steps = grad_acc_steps_for(
+        args.effective_batch_size or batch_size * world_size, batch_size * world_size
+    )
 
-    config = BertConfig(
-        vocab_size_or_config_json_file=tokenizer.vocab_size,
-        hidden_size=768,
-        num_hidden_layers=12,
-        num_attention_heads=12,
-        intermediate_size=3072,
+    # the data is loaded from the binary cache if it has been built with build_cache.py
+    # each process trains on a different part of the train set
+    data_silo = CharMLMDataSilo(
+        processor=processor, batch_size=batch_size, distributed=world_size > 1
     )
 
-    prediction_head = CharMLMHead(hidden_size=768, vocab_size=tokenizer.vocab_size)
+    # model setup
 
     if finetune:
         # load an existing model
         model = CharMLMAdaptiveModel.load(load_dir, device)
     else:
         # initialize a new model
-        internal_model = BertModel(config=config)
-        language_model = PretrainingBERT(internal_model)
-        language_model.language = "ancient-greek"
-
-        embeds_dropout_prob = 0.1
-
-        model = CharMLMAdaptiveModel(
-            language_model=language_model,
-            prediction_heads=[prediction_head],
-            embeds_dropout_prob=embeds_dropout_prob,
-            lm_output_types=["per_token"],
-            device=device,
+        model = init_model(args, tokenizer, args.max_seq_len, device)
+
+    # the config of a loaded model might differ from the options
+    config = model.language_model.model.config
+    print(
+        "Parameters: {:,}, layers: {}, hidden size: {}, max_seq_len: {}".format(
+            count_parameters(model),
+            config.num_hidden_layers,
+            config.hidden_size,
+            processor.max_seq_len,
+        )
+    )
+    print(
+        "Estimated forward FLOPs per token: {:,} (training: ~{:,})".format(
+            estimate_flops_per_token(config, processor.max_seq_len),
+            3 * estimate_flops_per_token(config, processor.max_seq_len),
         )
+    )
 
     # evaluators setup
 
-    evaluator_dev = setup_evaluator("dev", data_silo, device)
-    evaluator_test = setup_evaluator("test", data_silo, device)
+    # only the first process evaluates the model
+    if rank == 0:
+        evaluator_dev = setup_evaluator("dev", data_silo, device)
+        evaluator_test = setup_evaluator("test", data_silo, device)
+    else:
+        evaluator_dev = None
+        evaluator_test = None
 
     # training
 
-    learning_rate = 1e-4
-    warmup_proportion = 0.1
-    n_epochs = 1
+    learning_rate = args.learning_rate
+    warmup_proportion = args.warmup_proportion
+    n_epochs = args.n_epochs
 
     optimizer, warmup_linear = initialize_optimizer(
         model=model,
@@ -140,24 +325,34 @@ if __name__ == "__main__":
         warmup_proportion=warmup_proportion,
         n_batches=len(data_silo.loaders["train"]),
         n_epochs=n_epochs,
+        grad_acc_steps=grad_acc_steps,
     )
 
-    trainer = Trainer(
+    trainer = CharMLMTrainer(
         optimizer=optimizer,
         data_silo=data_silo,
         epochs=n_epochs,
         n_gpu=n_gpu,
         warmup_linear=warmup_linear,
         device=device,
-        evaluate_every=6000,
+        evaluate_every=args.evaluate_every,
         evaluator_dev=evaluator_dev,
         evaluator_test=evaluator_test,
-        grad_acc_steps=1,
+        grad_acc_steps=grad_acc_steps,
+        precision=args.precision,
+        checkpoint_every=args.checkpoint_every,
+        save_dir=save_dir,
+        max_checkpoints=args.max_checkpoints,
+        seed=args.seed,
     )
 
+    if args.resume:
+        trainer.load_checkpoint(checkpoint_dir)
+
     model = trainer.train(model)
 
     # Save model
 
-    model.save(save_dir)
-    processor.save(save_dir)
+    if rank == 0:
+        model.save(save_dir)
+        processor.save(save_dir)
@@ -0,0 +1,309 @@
+"""A Trainer for CharMLMs which adds a bf16 mixed-precision mode, distributed data-parallel training on CPUs, resumable checkpoints and logs the training throughput."""
+from farm.train import Trainer, WrappedDataParallel
+from farm.data_handler.dataloader import NamedDataLoader
+from torch.utils.data.sampler import RandomSampler
+from torch.nn.parallel import DistributedDataParallel
+from contextlib import nullcontext
+from farm.utils import MLFlowLogger as MlLogger
+from farm.visual.ascii.images import GROWING_TREE
+from datetime import timedelta
+from tqdm import tqdm
+import numpy as np
+import logging
+import random
+import shutil
+import math
+import torch
+import time
+import glob
+import os
+
+logger = logging.getLogger(__name__)
+
+PRECISIONS = ["fp32", "bf16"]
+CHECKPOINT_PREFIX = "checkpoint_"
+TRAINER_STATE_FILE = "trainer_state.pt"
+# how long the other processes wait for rank 0 to evaluate the model or save a checkpoint
+BARRIER_TIMEOUT = timedelta(hours=6)
+
+
+def grad_acc_steps_for(effective_batch_size, batch_size):
+    """Returns the number of gradient accumulation steps needed to reach effective_batch_size with batches of batch_size."""
+    grad_acc_steps = max(1, math.ceil(effective_batch_size / batch_size))
+    if grad_acc_steps * batch_size != effective_batch_size:
+        logger.warning(
+            f"The effective batch size {effective_batch_size} isn't a multiple of the batch size {batch_size}, using {grad_acc_steps * batch_size} instead."
+        )
+    return grad_acc_steps
+
+
+def init_distributed():
+    """Initializes the process group (with the gloo backend, which runs on CPUs) if the script was launched with torchrun. The cores of each node are shared between its processes. Returns the rank of the process and the number of processes."""
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size == 1:
+        return 0, 1
+    torch.distributed.init_process_group(backend="gloo")
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", world_size))
+    torch.set_num_threads(max(1, os.cpu_count() // local_world_size))
+    return torch.distributed.get_rank(), world_size
+
+
+def list_checkpoints(save_dir):
+    """Returns the checkpoints in save_dir, from the oldest to the newest."""
+    checkpoints = glob.glob(os.path.join(save_dir, CHECKPOINT_PREFIX + "*"))
+    checkpoints = [c for c in checkpoints if not c.endswith(".tmp")]
+    return sorted(checkpoints, key=lambda c: int(c.rsplit("_", 1)[1]))
+
+
+def find_checkpoint(path):
+    """Returns path if it is a checkpoint, otherwise the newest checkpoint in path (e.g. the save dir of an interrupted run)."""
+    if os.path.exists(os.path.join(path, TRAINER_STATE_FILE)):
+        return path
+    checkpoints = list_checkpoints(path)
+    if not checkpoints:
+        raise FileNotFoundError(f"No checkpoint found in {path}")
+    return checkpoints[-1]
+
+
+class WrappedDistributedDataParallel(DistributedDataParallel):
+    """Gives access to the attributes of the wrapped model, like WrappedDDP in farm/train.py, but uses torch's DistributedDataParallel instead of apex's (which requires GPUs)."""
+
+    def __getattr__(self, name):
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            return getattr(self.module, name)
+
+
+class CharMLMTrainer(Trainer):
+    def __init__(
+        self,
+        *args,
+        precision="fp32",
+        log_every=1,
+        checkpoint_every=None,
+        save_dir=None,
+        max_checkpoints=3,
+        seed=42,
+        **kwargs,
+    ):
+        """
+        Takes the same arguments as Trainer.__init__ (located at farm/train.py) plus the ones below. If the process group has been initialized (see init_distributed), the model is trained with DistributedDataParallel and only the process with rank 0 evaluates the model, saves the checkpoints and logs the throughput, while the other processes wait for it (see wait_for_rank_0).
+
+        :param precision: "fp32" or "bf16". With "bf16" the forward pass and the loss are computed under bf16 autocast (the weights, gradients and optimizer state stay in fp32), which is much faster on CPUs with native bf16 support.
+        :type precision: str
+        :param log_every: log the throughput every log_every optimizer steps.
+        :type log_every: int
+        :param checkpoint_every: save a checkpoint (the model, processor, optimizer, RNG states and position in the train set) to save_dir every checkpoint_every steps (batches), after the next optimizer step. None to disable checkpointing.
+        :type checkpoint_every: int
+        :param save_dir: the directory the checkpoints are saved in.
+        :type save_dir: str
+        :param max_checkpoints: how many checkpoints to keep. Older ones are deleted.
+        :type max_checkpoints: int
+        :param seed: the seed the order of the train set is derived from (the order only depends on the seed and the epoch, so that it can be recreated when resuming).
+        :type seed: int
+        """
+        super().__init__(*args, **kwargs)
+        if precision not in PRECISIONS:
+            raise ValueError(
+                f"Unknown precision {precision}, choose from {PRECISIONS}."
+            )
+        self.precision = precision
+        self.log_every = log_every
+        self.checkpoint_every = checkpoint_every
+        self.save_dir = save_dir
+        self.max_checkpoints = max_checkpoints
+        self.seed = seed
+        # where to continue training, set by load_checkpoint
+        self.start_epoch = 1
+        self.start_step = 0
+        if torch.distributed.is_initialized():
+            self.rank = torch.distributed.get_rank()
+            self.world_size = torch.distributed.get_world_size()
+            # the timeouts of the collectives of a group are set when it is created, so the barrier needs a group of its own
+            self._barrier_group = torch.distributed.new_group(
+                backend="gloo", timeout=BARRIER_TIMEOUT
+            )
+        else:
+            self.rank = 0
+            self.world_size = 1
+        MlLogger.log_params(
+            {"precision": precision, "grad_acc_steps": self.grad_acc_steps}
+        )
+
+    def wait_for_rank_0(self):
+        """Makes all the processes wait until rank 0 has finished evaluating the model or saving a checkpoint. Otherwise the other processes would wait in the allreduce of their next backward pass, which fails once the timeout of the process group (30 minutes by default) is exceeded. The barrier has its own, much longer timeout (BARRIER_TIMEOUT)."""
+        if self.world_size > 1:
+            torch.distributed.barrier(group=self._barrier_group)
+
+    def save_checkpoint(self, model, epoch, step):
+        """Saves a checkpoint from which training can be resumed at the given epoch and step (within the epoch). The model and processor are saved as usual, so a checkpoint can also be loaded like any other model. Only the newest max_checkpoints checkpoints are kept."""
+        checkpoint_dir = os.path.join(
+            self.save_dir, f"{CHECKPOINT_PREFIX}{self.global_step}"
+        )
+        # write to a temporary directory first, so that an interrupted save never leaves a broken checkpoint
+        tmp_dir = checkpoint_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        model.save(tmp_dir)
+        self.data_silo.processor.save(tmp_dir)
+        state = {
+            "optimizer": self.optimizer.state_dict(),
+            "warmup_linear": self.warmup_linear,
+            "global_step": self.global_step,
+            "epoch": epoch,
+            "step": step,
+            "python_rng": random.getstate(),
+            "numpy_rng": np.random.get_state(),
+            "torch_rng": torch.get_rng_state(),
+        }
+        torch.save(state, os.path.join(tmp_dir, TRAINER_STATE_FILE))
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+        os.rename(tmp_dir, checkpoint_dir)
+        logger.info(f"Saved checkpoint {checkpoint_dir}")
+        for old_checkpoint in list_checkpoints(self.save_dir)[: -self.max_checkpoints]:
+            shutil.rmtree(old_checkpoint)
+
+    def load_checkpoint(self, checkpoint_dir):
+        """Restores the optimizer, RNG states and position in the train set from a checkpoint saved with save_checkpoint. The model has to be loaded from the checkpoint separately (with CharMLMAdaptiveModel.load) before the optimizer is created."""
+        # the optimizer state contains the schedule objects, so it can't be loaded with weights_only
+        state = torch.load(
+            os.path.join(checkpoint_dir, TRAINER_STATE_FILE), weights_only=False
+        )
+        self.optimizer.load_state_dict(state["optimizer"])
+        self.warmup_linear = state["warmup_linear"]
+        self.global_step = state["global_step"]
+        self.start_epoch = state["epoch"]
+        self.start_step = state["step"]
+        random.setstate(state["python_rng"])
+        np.random.set_state(state["numpy_rng"])
+        torch.set_rng_state(state["torch_rng"])
+        logger.info(
+            f"Resuming from {checkpoint_dir} at epoch {self.start_epoch}, step {self.start_step}"
+        )
+
+    def _epoch_data_loader(self, epoch, start_step):
+        """Returns the train data loader for epoch, skipping the first start_step batches. The order of the train set only depends on the seed and the epoch, so the skipped samples don't have to be loaded."""
+        sampler = self.data_loader_train.sampler
+        if hasattr(sampler, "set_epoch"):
+            # the DistributedSampler shuffles with its seed plus the epoch
+            sampler.set_epoch(epoch)
+        elif isinstance(sampler, RandomSampler):
+            sampler.generator = torch.Generator().manual_seed(self.seed + epoch)
+        if start_step == 0:
+            data_loader = self.data_loader_train
+        else:
+            batch_size = self.data_loader_train.batch_size
+            data_loader = NamedDataLoader(
+                dataset=self.data_loader_train.dataset,
+                sampler=list(sampler)[start_step * batch_size :],
+                batch_size=batch_size,
+                tensor_names=self.data_silo.tensor_names,
+            )
+        # otherwise creating an iterator draws from the global RNG, so the RNG states in the checkpoints would be off by one draw
+        data_loader.generator = torch.Generator().manual_seed(self.seed + epoch)
+        return data_loader
+
+    def train(self, model):
+        """This method is a copy of Trainer.train() from farm/train.py. It has been modified to run the forward pass under autocast when training in bf16, to train with torch's DistributedDataParallel, to save and resume from checkpoints and to log the throughput. - BN"""
+        logger.info(f"\n {GROWING_TREE}")
+        model.train()
+        if self.fp16:
+            model.half()
+        # the evaluation runs on the unwrapped model, as DistributedDataParallel would wait for the other processes
+        unwrapped_model = model
+        if self.world_size > 1:
+            # the pooler isn't used by the MLM head
+            model = WrappedDistributedDataParallel(model, find_unused_parameters=True)
+        elif self.n_gpu > 1:
+            model = WrappedDataParallel(model)
+
+        nb_of_seqs = 0
+        nb_of_tokens = 0
+        last_checkpoint = self.global_step
+        start = time.perf_counter()
+        for epoch in range(self.start_epoch, self.epochs + 1):
+            start_step = self.start_step if epoch == self.start_epoch else 0
+            progress_bar = tqdm(
+                self._epoch_data_loader(epoch, start_step),
+                desc=f"Train epoch {epoch}/{self.epochs}",
+                total=len(self.data_loader_train),
+                initial=start_step,
+                disable=self.rank != 0,
+            )
+            for step, batch in enumerate(progress_bar, start_step):
+
+                # Move batch of samples to device
+                batch = {key: batch[key].to(self.device) for key in batch}
+
+                # the gradients only need to be synchronized before the optimizer step
+                if self.world_size > 1 and (step + 1) % self.grad_acc_steps != 0:
+                    sync_context = model.no_sync()
+                else:
+                    sync_context = nullcontext()
+
+                with sync_context:
+                    # Forward pass through model
+                    with torch.autocast(
+                        device_type=self.device.type,
+                        dtype=torch.bfloat16,
+                        enabled=self.precision == "bf16",
+                    ):
+                        logits = model.forward(**batch)
+                        per_sample_loss = model.logits_to_loss(logits=logits, **batch)
+
+                    self.backward_propagate(per_sample_loss.float(), step)
+
+                nb_of_seqs += batch["input_ids"].shape[0]
+                nb_of_tokens += int(batch["padding_mask"].sum())
+                if (step + 1) % (self.grad_acc_steps * self.log_every) == 0:
+                    seconds = time.perf_counter() - start
+                    # the processes run in lockstep, so the total throughput is that of rank 0 times the number of processes
+                    throughput = {
+                        "Train_seqs_per_sec": nb_of_seqs * self.world_size / seconds,
+                        "Train_tokens_per_sec": nb_of_tokens
+                        * self.world_size
+                        / seconds,
+                    }
+                    if self.rank == 0:
+                        MlLogger.log_metrics(throughput, step=self.global_step)
+                    progress_bar.set_postfix(
+                        seqs_per_sec=f"{throughput['Train_seqs_per_sec']:.1f}"
+                    )
+                    nb_of_seqs = 0
+                    nb_of_tokens = 0
+                    start = time.perf_counter()
+
+                # Perform  evaluation
+                if self.global_step != 0 and (
+                    self.global_step % self.evaluate_every == 0
+                ):
+                    if self.evaluator_dev is not None and self.rank == 0:
+                        result = self.evaluator_dev.eval(unwrapped_model)
+                        self.evaluator_dev.log_results(result, "Val", self.global_step)
+                        # the evaluator switches the model to eval mode
+                        model.train()
+                    self.wait_for_rank_0()
+                    # don't count the evaluation in the throughput
+                    start = time.perf_counter()
+
+                self.global_step += 1
+
+                # checkpoints are only saved after an optimizer step, so there are no accumulated gradients to save
+                if (
+                    self.checkpoint_every
+                    and self.global_step - last_checkpoint >= self.checkpoint_every
+                    and (step + 1) % self.grad_acc_steps == 0
+                ):
+                    last_checkpoint = self.global_step
+                    if self.rank == 0:
+                        if step + 1 == len(self.data_loader_train):
+                            self.save_checkpoint(unwrapped_model, epoch + 1, 0)
+                        else:
+                            self.save_checkpoint(unwrapped_model, epoch, step + 1)
+                    self.wait_for_rank_0()
+                    start = time.perf_counter()
+
+        if self.evaluator_test is not None and self.rank == 0:
+            result = self.evaluator_test.eval(unwrapped_model)
+            self.evaluator_test.log_results(result, "Test", self.global_step)
+        return unwrapped_model
@@ -0,0 +1,33 @@
+from greek_char_bert.data_handler.tokenization import CharMLMTokenizer
+from greek_char_bert.data_handler.processor import CharMLMProcessor
+from greek_char_bert.data_handler.dataset_cache import (
+    CharMLMCachedDataset,
+    build_cache,
+    cache_is_current,
+)
+import os
+
+
+def test_cache_is_tied_to_the_data_file(tmp_path):
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]', '_', 'α', 'β', 'γ']
+    (tmp_path / 'vocab.txt').write_text('\n'.join(vocab) + '\n')
+    tokenizer = CharMLMTokenizer(vocab_file=str(tmp_path / 'vocab.txt'), do_lower_case=False)
+    data = tmp_path / 'train.txt'
+    data.write_text('αβγ\nβγ_α\n\nγα\nαα\n')
+    cache_prefix = build_cache(str(data), tokenizer, 16)
+    # it should use a cache built from the file as it is
+    assert cache_is_current(cache_prefix, str(data))
+    processor = CharMLMProcessor(tokenizer=tokenizer, max_seq_len=16, data_dir=str(tmp_path))
+    dataset, _ = processor.dataset_from_file(str(data))
+    assert isinstance(dataset, CharMLMCachedDataset) and len(dataset) == 2
+
+    # it should not use the cache once the file has been regenerated
+    data.write_text('γγγ\nβ\n\nα\nβ\nγ\n')
+    os.utime(str(data), ns=(1, 1))
+    assert not cache_is_current(cache_prefix, str(data))
+    dataset, _ = processor.dataset_from_file(str(data))
+    assert not isinstance(dataset, CharMLMCachedDataset) and len(dataset) == 3
+
+    # it should use the cache again once it has been rebuilt
+    build_cache(str(data), tokenizer, 16)
+    assert cache_is_current(cache_prefix, str(data))
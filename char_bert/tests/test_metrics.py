@@ -0,0 +1,147 @@
+from greek_char_bert.metrics import (
+    accuracy_per_char,
+    accuracy_per_mask_length,
+    accuracy_per_seq,
+    align_predictions,
+    find_spans,
+    mask_length_histogram,
+)
+import random
+import re
+import pytest
+
+
+def old_evaluate_predictions_per_char(predictions, answers):
+    """The loop implementation of evaluate_predictions_per_char which run_eval.py used before metrics.py, returning the accuracy per char and per sequence."""
+    total = 0
+    correct = 0
+    nb_of_incorrect_seqs = 0
+    for pred, ans in zip(predictions, answers):
+        sent_correct = True
+        for p, a in zip(pred['predictions']['predictions'], ans):
+            total += 1
+            if p != a:
+                sent_correct = False
+            else:
+                correct += 1
+        if not sent_correct:
+            nb_of_incorrect_seqs += 1
+    return correct / total, 1.0 - nb_of_incorrect_seqs / len(predictions)
+
+
+def old_evaluate_predictions_per_mask(predictions, answers):
+    """The loop implementation of evaluate_predictions_per_mask which run_eval.py used before metrics.py, returning the accuracy per mask length."""
+    acc_per_mask_length = {}
+    for pred, ans in zip(predictions, answers):
+        preds = pred['predictions']['predictions']
+        chars_checked = 0
+        for match in re.finditer(r'\[[^[]*\]', pred['predictions']['text_with_preds']):
+            mask_len = match.end() - match.start() - 2
+            mask_correct = True
+            if mask_len not in acc_per_mask_length:
+                acc_per_mask_length[mask_len] = {
+                    'total_chars': 0,
+                    'total_masks': 0,
+                    'char_errors': 0,
+                    'correct_masks': 0,
+                }
+            acc_per_mask_length[mask_len]['total_masks'] += 1
+            for i in range(chars_checked, mask_len + chars_checked):
+                chars_checked += 1
+                acc_per_mask_length[mask_len]['total_chars'] += 1
+                if preds[i] != ans[i]:
+                    mask_correct = False
+                    acc_per_mask_length[mask_len]['char_errors'] += 1
+            if mask_correct:
+                acc_per_mask_length[mask_len]['correct_masks'] += 1
+    return acc_per_mask_length
+
+
+def make_prediction(masked_text, text_with_preds, predicted_chars):
+    return {
+        'task': 'mlm',
+        'predictions': {
+            'masked_text': masked_text,
+            'predictions': predicted_chars,
+            'text_with_preds': text_with_preds,
+        },
+    }
+
+
+@pytest.fixture
+def predictions_and_answers():
+    """Random sequences with spans of one to five masked chars, about three quarters of which are predicted correctly."""
+    rng = random.Random(42)
+    letters = 'αβγδεζηθικλμνξοπρστυφχψω'
+    predictions = []
+    answers = []
+    for _ in range(200):
+        masked_text = ''
+        text_with_preds = ''
+        answer = ''
+        predicted_chars = []
+        for _ in range(rng.randint(1, 4)):
+            context = ''.join(rng.choice(letters) for _ in range(rng.randint(1, 6)))
+            span = ''.join(rng.choice(letters) for _ in range(rng.randint(1, 5)))
+            span_preds = [c if rng.random() < 0.75 else rng.choice(letters) for c in span]
+            masked_text += context + '#' * len(span)
+            text_with_preds += context + '[' + ''.join(span_preds) + ']'
+            answer += span
+            predicted_chars += span_preds
+        ending = rng.choice(['', '_' + rng.choice(letters)])
+        masked_text += ending
+        text_with_preds += ending
+        predictions.append(make_prediction(masked_text, text_with_preds, predicted_chars))
+        answers.append(answer)
+    return predictions, answers
+
+
+def test_find_spans():
+    starts, lens, seq_ids = find_spans(['α##β#', '', '###', 'αβ'])
+    # it should find every run of masked chars with its position in its own sequence
+    assert starts.tolist() == [1, 4, 0]
+    assert lens.tolist() == [2, 1, 3]
+    assert seq_ids.tolist() == [0, 0, 2]
+
+
+def test_metrics_match_the_loops(predictions_and_answers):
+    predictions, answers = predictions_and_answers
+    aligned, skipped = align_predictions(predictions, answers)
+    assert skipped == []
+    acc_per_char, acc_per_seq = old_evaluate_predictions_per_char(predictions, answers)
+    # it should compute the same accuracies as the loop implementations
+    assert accuracy_per_char(aligned) == pytest.approx(acc_per_char)
+    assert accuracy_per_seq(aligned) == pytest.approx(acc_per_seq)
+    old_acc_per_mask_length = old_evaluate_predictions_per_mask(predictions, answers)
+    assert accuracy_per_mask_length(aligned) == old_acc_per_mask_length
+    # it should count the spans of each length like total_masks
+    assert mask_length_histogram(aligned) == {
+        length: acc['total_masks'] for length, acc in old_acc_per_mask_length.items()
+    }
+
+
+def test_metrics_skip_misaligned_sequences(predictions_and_answers):
+    predictions, answers = predictions_and_answers
+    # a prediction cut short (as when the masked text is truncated to max_seq_len), an answer which is too long and a sequence without masks
+    predictions.insert(3, make_prediction('αβ###γ#', 'αβ[αβ]#γ#', ['α', 'β']))
+    answers.insert(3, 'αβγδ')
+    predictions.insert(10, make_prediction('αβ##γ', 'αβ[αβ]γ', ['α', 'β']))
+    answers.insert(10, 'αβγ')
+    predictions.insert(20, make_prediction('αβγ', 'αβγ', []))
+    answers.insert(20, '')
+    aligned, skipped = align_predictions(predictions, answers)
+    # it should skip the misaligned sequences, but not the one without masks
+    assert skipped == [3, 10]
+    assert aligned['nb_of_seqs'] == len(predictions)
+    kept = [i for i in range(len(predictions)) if i not in (3, 10, 20)]
+    acc_per_char, acc_per_seq = old_evaluate_predictions_per_char(
+        [predictions[i] for i in kept], [answers[i] for i in kept]
+    )
+    # it should compute the metrics of the other sequences as the loop implementations do, counting the sequence without masks as correct
+    assert accuracy_per_char(aligned) == pytest.approx(acc_per_char)
+    assert accuracy_per_seq(aligned) == pytest.approx(
+        (acc_per_seq * len(kept) + 1) / (len(kept) + 1)
+    )
+    assert accuracy_per_mask_length(aligned) == old_evaluate_predictions_per_mask(
+        [predictions[i] for i in kept], [answers[i] for i in kept]
+    )
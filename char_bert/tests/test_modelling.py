@@ -0,0 +1,124 @@
+from greek_char_bert.data_handler.tokenization import CharMLMTokenizer
+from greek_char_bert.data_handler.processor import CharMLMPredProcessor
+from greek_char_bert.modelling.language_model import PretrainingBERT
+from greek_char_bert.modelling.prediction_head import CharMLMHead, DEFAULT_MASK_TOKEN_ID
+from greek_char_bert.modelling.adaptive_model import CharMLMAdaptiveModel
+from greek_char_bert.predict import sentences_to_dicts
+from farm.modeling.language_model import BertModel
+from farm.modeling.prediction_head import BertLMHead
+from farm.utils import set_all_seeds
+from pytorch_transformers.modeling_bert import BertConfig
+import json
+import pytest
+import torch
+
+VOCAB = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]', '_'] + list('αβγδεηικλμνοπρστυω')
+MASK_ID = VOCAB.index('[MASK]')
+
+
+@pytest.fixture(scope='module')
+def model():
+    """A tiny randomly initialized model."""
+    set_all_seeds(seed=42)
+    config = BertConfig(
+        vocab_size_or_config_json_file=len(VOCAB),
+        hidden_size=16,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+        intermediate_size=32,
+    )
+    language_model = PretrainingBERT(BertModel(config=config))
+    language_model.language = 'ancient-greek'
+    model = CharMLMAdaptiveModel(
+        language_model=language_model,
+        prediction_heads=[CharMLMHead(hidden_size=16, vocab_size=len(VOCAB), mask_token_id=MASK_ID)],
+        embeds_dropout_prob=0.1,
+        lm_output_types=['per_token'],
+        device=torch.device('cpu'),
+    )
+    model.eval()
+    return model
+
+
+def make_batch(lm_label_ids, input_ids):
+    return {
+        'input_ids': input_ids,
+        'segment_ids': torch.zeros_like(input_ids),
+        'padding_mask': torch.ones_like(input_ids),
+        'lm_label_ids': lm_label_ids,
+    }
+
+
+def full_sequence_logits(model, batch):
+    """The logits of the head at every position, as computed before the head was only run at the selected positions."""
+    sequence_output, _ = model.language_model(**batch, output_all_encoded_layers=False)
+    return model.prediction_heads[0](model.dropout(sequence_output))
+
+
+def old_logits_to_preds(logits, label_map, input_ids):
+    """The logits_to_preds of the CharMLMHead which took the logits of every position."""
+    lm_preds_ids = logits.argmax(2).numpy()
+    lm_preds_ids[input_ids.numpy() != MASK_ID] = -1
+    return [[label_map[int(x)] for x in seq if int(x) != -1] for seq in lm_preds_ids.tolist()]
+
+
+def test_head_matches_the_full_sequence_head(model):
+    generator = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(5, len(VOCAB), (4, 12), generator=generator)
+    # labels at the masked positions and at a few positions which kept (or had replaced) their char
+    lm_label_ids = torch.full_like(input_ids, -1)
+    is_labelled = torch.rand(input_ids.shape, generator=generator) < 0.3
+    lm_label_ids[is_labelled] = input_ids[is_labelled]
+    input_ids[is_labelled & (torch.rand(input_ids.shape, generator=generator) < 0.8)] = MASK_ID
+    batch = make_batch(lm_label_ids, input_ids)
+    head = model.prediction_heads[0]
+    with torch.no_grad():
+        logits = model.forward(**batch)[0]
+        old_logits = full_sequence_logits(model, batch)
+    # it should only compute the logits of the selected positions
+    assert logits.shape == (is_labelled.sum().item(), len(VOCAB))
+    # it should give the same mean loss as BertLMHead over the full sequence
+    loss = head.logits_to_loss(logits=logits, **batch)
+    old_loss = BertLMHead.logits_to_loss(head, logits=old_logits, lm_label_ids=lm_label_ids)
+    assert loss.shape == (4,)
+    assert loss.mean().item() == pytest.approx(old_loss.mean().item(), rel=1e-5)
+
+
+def test_head_is_only_computed_at_the_masked_positions_during_prediction(model, tmp_path):
+    (tmp_path / 'vocab.txt').write_text('\n'.join(VOCAB) + '\n')
+    tokenizer = CharMLMTokenizer(vocab_file=str(tmp_path / 'vocab.txt'), do_lower_case=False)
+    processor = CharMLMPredProcessor(tokenizer=tokenizer, max_seq_len=32, data_dir=str(tmp_path))
+    texts = [
+        'τον_δημον_κα[MASK][MASK][MASK]_τους',
+        '[MASK]ιππεας_και',
+        'ο_δημος_ειπεν[MASK]',
+        'και_τους_πολεμ[MASK][MASK]ους',
+    ]
+    dataset, tensor_names, _ = processor.dataset_and_samples_from_dicts(sentences_to_dicts(texts))
+    batch = dict(zip(tensor_names, dataset.tensors))
+    input_ids = batch['input_ids']
+    head = model.prediction_heads[0]
+    with torch.no_grad():
+        logits = model.forward(**batch)[0]
+        old_logits = full_sequence_logits(model, batch)
+    # it should only compute the logits of the masked positions
+    assert logits.shape == ((input_ids == MASK_ID).sum().item(), len(VOCAB))
+    # it should predict the same chars at the masked positions
+    label_map = dict(enumerate(VOCAB))
+    preds = head.logits_to_preds(logits=logits, label_map=label_map, **batch)
+    assert preds == old_logits_to_preds(old_logits, label_map, input_ids)
+    assert [len(p) for p in preds] == [3, 1, 1, 2]
+
+
+def test_mask_token_id_fallback(model, tmp_path):
+    model.prediction_heads[0].save(str(tmp_path), 0)
+    config_file = tmp_path / 'prediction_head_0_config.json'
+    config = json.loads(config_file.read_text())
+    # it should save the id of the mask token
+    assert config['mask_token_id'] == MASK_ID
+    # it should fall back on the position of [MASK] in the vocabs of generate_char_vocab.py for heads saved without it
+    del config['mask_token_id']
+    config_file.write_text(json.dumps(config))
+    head = CharMLMHead.load(str(config_file))
+    assert isinstance(head, CharMLMHead)
+    assert head.mask_token_id == DEFAULT_MASK_TOKEN_ID == 4
@@ -0,0 +1,307 @@
+from greek_char_bert.data_handler.tokenization import CharMLMTokenizer
+from greek_char_bert.data_handler.processor import CharMLMProcessor
+from greek_char_bert.modelling.language_model import PretrainingBERT
+from greek_char_bert.modelling.prediction_head import CharMLMHead
+from greek_char_bert.modelling.adaptive_model import CharMLMAdaptiveModel
+from greek_char_bert.prediction_cache import PredictionCache
+from greek_char_bert.predict import (
+    MLMPredicter,
+    format_metrics,
+    insert_preds,
+    run_pipeline,
+    split_masked_text,
+)
+from farm.modeling.language_model import BertModel
+from farm.utils import set_all_seeds
+from pytorch_transformers.modeling_bert import BertConfig
+from contextlib import contextmanager
+from threading import Thread
+import numpy as np
+import os
+import pytest
+import torch
+
+
+@pytest.fixture(scope='module')
+def predicter(tmp_path_factory):
+    """A tiny randomly initialized model."""
+    save_dir = tmp_path_factory.mktemp('model')
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]', '_'] + list('αβγδεηικλμνοπρστυω')
+    (save_dir / 'vocab.txt').write_text('\n'.join(vocab) + '\n')
+    tokenizer = CharMLMTokenizer(vocab_file=str(save_dir / 'vocab.txt'), do_lower_case=False)
+    processor = CharMLMProcessor(tokenizer=tokenizer, max_seq_len=32, data_dir=str(save_dir))
+    set_all_seeds(seed=42)
+    config = BertConfig(
+        vocab_size_or_config_json_file=len(vocab),
+        hidden_size=16,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+        intermediate_size=32,
+    )
+    language_model = PretrainingBERT(BertModel(config=config))
+    language_model.language = 'ancient-greek'
+    model = CharMLMAdaptiveModel(
+        language_model=language_model,
+        prediction_heads=[CharMLMHead(hidden_size=16, vocab_size=len(vocab))],
+        embeds_dropout_prob=0.1,
+        lm_output_types=['per_token'],
+        device=torch.device('cpu'),
+    )
+    model.save(str(save_dir))
+    processor.save(str(save_dir))
+    return MLMPredicter.load(str(save_dir), batch_size=8, gpu=False)
+
+
+def test_score_candidates(predicter):
+    text = 'τον_δημον_κα#####_τους_ιππεας'
+    # it should reject empty candidates
+    with pytest.raises(ValueError):
+        predicter.score_candidates(text, ['ηκου', ''])
+    # it should rank candidates of different lengths by their log-likelihood per char
+    scores = predicter.score_candidates(text, ['ου', 'ηκου', 'λεσαι'])
+    for score in scores:
+        assert score['log_likelihood_per_char'] == pytest.approx(
+            score['log_likelihood'] / len(score['candidate'])
+        )
+        assert score['score'] == score['log_likelihood_per_char']
+    assert [s['score'] for s in scores] == sorted([s['score'] for s in scores], reverse=True)
+    # it should rank candidates of the same length by their log-likelihood
+    scores = predicter.score_candidates(text, ['λεσαι', 'ληκου'], pseudo_log_likelihood=True)
+    assert all(s['score'] == s['pseudo_log_likelihood'] for s in scores)
+
+
+def test_run_pipeline():
+    # it should return the decoded items in the same order as the items
+    results = run_pipeline(
+        range(20),
+        lambda item: item * 2,
+        lambda featurized: featurized + 1,
+        lambda featurized, output: (featurized, output),
+        queue_size=2,
+    )
+    assert results == [(i * 2, i * 2 + 1) for i in range(20)]
+
+
+def fail_on(value):
+    def stage(*args):
+        if args[0] == value:
+            raise RuntimeError(f'failed on {value}')
+        return args[0]
+
+    return stage
+
+
+def run_pipeline_with_timeout(*args, timeout=30):
+    """Runs run_pipeline in a separate thread and returns the exception it raised, failing if it doesn't finish in time."""
+    errors = []
+
+    def target():
+        try:
+            run_pipeline(*args)
+        except Exception as e:
+            errors.append(e)
+
+    thread = Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'run_pipeline hangs'
+    return errors[0] if errors else None
+
+
+def test_run_pipeline_errors():
+    identity = lambda item: item
+    # it should raise an exception in featurize or decode again, without hanging even though the queues are full
+    error = run_pipeline_with_timeout(range(100), fail_on(3), identity, lambda f, o: o, 1)
+    assert str(error) == 'failed on 3'
+    error = run_pipeline_with_timeout(range(100), identity, identity, fail_on(5), 1)
+    assert str(error) == 'failed on 5'
+    # it should raise an exception in forward again
+    error = run_pipeline_with_timeout(range(100), identity, fail_on(0), lambda f, o: o, 1)
+    assert str(error) == 'failed on 0'
+
+
+def test_profiled_predict(predicter):
+    dicts = [{'doc': ['τον_δημον_κα#####_τους', '_']} for _ in range(20)]
+    predicter.reset_metrics()
+    predicter.profile = 'time'
+    try:
+        predictions = predicter.predict(dicts)
+        profiled_metrics = predicter.metrics
+        wall_seconds = predicter.wall_seconds
+    finally:
+        predicter.profile = None
+        predicter.reset_metrics()
+    # it should run the stages one after the other, giving the same predictions
+    assert predictions == predicter.predict(dicts)
+    assert profiled_metrics['forward']['calls'] == 3
+    # it should report the wall time separately from the sum of the stage times, which can't be larger
+    stages_total = sum(stage['seconds'] for stage in profiled_metrics.values())
+    assert 0 < stages_total <= wall_seconds
+    assert 'wall time' in format_metrics(profiled_metrics, wall_seconds)
+
+
+class StubNgramModel:
+    """Predicts α with a probability of 0.95 at even positions and β with a probability of 0.5 at odd ones."""
+
+    counts = np.zeros(4, dtype=np.uint32)
+    chars = ['α', 'β']
+    order = 3
+    nb_of_bits = 2
+    min_count = 5
+
+    def predict(self, chars, i):
+        return ('α', 0.95) if i % 2 == 0 else ('β', 0.5)
+
+
+@contextmanager
+def ngram_model(predicter, model, threshold):
+    predicter.ngram_model = model
+    predicter.ngram_threshold = threshold
+    try:
+        yield predicter
+    finally:
+        predicter.ngram_model = None
+
+
+def test_cascade_threshold(predicter):
+    dicts = [{'doc': ['τον_[MASK][MASK][MASK]_κ[MASK]_τους', '_']}]
+    bert_predictions = predicter.predict(dicts)
+    with ngram_model(predicter, StubNgramModel(), 0.9):
+        predictions = predicter.predict(dicts)
+    stages = predictions[0]['predictions']['stages']
+    chars = predictions[0]['predictions']['predictions']
+    # it should only use the n-gram predictions at or above the threshold
+    assert stages == ['ngram', 'bert', 'ngram', 'bert']
+    assert chars[0] == chars[2] == 'α'
+    assert predictions[0]['predictions']['masked_text'] == bert_predictions[0]['predictions']['masked_text']
+    with ngram_model(predicter, StubNgramModel(), 0.4):
+        predictions = predicter.predict(dicts)
+    # it should answer every masked char with the n-gram model if the threshold is low enough
+    assert predictions[0]['predictions']['stages'] == ['ngram'] * 4
+    assert predictions[0]['predictions']['predictions'] == ['α', 'β', 'α', 'β']
+    with ngram_model(predicter, StubNgramModel(), 1.0):
+        predictions = predicter.predict(dicts)
+    # it should answer every masked char with the BERT model if the threshold is too high
+    assert predictions[0]['predictions']['stages'] == ['bert'] * 4
+    assert predictions[0]['predictions']['predictions'] == bert_predictions[0]['predictions']['predictions']
+
+
+def test_cascade_truncation(predicter):
+    # the text is longer than max_seq_len, so the last masked char is cut off
+    dicts = [{'doc': ['[MASK][MASK]' + 'τον_δημον_' * 4 + '[MASK]', '_']}]
+    bert_prediction = predicter.predict(dicts)[0]['predictions']
+    with ngram_model(predicter, StubNgramModel(), 0.4):
+        ngram_prediction = predicter.predict(dicts)[0]['predictions']
+    # it should truncate the masked text in the same way whether or not the BERT model is run
+    assert ngram_prediction['masked_text'] == bert_prediction['masked_text']
+    assert len(ngram_prediction['masked_text']) == 32 - 3
+    assert len(ngram_prediction['predictions']) == len(bert_prediction['predictions']) == 2
+    assert ngram_prediction['stages'] == ['ngram', 'ngram']
+
+
+def stub_predict(calls, probabilities):
+    """Returns a predict function which records the texts it is called with and predicts chr(ord('α') + i) for the masked char at position i, with the probability given in probabilities, or 0.99 if the chars on both sides of it are known."""
+
+    def predict(dicts):
+        predictions = []
+        for d in dicts:
+            calls.append(d['doc'][0])
+            chars = split_masked_text(d['doc'][0])
+            positions = [i for i, c in enumerate(chars) if c == '[MASK]']
+            masked_text = ''.join('#' if c == '[MASK]' else c for c in chars) + '_'
+            predicted_chars = [chr(ord('α') + i) for i in positions]
+            predictions.append(
+                {
+                    'task': 'mlm',
+                    'predictions': {
+                        'original_text': d['doc'][0],
+                        'masked_text': masked_text,
+                        'text_with_preds': insert_preds(masked_text, predicted_chars),
+                        'predictions': predicted_chars,
+                        'probabilities': [
+                            0.99
+                            if chars[i - 1] != '[MASK]' and chars[i + 1] != '[MASK]'
+                            else probabilities[i]
+                            for i in positions
+                        ],
+                    },
+                }
+            )
+        return predictions
+
+    return predict
+
+
+def test_predict_adaptively(predicter, monkeypatch):
+    # a gap of three masked chars, the middle one of which is the most probable, and a confident gap of one
+    dicts = [{'doc': ['ab[MASK][MASK][MASK]c[MASK]d', '_']}]
+    probabilities = {2: 0.5, 3: 0.8, 4: 0.6, 6: 0.4}
+    calls = []
+    monkeypatch.setattr(predicter, '_profiled_predict', stub_predict(calls, probabilities))
+    monkeypatch.setattr(predicter, 'confidence_threshold', 0.9)
+    monkeypatch.setattr(predicter, 'max_iterations', 8)
+    prediction = predicter.predict_adaptively(dicts)[0]['predictions']
+    # it should accept the confident gap, fill in the most probable char of the other one and stop once it is confident
+    assert calls == [
+        'ab[MASK][MASK][MASK]c[MASK]d',
+        'ab[MASK]δ[MASK]cηd',
+    ]
+    assert prediction['predictions'] == ['γ', 'δ', 'ε', 'η']
+    assert prediction['probabilities'] == [0.99, 0.8, 0.99, 0.99]
+    assert prediction['text_with_preds'] == 'ab[γδε]c[η]d_'
+    # it should stop after max_iterations passes, keeping the last predictions of the remaining chars
+    calls.clear()
+    monkeypatch.setattr(predicter, 'confidence_threshold', 1.0)
+    monkeypatch.setattr(predicter, 'max_iterations', 1)
+    prediction = predicter.predict_adaptively(dicts)[0]['predictions']
+    assert calls == [
+        'ab[MASK][MASK][MASK]c[MASK]d',
+        'ab[MASK]δ[MASK]cηd',
+    ]
+    assert prediction['probabilities'] == [0.99, 0.8, 0.99, 0.99]
+    # it should only make one pass if every gap is confident
+    calls.clear()
+    monkeypatch.setattr(predicter, 'confidence_threshold', 0.3)
+    prediction = predicter.predict_adaptively(dicts)[0]['predictions']
+    assert calls == ['ab[MASK][MASK][MASK]c[MASK]d']
+    assert prediction['probabilities'] == [0.5, 0.8, 0.6, 0.99]
+
+
+def test_cache_keys(predicter, monkeypatch):
+    dicts = [{'doc': ['τον_[MASK][MASK][MASK]_κ[MASK]_τους', '_']}]
+    monkeypatch.setattr(predicter, 'cache', PredictionCache())
+
+    def misses(decode):
+        nb_of_misses = predicter.cache.misses
+        decode(dicts)
+        return predicter.cache.misses - nb_of_misses
+
+    # it should reuse the predictions of the same decoding mode
+    assert misses(predicter.predict) == 1
+    assert misses(predicter.predict) == 0
+    # it should not reuse them for another decoding mode or other options of the adaptive decoder
+    assert misses(predicter.predict_adaptively) > 0
+    assert misses(predicter.predict_adaptively) == 0
+    monkeypatch.setattr(predicter, 'confidence_threshold', 0.5)
+    assert misses(predicter.predict_adaptively) > 0
+    # it should not reuse them once an n-gram model is set or its threshold is changed
+    with ngram_model(predicter, StubNgramModel(), 0.9):
+        assert misses(predicter.predict) > 0
+        assert misses(predicter.predict) == 0
+        predicter.ngram_threshold = 0.4
+        assert misses(predicter.predict) == 1
+        assert predicter.predict(dicts)[0]['predictions']['stages'] == ['ngram'] * 4
+
+
+@pytest.mark.parametrize('profile, files', [('cprofile', ['profile.prof']), ('torch', ['profile_1.json', 'profile_2.json'])])
+def test_profile_output(predicter, monkeypatch, tmp_path, profile, files):
+    dicts = [{'doc': ['τον_δημον_κα#####_τους', '_']}]
+    monkeypatch.setattr(predicter, 'profile', profile)
+    monkeypatch.setattr(predicter, 'profile_output', str(tmp_path / 'profile'))
+    monkeypatch.setattr(predicter, '_profiler', None)
+    predicter.predict(dicts)
+    predicter.predict(dicts)
+    # it should write one cProfile of all the calls or one torch trace per call
+    assert sorted(os.listdir(str(tmp_path))) == files
+    # it should only create a cProfile profiler when capturing a cProfile
+    assert (predicter._profiler is not None) == (profile == 'cprofile')
@@ -0,0 +1,51 @@
+from greek_char_bert.prediction_cache import PredictionCache
+import os
+
+
+def prediction(text):
+    return {'task': 'mlm', 'predictions': {'masked_text': text, 'predictions': ['α']}}
+
+
+def test_keys():
+    cache = PredictionCache()
+    d = {'doc': ['αβ#', '_']}
+    key = cache.key('fingerprint', 'normal', d)
+    # it should give the same key whichever way the chars are masked
+    assert key == cache.key('fingerprint', 'normal', {'doc': ['αβ[MASK]', '_']})
+    # it should give a different key for another model, decoding mode or text
+    assert key != cache.key('other fingerprint', 'normal', d)
+    assert key != cache.key('fingerprint', 'sequential', d)
+    assert key != cache.key('fingerprint', 'normal', {'doc': ['αγ#', '_']})
+
+
+def test_disk_hit_after_memory_eviction(tmp_path):
+    cache = PredictionCache(max_entries=1, cache_dir=str(tmp_path))
+    cache.put('a', prediction('α#'))
+    cache.put('b', prediction('β#'))
+    # it should only keep the most recently used prediction in memory
+    assert list(cache.entries) == ['b']
+    # it should read a prediction which was evicted from memory from the disk and keep it in memory again
+    assert cache.get('a') == prediction('α#')
+    assert list(cache.entries) == ['a']
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 0
+    assert cache.get('c') is None
+    assert cache.stats()['misses'] == 1
+    # it should find the predictions on disk in a new cache
+    cache = PredictionCache(cache_dir=str(tmp_path))
+    assert cache.stats()['disk_entries'] == 2
+    assert cache.get('b') == prediction('β#')
+
+
+def test_disk_eviction_by_mtime(tmp_path):
+    cache = PredictionCache(max_entries=1, cache_dir=str(tmp_path), max_disk_entries=10)
+    for i in range(10):
+        cache.put(str(i), prediction('α#'))
+        os.utime(str(tmp_path / f'{i}.json'), (1000 + i, 1000 + i))
+    # reading a prediction marks it as recently used
+    assert cache.get('0') is not None
+    cache.put('10', prediction('α#'))
+    # it should remove the least recently used predictions until a tenth of max_disk_entries is free
+    assert sorted(os.listdir(str(tmp_path)), key=lambda f: int(f.split('.')[0])) == [
+        f'{i}.json' for i in [0] + list(range(3, 11))
+    ]
+    assert cache.stats()['disk_entries'] == 9
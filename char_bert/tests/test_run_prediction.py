@@ -0,0 +1,92 @@
+from greek_char_bert.run_prediction import (
+    count_records,
+    crop_window,
+    lacuna_windows,
+    predict_to_jsonl,
+)
+from types import SimpleNamespace
+import json
+
+
+class StubModel:
+    """Predicts α for every masked char."""
+
+    processor = SimpleNamespace(max_seq_len=16)
+
+    def decode(self, dicts, decoding):
+        return [
+            {'predictions': {'predictions': ['α'] * d['doc'][0].count('[MASK]')}}
+            for d in dicts
+        ]
+
+
+def test_crop_window():
+    # it should share the room between both sides if the context doesn't fit
+    assert crop_window(10, 12, 100, 6, 5, 5) == (8, 14)
+    # it should give the room which one side doesn't need to the other
+    assert crop_window(10, 12, 100, 6, 1, 5) == (9, 15)
+    # it should stop at the ends of the text
+    assert crop_window(1, 3, 5, 20, 4, 4) == (0, 5)
+
+
+def test_lacuna_windows():
+    text = 'αβ#γδεζηθ##ικ'
+    # it should give each lacuna a window of its own if their contexts don't overlap
+    assert lacuna_windows(text, 10, 2, 2) == [(0, 5, 2, 3), (7, 13, 9, 11)]
+    # it should give lacunae whose contexts overlap a shared window
+    assert lacuna_windows(text, 10, 3, 3) == [(2, 12, 2, 11)]
+    # it should split up lacunae which are longer than a window
+    assert lacuna_windows('α' + '#' * 25 + 'β', 10, 2, 2) == [
+        (1, 11, 1, 11),
+        (11, 21, 11, 21),
+        (19, 27, 21, 26),
+    ]
+    # it should skip texts without lacunae
+    assert lacuna_windows('αβγ', 10, 2, 2) == []
+
+
+def test_count_records(tmp_path):
+    path = tmp_path / 'out.jsonl'
+    assert count_records(str(path)) == 0
+    path.write_text('{"line": 0}\n{"line": 1}\n{"li')
+    # it should count the complete records and remove the partially written one
+    assert count_records(str(path)) == 2
+    assert path.read_text() == '{"line": 0}\n{"line": 1}\n'
+
+
+def read_records(path):
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    for record in records:
+        del record['seconds']
+    return records
+
+
+def test_predict_to_jsonl_resume(tmp_path, capsys):
+    path = tmp_path / 'texts.txt'
+    path.write_text(
+        '\n'.join(
+            [
+                'μῆνιν ἄ[...]ε θεὰ',
+                'Πηληϊάδεω Ἀχ[...]ος',
+                'οὐλομένην',
+                'ἣ μυρί[.] Ἀχαιοῖς ἄλγε[..] ἔθηκε',
+                'πολλὰς δ[.]',
+                '',
+                'ψυχὰς Ἄϊδι προ[...]εν',
+            ]
+        )
+        + '\n'
+    )
+    output_path = tmp_path / 'out.jsonl'
+    predict_to_jsonl(str(path), str(output_path), StubModel(), 'normal', 4, 4, batch_size=3)
+    records = read_records(output_path)
+    # it should write one record per line (and nothing to stdout)
+    assert [r['line'] for r in records] == list(range(7))
+    assert records[0]['text_with_preds'] == 'μῆνιν ἄ[ααα]ε θεὰ'
+    assert capsys.readouterr().out == ''
+    # it should continue after the last complete record, in the middle of a batch
+    lines = output_path.read_text().splitlines(keepends=True)
+    resumed_path = tmp_path / 'resumed.jsonl'
+    resumed_path.write_text(''.join(lines[:4]) + lines[4][:10])
+    predict_to_jsonl(str(path), str(resumed_path), StubModel(), 'normal', 4, 4, batch_size=3, resume=True)
+    assert read_records(resumed_path) == records
@@ -0,0 +1,270 @@
+from greek_char_bert.data_handler.tokenization import CharMLMTokenizer
+from greek_char_bert.data_handler.processor import CharMLMProcessor
+from greek_char_bert.data_handler.data_silo import CharMLMDataSilo
+from greek_char_bert.data_handler.dataset_cache import build_cache
+from greek_char_bert.modelling.language_model import PretrainingBERT
+from greek_char_bert.modelling.prediction_head import CharMLMHead
+from greek_char_bert.modelling.adaptive_model import CharMLMAdaptiveModel
+from greek_char_bert.trainer import (
+    CharMLMTrainer,
+    find_checkpoint,
+    grad_acc_steps_for,
+    list_checkpoints,
+)
+from farm.experiment import initialize_optimizer
+from farm.modeling.language_model import BertModel
+from farm.utils import set_all_seeds
+from pytorch_transformers.modeling_bert import BertConfig
+from datetime import timedelta
+import torch.multiprocessing
+import random
+import socket
+import time
+import os
+import pytest
+import torch
+
+VOCAB = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]', '_'] + list('αβγδεηικλμνοπρστυω')
+MAX_SEQ_LEN = 32
+
+
+def write_docs(path, nb_of_docs, nb_of_sentences, rng):
+    """Writes docs of random sentences in the BERT format."""
+    docs = []
+    for _ in range(nb_of_docs):
+        sentences = [
+            '_'.join(''.join(rng.choice(VOCAB[6:]) for _ in range(rng.randint(2, 6))) for _ in range(rng.randint(2, 5)))
+            for _ in range(nb_of_sentences)
+        ]
+        docs.append('\n'.join(sentences))
+    path.write_text('\n\n'.join(docs) + '\n')
+
+
+@pytest.fixture(scope='module')
+def data_dir(tmp_path_factory):
+    """A data dir with a vocab and small train, dev and test sets, each with a dataset cache."""
+    data_dir = tmp_path_factory.mktemp('data')
+    (data_dir / 'vocab.txt').write_text('\n'.join(VOCAB) + '\n')
+    tokenizer = CharMLMTokenizer(vocab_file=str(data_dir / 'vocab.txt'), do_lower_case=False)
+    rng = random.Random(42)
+    for name, nb_of_docs in [('train.txt', 3), ('dev.txt', 1), ('test.txt', 1)]:
+        write_docs(data_dir / name, nb_of_docs, 9, rng)
+        build_cache(str(data_dir / name), tokenizer, MAX_SEQ_LEN)
+    return data_dir
+
+
+def make_trainer(data_dir, world_size=1, load_dir=None, **kwargs):
+    """Returns a trainer for a tiny randomly initialized model (or the model in load_dir) and the model."""
+    set_all_seeds(seed=42)
+    tokenizer = CharMLMTokenizer(vocab_file=str(data_dir / 'vocab.txt'), do_lower_case=False)
+    processor = CharMLMProcessor(tokenizer=tokenizer, max_seq_len=MAX_SEQ_LEN, data_dir=str(data_dir))
+    data_silo = CharMLMDataSilo(processor=processor, batch_size=4, distributed=world_size > 1)
+    if load_dir:
+        model = CharMLMAdaptiveModel.load(load_dir, torch.device('cpu'))
+    else:
+        config = BertConfig(
+            vocab_size_or_config_json_file=len(VOCAB),
+            hidden_size=16,
+            num_hidden_layers=1,
+            num_attention_heads=2,
+            intermediate_size=32,
+        )
+        language_model = PretrainingBERT(BertModel(config=config))
+        language_model.language = 'ancient-greek'
+        model = CharMLMAdaptiveModel(
+            language_model=language_model,
+            prediction_heads=[CharMLMHead(hidden_size=16, vocab_size=len(VOCAB), mask_token_id=4)],
+            embeds_dropout_prob=0.1,
+            lm_output_types=['per_token'],
+            device=torch.device('cpu'),
+        )
+    optimizer, warmup_linear = initialize_optimizer(
+        model=model,
+        learning_rate=1e-3,
+        warmup_proportion=0.1,
+        n_batches=len(data_silo.loaders['train']),
+        n_epochs=2,
+    )
+    kwargs.setdefault('evaluate_every', 1000)
+    kwargs.setdefault('evaluator_dev', StubEvaluator())
+    kwargs.setdefault('evaluator_test', StubEvaluator())
+    trainer = CharMLMTrainer(
+        optimizer=optimizer,
+        data_silo=data_silo,
+        epochs=2,
+        n_gpu=0,
+        warmup_linear=warmup_linear,
+        device=torch.device('cpu'),
+        **kwargs,
+    )
+    return trainer, model
+
+
+class StubEvaluator:
+    """An evaluator which only waits for the given number of seconds."""
+
+    def __init__(self, seconds=0):
+        self.seconds = seconds
+
+    def eval(self, model):
+        time.sleep(self.seconds)
+        return []
+
+    def log_results(self, result, dataset_name, steps):
+        pass
+
+
+def test_grad_acc_steps_for(caplog):
+    # it should reach the effective batch size exactly when it is a multiple of the batch size
+    with caplog.at_level('WARNING', logger='greek_char_bert.trainer'):
+        assert grad_acc_steps_for(32, 8) == 4
+        assert grad_acc_steps_for(8, 8) == 1
+    assert not caplog.records
+    # it should round up and warn otherwise
+    with caplog.at_level('WARNING', logger='greek_char_bert.trainer'):
+        assert grad_acc_steps_for(30, 8) == 4
+        assert grad_acc_steps_for(4, 8) == 1
+    assert len(caplog.records) == 2
+    assert 'using 32 instead' in caplog.records[0].getMessage()
+    assert 'using 8 instead' in caplog.records[1].getMessage()
+
+
+def test_bf16_training_with_grad_acc(data_dir):
+    trainer, model = make_trainer(data_dir, precision='bf16', grad_acc_steps=2)
+    logits_dtypes = []
+    forward = model.forward
+
+    def recording_forward(**batch):
+        logits = forward(**batch)
+        logits_dtypes.append(logits[0].dtype)
+        return logits
+
+    model.forward = recording_forward
+    nb_of_optimizer_steps = []
+    optimizer_step = trainer.optimizer.step
+
+    def counting_step(*args, **kwargs):
+        nb_of_optimizer_steps.append(len(logits_dtypes))
+        return optimizer_step(*args, **kwargs)
+
+    trainer.optimizer.step = counting_step
+    initial_weights = {name: weights.clone() for name, weights in model.state_dict().items()}
+    trainer.train(model)
+    nb_of_batches = len(trainer.data_loader_train)
+    # it should run the forward pass under bf16 autocast
+    assert logits_dtypes == [torch.bfloat16] * 2 * nb_of_batches
+    # it should keep the weights in fp32 and train them
+    for name, weights in model.state_dict().items():
+        if weights.is_floating_point():
+            assert weights.dtype == torch.float32, name
+    assert any(
+        not torch.equal(weights, initial_weights[name]) for name, weights in model.state_dict().items()
+    )
+    # it should only step the optimizer at the end of each accumulation window (of each epoch)
+    windows_per_epoch = nb_of_batches // 2
+    assert nb_of_optimizer_steps == [
+        epoch * nb_of_batches + 2 * (window + 1)
+        for epoch in range(2)
+        for window in range(windows_per_epoch)
+    ]
+
+
+def train_distributed(rank, world_size, port, data_dir, output_dir):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    # a short timeout, so that a process waiting for rank 0 in an allreduce would fail
+    torch.distributed.init_process_group(
+        backend='gloo', rank=rank, world_size=world_size, timeout=timedelta(seconds=3)
+    )
+    torch.set_num_threads(1)
+    trainer, model = make_trainer(
+        data_dir,
+        world_size=world_size,
+        evaluate_every=4,
+        # longer than the timeout of the process group
+        evaluator_dev=StubEvaluator(6),
+    )
+    torch.distributed.barrier()
+    model = trainer.train(model)
+    torch.save(
+        {'global_step': trainer.global_step, 'state_dict': model.state_dict()},
+        str(output_dir / f'rank_{rank}.pt'),
+    )
+    torch.distributed.destroy_process_group()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_distributed_training(data_dir, tmp_path):
+    world_size = 2
+    torch.multiprocessing.spawn(
+        train_distributed,
+        args=(world_size, free_port(), data_dir, tmp_path),
+        nprocs=world_size,
+    )
+    results = [torch.load(str(tmp_path / f'rank_{rank}.pt')) for rank in range(world_size)]
+    trainer, _ = make_trainer(data_dir)
+    # it should split the batches of each epoch between the processes
+    assert results[0]['global_step'] == results[1]['global_step'] == 2 * -(-len(trainer.data_loader_train) // world_size)
+    # it should keep the models of the processes in sync, even while rank 0 evaluates the model for longer than the timeout
+    for name, weights in results[0]['state_dict'].items():
+        assert torch.equal(weights, results[1]['state_dict'][name]), name
+
+
+def record_batches(model):
+    """Records a copy of the batches which the model is trained on."""
+    batches = []
+    forward = model.forward
+
+    def recording_forward(**batch):
+        batches.append({name: tensor.clone() for name, tensor in batch.items()})
+        return forward(**batch)
+
+    model.forward = recording_forward
+    return batches
+
+
+def test_resume_from_checkpoint(data_dir, tmp_path):
+    trainer, model = make_trainer(data_dir, checkpoint_every=3, save_dir=str(tmp_path), max_checkpoints=100)
+    batches = record_batches(model)
+    trainer.train(model)
+    checkpoint_dir = str(tmp_path / 'checkpoint_3')
+    resumed_trainer, resumed_model = make_trainer(data_dir, load_dir=checkpoint_dir)
+    resumed_trainer.load_checkpoint(checkpoint_dir)
+    # it should continue after the third step
+    assert (resumed_trainer.global_step, resumed_trainer.start_epoch, resumed_trainer.start_step) == (3, 1, 3)
+    resumed_batches = record_batches(resumed_model)
+    resumed_trainer.train(resumed_model)
+    # it should train on the same batches (with the same masks) as the run which wasn't interrupted
+    assert len(resumed_batches) == len(batches) - 3
+    for batch, resumed_batch in zip(batches[3:], resumed_batches):
+        for name in batch:
+            assert torch.equal(batch[name], resumed_batch[name]), name
+    # it should end with the same optimizer state and weights
+    assert resumed_trainer.global_step == trainer.global_step
+    state = trainer.optimizer.state_dict()['state']
+    resumed_state = resumed_trainer.optimizer.state_dict()['state']
+    assert state.keys() == resumed_state.keys()
+    for param_id in state:
+        for name, value in state[param_id].items():
+            if torch.is_tensor(value):
+                assert torch.allclose(value, resumed_state[param_id][name]), name
+            else:
+                assert value == resumed_state[param_id][name], name
+    for (name, weights), resumed_weights in zip(model.state_dict().items(), resumed_model.state_dict().values()):
+        assert torch.allclose(weights, resumed_weights), name
+
+
+def test_checkpoint_rotation(data_dir, tmp_path):
+    trainer, model = make_trainer(data_dir, checkpoint_every=2, save_dir=str(tmp_path), max_checkpoints=2)
+    trainer.train(model)
+    # it should only keep the newest max_checkpoints checkpoints
+    steps = list(range(2, trainer.global_step + 1, 2))
+    assert len(steps) > 2
+    assert sorted(os.listdir(str(tmp_path))) == [f'checkpoint_{step}' for step in steps[-2:]]
+    assert list_checkpoints(str(tmp_path)) == [str(tmp_path / f'checkpoint_{step}') for step in steps[-2:]]
+    assert find_checkpoint(str(tmp_path)) == str(tmp_path / f'checkpoint_{steps[-1]}')
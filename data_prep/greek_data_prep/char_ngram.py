@@ -0,0 +1,152 @@
+"""Trains a count-based character n-gram model on train.txt, which can be used to answer easy single character gaps (e.g. κ#ὶ) without running the BERT model (see MLMPredicter). The model counts the n-grams centred on each character, with 1 to order characters of context on either side. The counts are stored in a hashed table, a numpy array which is memory-mapped when the model is loaded, so the size of the model doesn't depend on the size of the corpus (n-grams which hash to the same entry share a count)."""
+from greek_data_prep.generate_char_vocab import read_chunks, SPACE_CHAR
+from multiprocessing import Pool
+from functools import partial
+import numpy as np
+import argparse
+import json
+import zlib
+import os
+
+COUNTS_FILE = "ngram_counts.npy"
+CONFIG_FILE = "ngram_config.json"
+# masked chars are passed to CharNgramModel.predict as this token, like in the input of the BERT model
+MASK = "[MASK]"
+
+
+def ngram_index(ngram, nb_of_bits):
+    """Returns the index of ngram in a hashed table with 2 ** nb_of_bits entries."""
+    return zlib.crc32(ngram.encode("utf-8")) & ((1 << nb_of_bits) - 1)
+
+
+def count_chunk(chunk, order, nb_of_bits):
+    """Counts the centred n-grams of every line in chunk. Returns the table indices of the n-grams, how often each occurs and the set of chars in chunk."""
+    indices = []
+    chars = set()
+    for line in chunk.splitlines():
+        line = line.replace(" ", SPACE_CHAR)
+        chars.update(line)
+        for i in range(len(line)):
+            for k in range(1, order + 1):
+                if i - k < 0 or i + k >= len(line):
+                    break
+                indices.append(ngram_index(line[i - k : i + k + 1], nb_of_bits))
+    indices, counts = np.unique(np.array(indices, dtype=np.int64), return_counts=True)
+    return indices, counts, chars
+
+
+class CharNgramModel:
+    """A character n-gram model which predicts a masked char from the chars on either side of it."""
+
+    def __init__(self, counts, chars, order, nb_of_bits, min_count=5):
+        """
+        :param counts: the hashed table of n-gram counts.
+        :type counts: numpy.ndarray
+        :param chars: the chars which can be predicted.
+        :type chars: [str]
+        :param order: the maximum number of chars of context on either side.
+        :type order: int
+        :param nb_of_bits: the table has 2 ** nb_of_bits entries.
+        :type nb_of_bits: int
+        :param min_count: a context has to occur at least this many times to be used for prediction.
+        :type min_count: int
+        """
+        self.counts = counts
+        self.chars = chars
+        self.order = order
+        self.nb_of_bits = nb_of_bits
+        self.min_count = min_count
+
+    @classmethod
+    def train(
+        cls,
+        filename,
+        order=3,
+        nb_of_bits=24,
+        min_count=5,
+        processes=None,
+        lines_per_chunk=10000,
+    ):
+        """Counts the n-grams in filename. The file is read in chunks which are counted in a pool of worker processes."""
+        counts = np.zeros(1 << nb_of_bits, dtype=np.uint32)
+        chars = set()
+        count = partial(count_chunk, order=order, nb_of_bits=nb_of_bits)
+        with Pool(processes=processes) as pool:
+            for indices, chunk_counts, chunk_chars in pool.imap_unordered(
+                count, read_chunks(filename, lines_per_chunk)
+            ):
+                counts[indices] += chunk_counts.astype(np.uint32)
+                chars.update(chunk_chars)
+        return cls(counts, sorted(chars), order, nb_of_bits, min_count)
+
+    def save(self, save_dir):
+        os.makedirs(save_dir, exist_ok=True)
+        np.save(os.path.join(save_dir, COUNTS_FILE), self.counts)
+        config = {
+            "chars": self.chars,
+            "order": self.order,
+            "nb_of_bits": self.nb_of_bits,
+            "min_count": self.min_count,
+        }
+        with open(os.path.join(save_dir, CONFIG_FILE), "w", encoding="utf-8") as fp:
+            json.dump(config, fp, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, load_dir):
+        """Loads a model. The counts are memory-mapped, so only the parts of the table which are used are read and processes using the same model share them."""
+        with open(os.path.join(load_dir, CONFIG_FILE), "r", encoding="utf-8") as fp:
+            config = json.load(fp)
+        counts = np.load(os.path.join(load_dir, COUNTS_FILE), mmap_mode="r")
+        return cls(counts, **config)
+
+    def predict(self, chars, i):
+        """Predicts the char at position i of chars (a list with one char or MASK per position). The longest context without masked chars on either side which occurs at least min_count times is used. Returns the predicted char and its probability, or None if there is no such context."""
+        for k in range(self.order, 0, -1):
+            if i - k < 0 or i + k >= len(chars):
+                continue
+            left = chars[i - k : i]
+            right = chars[i + 1 : i + k + 1]
+            if MASK in left or MASK in right:
+                continue
+            left = "".join(left)
+            right = "".join(right)
+            candidate_counts = self.counts[
+                [ngram_index(left + c + right, self.nb_of_bits) for c in self.chars]
+            ].astype(np.int64)
+            total = candidate_counts.sum()
+            if total >= self.min_count:
+                best = int(np.argmax(candidate_counts))
+                return self.chars[best], float(candidate_counts[best] / total)
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Train a character n-gram model on train.txt, which can answer easy gaps before the BERT model is used (see run_prediction.py --ngram_model)."
+    )
+    parser.add_argument("-f", "--file", default="../../data/train.txt")
+    parser.add_argument("-o", "--output_dir", default="../../data/char_ngram")
+    parser.add_argument(
+        "--order",
+        type=int,
+        default=3,
+        help="The maximum number of chars of context on either side of the predicted char.",
+    )
+    parser.add_argument(
+        "--nb_of_bits",
+        type=int,
+        default=24,
+        help="The table of counts has 2 ** N entries (4 bytes each). Use more for large corpora to reduce collisions.",
+    )
+    parser.add_argument(
+        "--min_count",
+        type=int,
+        default=5,
+        help="The minimum number of occurrences of a context for it to be used.",
+    )
+    args = parser.parse_args()
+    model = CharNgramModel.train(args.file, args.order, args.nb_of_bits, args.min_count)
+    model.save(args.output_dir)
+    print(
+        f"Saved a model with {len(model.chars)} chars and {np.count_nonzero(model.counts)} used entries to {args.output_dir}"
+    )
@@ -0,0 +1,162 @@
+"""Removes near-duplicate sentences from the dataset. Perseus and First1KGreek overlap heavily (the same works appear in different editions), and since the sentences are scattered across the train, dev and test sets, duplicates would both slow down training and leak into the dev and test sets. Near-duplicates are found with MinHash and locality sensitive hashing (LSH) over character shingles: the MinHash signature of each sentence is split into bands and two sentences are considered duplicates if all the values of one of their bands are the same, which is likely if the Jaccard similarity of their shingles is above roughly (1 / num_bands) ** (1 / rows_per_band) (0.71 by default). The first occurrence of each sentence is kept."""
+from greek_data_prep.generate_char_vocab import read_chunks
+from multiprocessing import Pool
+from functools import partial
+import numpy as np
+import argparse
+import zlib
+import os
+
+# a Mersenne prime larger than any shingle hash, used for the universal hash functions of the MinHash signatures
+PRIME = np.uint64((1 << 61) - 1)
+# combines the values of a band into a single key
+BAND_MULTIPLIER = np.uint64(0x100000001B3)
+
+
+def split_lines(chunk):
+    """Splits a chunk read with read_chunks into its lines (unlike str.splitlines, only on newlines)."""
+    lines = chunk.split("\n")
+    return lines[:-1] if chunk.endswith("\n") else lines
+
+
+def shingle_hashes(sentence, shingle_size):
+    """Returns the hashes of the distinct character shingles (substrings of shingle_size chars) of sentence. Sentences shorter than shingle_size are a single shingle."""
+    shingles = {
+        sentence[i : i + shingle_size]
+        for i in range(max(1, len(sentence) - shingle_size + 1))
+    }
+    return [zlib.crc32(s.encode("utf-8")) for s in shingles]
+
+
+def hash_functions(num_bands, rows_per_band, seed=42):
+    """Returns the parameters a and b of the num_bands * rows_per_band hash functions (a * x + b) % PRIME of the MinHash signatures, one row per band."""
+    rng = np.random.RandomState(seed)
+    shape = (num_bands, rows_per_band, 1)
+    # a < 2 ** 32 so that a * x (with x < 2 ** 32) doesn't overflow
+    a = rng.randint(1, 1 << 32, size=shape, dtype=np.uint64)
+    b = rng.randint(0, PRIME, size=shape, dtype=np.uint64)
+    return a, b
+
+
+def band_keys(chunk, shingle_size, num_bands, rows_per_band):
+    """Computes the LSH band keys of every line in chunk: the MinHash signature of each line is split into num_bands bands of rows_per_band values, each of which is combined into a key. Returns an array of shape (number of lines, num_bands) and the number of bytes of each line."""
+    lines = split_lines(chunk)
+    hashes = [shingle_hashes(line, shingle_size) for line in lines]
+    starts = np.cumsum([0] + [len(h) for h in hashes[:-1]])
+    x = np.array([h for line_hashes in hashes for h in line_hashes], dtype=np.uint64)
+    a, b = hash_functions(num_bands, rows_per_band)
+    keys = np.zeros((len(lines), num_bands), dtype=np.uint64)
+    for band in range(num_bands):
+        # the minimum of each hash function over the shingles of each line
+        signatures = np.minimum.reduceat(
+            (a[band] * x % PRIME + b[band]) % PRIME, starts, axis=1
+        )
+        for row in signatures:
+            keys[:, band] = keys[:, band] * BAND_MULTIPLIER + row
+    nb_of_bytes = np.array([len(line.encode("utf-8")) + 1 for line in lines])
+    return keys, nb_of_bytes
+
+
+def find_duplicates(
+    filename,
+    shingle_size=5,
+    num_bands=16,
+    rows_per_band=8,
+    processes=None,
+    lines_per_chunk=1000,
+):
+    """
+    Finds the near-duplicate lines in filename. The band keys are computed in a pool of worker processes, then the lines are sorted by each band in turn and every line which shares a band with an earlier line is marked as a duplicate. Empty lines are never duplicates.
+
+    :return: a boolean array which is True for the duplicate lines and the number of bytes of each line (including its newline).
+    :rtype: (numpy.ndarray, numpy.ndarray)
+    """
+    keys = []
+    nb_of_bytes = []
+    compute_keys = partial(
+        band_keys,
+        shingle_size=shingle_size,
+        num_bands=num_bands,
+        rows_per_band=rows_per_band,
+    )
+    with Pool(processes=processes) as pool:
+        for chunk_keys, chunk_bytes in pool.imap(
+            compute_keys, read_chunks(filename, lines_per_chunk)
+        ):
+            keys.append(chunk_keys)
+            nb_of_bytes.append(chunk_bytes)
+    if not keys:
+        return np.zeros(0, dtype=bool), np.zeros(0, dtype=np.int64)
+    keys = np.concatenate(keys)
+    nb_of_bytes = np.concatenate(nb_of_bytes)
+    is_duplicate = np.zeros(len(keys), dtype=bool)
+    for band in range(num_bands):
+        # a stable sort keeps equal keys in the order of the lines, so the first one is the earliest
+        order = np.argsort(keys[:, band], kind="stable")
+        sorted_keys = keys[order, band]
+        is_duplicate[order[1:][sorted_keys[1:] == sorted_keys[:-1]]] = True
+    is_duplicate[nb_of_bytes == 1] = False
+    return is_duplicate, nb_of_bytes
+
+
+def remove_duplicates(filename, is_duplicate):
+    """Rewrites filename without the lines marked in is_duplicate."""
+    tmp_file = filename + ".tmp"
+    with open(filename, "r") as input_file, open(tmp_file, "w") as output_file:
+        for line, duplicate in zip(input_file, is_duplicate):
+            if not duplicate:
+                output_file.write(line)
+    os.replace(tmp_file, filename)
+
+
+def deduplicate_file(filename, processes=None, **kwargs):
+    """Removes the near-duplicate lines from filename (see find_duplicates for the options). Returns the number of lines, the number of duplicates and the number of bytes saved."""
+    is_duplicate, nb_of_bytes = find_duplicates(filename, processes=processes, **kwargs)
+    remove_duplicates(filename, is_duplicate)
+    return (
+        len(is_duplicate),
+        int(is_duplicate.sum()),
+        int(nb_of_bytes[is_duplicate].sum()),
+    )
+
+
+def deduplicate_sentences(processes=None):
+    """Removes the near-duplicate sentences from the dataset and reports the duplicate rate."""
+    print("Removing near-duplicate sentences...")
+    nb_of_sentences, nb_of_duplicates, nb_of_bytes = deduplicate_file(
+        "char_BERT_dataset.txt", processes
+    )
+    rate = nb_of_duplicates / nb_of_sentences if nb_of_sentences else 0.0
+    print(
+        f"Removed {nb_of_duplicates} of {nb_of_sentences} sentences ({rate:.2%}), saving {nb_of_bytes} bytes"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Remove near-duplicate lines from a file using MinHash LSH over character shingles."
+    )
+    parser.add_argument("-f", "--file", default="char_BERT_dataset.txt")
+    parser.add_argument("--shingle_size", type=int, default=5)
+    parser.add_argument(
+        "--num_bands",
+        type=int,
+        default=16,
+        help="More bands find more (and less similar) duplicates.",
+    )
+    parser.add_argument(
+        "--rows_per_band",
+        type=int,
+        default=8,
+        help="More rows per band only find more similar duplicates.",
+    )
+    args = parser.parse_args()
+    nb_of_lines, nb_of_duplicates, nb_of_bytes = deduplicate_file(
+        args.file,
+        shingle_size=args.shingle_size,
+        num_bands=args.num_bands,
+        rows_per_band=args.rows_per_band,
+    )
+    print(
+        f"Removed {nb_of_duplicates} of {nb_of_lines} lines, saving {nb_of_bytes} bytes"
+    )
@@ -1,26 +1,87 @@
-"""Creates a vocab file in the format expected by BERT. This is needed even with a custom tokenizer if we want to manipulate the special tokens (which are not individual characters."""
+"""Creates a vocab file in the format expected by BERT. This is needed even with a custom tokenizer if we want to manipulate the special tokens (which are not individual characters. The characters are counted in parallel and their frequencies are written out alongside the vocab, which makes it possible to leave rare characters out of the vocab (they are then mapped to [UNK])."""
+from collections import Counter
+from itertools import islice
+from multiprocessing import Pool
+import argparse
+
 SPECIAL_CHARS = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+# spaces are replaced with underscores before the data is passed to the model
+SPACE_CHAR = "_"
+
+
+def read_chunks(filename, lines_per_chunk):
+    """Lazily reads filename, yielding chunks of lines_per_chunk lines as single strings."""
+    with open(filename, "r") as fp:
+        while True:
+            chunk = "".join(islice(fp, lines_per_chunk))
+            if not chunk:
+                break
+            yield chunk
+
 
+def count_chars(filename, processes=None, lines_per_chunk=10000):
+    """Counts how often each character occurs in filename. The file is read in chunks which are counted in a pool of worker processes."""
+    counts = Counter()
+    with Pool(processes=processes) as pool:
+        for chunk_counts in pool.imap_unordered(
+            Counter, read_chunks(filename, lines_per_chunk)
+        ):
+            counts.update(chunk_counts)
+    # count the characters as the model sees them
+    counts[SPACE_CHAR] += counts.pop(" ", 0)
+    counts.pop("\n", None)
+    return counts
 
-def create_vocab():
+
+def write_freq_table(filename, counts):
+    """Writes the character counts to filename as tab separated values, most frequent first."""
+    with open(filename, "w") as fp:
+        for c, count in counts.most_common():
+            fp.write(f"{c}\t{count}\n")
+
+
+def create_vocab(min_count=1, processes=None):
+    """Generates the vocab and the character frequency table. Characters occuring fewer than min_count times are left out of the vocab."""
     data_path = "char_BERT_dataset.txt"
     output_file = "greek_char_vocab.txt"
+    freq_file = "greek_char_freqs.tsv"
 
     print("Generating character vocab...")
 
-    with open(data_path, "r") as fp:
-        data = fp.read()
+    counts = count_chars(data_path, processes)
+    write_freq_table(freq_file, counts)
 
-    chars = sorted(list(set(data)))
+    # the space char is always part of the vocab
+    chars = sorted(
+        c for c, count in counts.items() if count >= min_count and c != SPACE_CHAR
+    )
+    rare_chars = [
+        c for c, count in counts.items() if count < min_count and c != SPACE_CHAR
+    ]
+    nb_of_unknowns = sum(counts[c] for c in rare_chars)
 
     with open(output_file, "w") as fp:
         for s in SPECIAL_CHARS:
             fp.write(s + "\n")
-        fp.write("_\n")
+        fp.write(SPACE_CHAR + "\n")
         for c in chars:
-            if c not in [" ", "\n"]:
-                fp.write(c + "\n")
+            fp.write(c + "\n")
+
+    print(f"Vocab size: {len(SPECIAL_CHARS) + 1 + len(chars)}")
+    print(
+        f"Characters mapped to [UNK]: {len(rare_chars)} ({nb_of_unknowns} of {sum(counts.values())} chars in the dataset)"
+    )
 
 
 if __name__ == "__main__":
-    create_vocab()
+    parser = argparse.ArgumentParser(
+        description="Generate the character vocab and a character frequency table from char_BERT_dataset.txt."
+    )
+    parser.add_argument(
+        "--min_count",
+        type=int,
+        default=1,
+        help="Characters occuring fewer times than this are left out of the vocab and mapped to [UNK].",
+    )
+    args = parser.parse_args()
+    create_vocab(min_count=args.min_count)
@@ -3,9 +3,9 @@ from greek_data_prep.download_data import get_data
 from greek_data_prep.clean_data import clean_data
 from greek_data_prep.sentence_tokenization import sentence_tokenize_corpus
 from greek_data_prep.filter_sentences import filter_sentences
+from greek_data_prep.deduplicate import deduplicate_sentences
 from greek_data_prep.generate_char_vocab import create_vocab
 from greek_data_prep.split_data import ninty_eight_one_one_spilt
-from greek_data_prep.convert_data_to_bert_format import convert_data
 import os
 
 if __name__ == "__main__":
@@ -20,9 +20,11 @@ if __name__ == "__main__":
     sentence_tokenize_corpus()
     # create the specific train, dev and test sets used to train the Ancient Greek character-level BERT
     filter_sentences()
+    # remove the sentences which occur (nearly) verbatim in both Perseus and First1KGreek
+    deduplicate_sentences()
     create_vocab()
+    # split the data and write it out in BERT format
     ninty_eight_one_one_spilt()
-    convert_data()
     # clean up intermediate files
     for f in ["char_BERT_dataset.txt", "First1KGreek-1.1.4529.zip"]:
         os.remove(f)
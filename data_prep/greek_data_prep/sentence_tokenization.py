@@ -1,9 +1,15 @@
-"""Loads and uses a custom trained Punkt tokenizer. The tokenizer has been trained on the Ancient_Greek_ML dataset using the NLTK's Punkt implementation (https://www.nltk.org/_modules/nltk/tokenize/punkt.html)."""
+"""Loads and uses a custom trained Punkt tokenizer. The tokenizer has been trained on the Ancient_Greek_ML dataset using the NLTK's Punkt implementation (https://www.nltk.org/_modules/nltk/tokenize/punkt.html). The corpus is tokenized one text at a time in a pool of worker processes and the sentences are streamed back to disk."""
 from nltk.tokenize.punkt import PunktSentenceTokenizer
-from greek_data_prep.utils import write_to_file
+from functools import lru_cache
+from multiprocessing import Pool
+import os
 import pickle
 import re
 
+PUNKT_TRAINER_PATH = "../data_prep/greek_data_prep/ancient_greek_punkt_trainer.pickle"
+# matches the (empty) position following a semicolon or a middle dot
+SENTENCE_DELIMITERS = re.compile("(?<=[;·])")
+
 speakers = [
     "ΣΩ",
     "ΑΘ",
@@ -36,12 +42,6 @@ abbreviations = speakers + numbers + other_abbreviations
 ABBREVIATIONS = [i.lower() for i in abbreviations]
 
 
-def get_corpus():
-    with open("Ancient_Greek_ML.txt", "r") as f:
-        texts = f.read()
-    return texts
-
-
 def non_destructive_split(t, delim):
     """Splits the text t after the delimiter delim, retaining delim with the part of t that preceeded it. Returns a list of strings"""
     split_texts = []
@@ -72,26 +72,70 @@ def additional_tokenization(texts):
     return tokenized_texts
 
 
-def tokenize_with_custom_punkt_tokenizer(texts):
-    """Sentence tokenizes texts using a custom Punkt tokenizer followed by additional tokenization on semicola and middle dots."""
+def split_on_delimiters(texts):
+    """Splits texts on semicola and middle dots in a single pass. Equivalent to additional_tokenization except that empty sentences are dropped."""
+    tokenized_texts = []
+    for t in texts:
+        for s in SENTENCE_DELIMITERS.split(t):
+            s = s.strip(" ")
+            if s:
+                tokenized_texts.append(s)
+    return tokenized_texts
+
+
+@lru_cache(maxsize=None)
+def load_punkt_tokenizer(trainer_path=PUNKT_TRAINER_PATH):
+    """Builds the custom Punkt tokenizer. The result is cached, so the trainer is only unpickled once per process."""
     # a trainer is loaded rather than a tokenizer so that additional abbreviations can be added manually.
-    with open("../data_prep/greek_data_prep/ancient_greek_punkt_trainer.pickle", "rb") as f:
+    with open(trainer_path, "rb") as f:
         trainer = pickle.load(f)
     # add additional abbreviations
     for abbv in ABBREVIATIONS:
         trainer._params.abbrev_types.add(abbv)
-    tokenizer = PunktSentenceTokenizer(trainer.get_params())
+    return PunktSentenceTokenizer(trainer.get_params())
+
+
+def tokenize_with_custom_punkt_tokenizer(texts):
+    """Sentence tokenizes texts using a custom Punkt tokenizer followed by additional tokenization on semicola and middle dots."""
+    tokenizer = load_punkt_tokenizer()
     tokenized_texts = tokenizer.tokenize(texts)
-    tokenized_texts = additional_tokenization(tokenized_texts)
+    tokenized_texts = split_on_delimiters(tokenized_texts)
     return tokenized_texts
 
 
-def sentence_tokenize_corpus():
+def read_texts(filename):
+    """Lazily reads the corpus, yielding one text (i.e. one line) at a time."""
+    with open(filename, "r") as fp:
+        for line in fp:
+            line = line.rstrip("\n")
+            if line:
+                yield line
+
+
+def sentence_tokenize_file(input_file, output_file, processes=None, chunksize=8):
+    """Sentence tokenizes the texts in input_file in a pool of worker processes and streams the sentences to output_file in the original order. The corpus is sharded at text boundaries, so no sentence spans two texts. Returns the number of sentences written."""
+    nb_of_sentences = 0
+    with Pool(processes=processes, initializer=load_punkt_tokenizer) as pool:
+        with open(output_file, "w") as fp:
+            for sentences in pool.imap(
+                tokenize_with_custom_punkt_tokenizer,
+                read_texts(input_file),
+                chunksize=chunksize,
+            ):
+                for s in sentences:
+                    fp.write("%s\n" % s)
+                nb_of_sentences += len(sentences)
+    return nb_of_sentences
+
+
+def sentence_tokenize_corpus(processes=None):
     """Fetches and tokenizes the corpus then writes it back out."""
-    texts = get_corpus()
+    corpus_file = "Ancient_Greek_ML.txt"
+    tmp_file = corpus_file + ".tmp"
     print("Sentence tokenizing...")
-    tokenized_texts = tokenize_with_custom_punkt_tokenizer(texts)
-    write_to_file("Ancient_Greek_ML.txt", tokenized_texts)
+    nb_of_sentences = sentence_tokenize_file(corpus_file, tmp_file, processes)
+    os.replace(tmp_file, corpus_file)
+    print(f"Number of sentences: {nb_of_sentences}")
 
 
 if __name__ == "__main__":
@@ -1,67 +1,57 @@
-"""Splits the sentence tokenized data into train, dev and test sets. This script shuffles the sentences. As a result the dataset created this way can't be used for next sentence prediction."""
-from greek_data_prep.utils import write_to_file
-import random as rn
-import math
+"""Splits the sentence tokenized data into train, dev and test sets. Sentences are assigned to a set by hashing them, which scatters them across the sets just like shuffling would. As a result the dataset created this way can't be used for next sentence prediction."""
+from contextlib import ExitStack
+import hashlib
 
+SPLIT_NAMES = ["train", "dev", "test"]
+# the number of sentences per document in the BERT formatted files
+SENTENCES_PER_DOC = 1000
 
-def get_data(filename):
-    with open(filename, "r") as f:
-        data = f.read().splitlines()
-    return data
 
+def assign_split(sentence, train_split, val_split):
+    """Deterministically assigns a sentence to the train, dev or test set using a hash of the sentence. The assignment only depends on the sentence itself, so it stays stable when sentences are added to or removed from the corpus."""
+    digest = hashlib.blake2b(sentence.encode("utf-8"), digest_size=8).digest()
+    position = int.from_bytes(digest, "big") / 2**64
+    if position < train_split:
+        return "train"
+    elif position < train_split + val_split:
+        return "dev"
+    return "test"
 
-def split_data(data, train_split, val_split, test_split):
-    assert train_split + val_split + test_split == 1.0
-    train = []
-    val = []
-    test = []
-
-    # we want to be able to reproduce this split
-    rn.seed(42)
-    rn.shuffle(data)
-
-    nb_of_texts = len(data)
-    total_len = sum([len(text) for text in data])
-    print("Total number of chars: " + str(total_len))
-    train_target_len = math.floor(total_len * train_split)
-    val_target_len = math.floor(total_len * (train_split + val_split))
 
-    current_len = 0
-    train_end = 0
-    val_end = 0
-    for i, text in enumerate(data):
-        current_len += len(text)
-        if current_len < train_target_len:
-            # keep updating the train end index until current len >= train_target_len
-            train_end = i
-        if current_len > val_target_len:
-            val_end = i
-            # now that we're finished, correct the train_end index
-            train_end += 1
-            break
-    train = data[0 : train_end + 1]
-    val = data[train_end + 1 : val_end + 1]
-    test = data[val_end + 1 :]
-    assert len(train) + len(val) + len(test) == len(data)
-
-    train_len = sum([len(text) for text in train])
-    val_len = sum([len(text) for text in val])
-    test_len = sum([len(text) for text in test])
-    print(f"Train length: {train_len}")
-    print(f"Val length: {val_len}")
-    print(f"Test length: {test_len}")
-    return train, val, test
+def hash_split(filename, train_split, val_split, test_split):
+    """Streams the sentences in filename into train.txt, dev.txt and test.txt, writing them directly in the format expected by the BERT code: spaces are replaced with underscores and an empty line is inserted every SENTENCES_PER_DOC sentences. Only one sentence is held in memory at a time. Returns the number of chars in each set."""
+    assert train_split + val_split + test_split == 1.0
+    nb_of_sentences = {name: 0 for name in SPLIT_NAMES}
+    nb_of_chars = {name: 0 for name in SPLIT_NAMES}
+    with ExitStack() as stack:
+        output_files = {
+            name: stack.enter_context(open(f"{name}.txt", "w")) for name in SPLIT_NAMES
+        }
+        input_file = stack.enter_context(open(filename, "r"))
+        for line in input_file:
+            sentence = line.rstrip("\n")
+            if not sentence:
+                continue
+            name = assign_split(sentence, train_split, val_split)
+            # replace spaces with underscores, to work around deeply embedded whitespace remove in the BERT implementation
+            output_files[name].write(sentence.replace(" ", "_") + "\n")
+            nb_of_sentences[name] += 1
+            nb_of_chars[name] += len(sentence)
+            if nb_of_sentences[name] % SENTENCES_PER_DOC == 0:
+                # append a new line every SENTENCES_PER_DOC lines (to comply with BERT document formating expectations)
+                output_files[name].write("\n")
+    print("Total number of chars: " + str(sum(nb_of_chars.values())))
+    print(f"Train length: {nb_of_chars['train']}")
+    print(f"Val length: {nb_of_chars['dev']}")
+    print(f"Test length: {nb_of_chars['test']}")
+    return nb_of_chars
 
 
 def ninty_eight_one_one_spilt():
     filename = "char_BERT_dataset.txt"
 
-    print("Splitting data...")
-    data = get_data(filename)
-    train, val, test = split_data(data, 0.98, 0.01, 0.01)
-    write_to_file("train.txt", train)
-    write_to_file("dev.txt", val)
-    write_to_file("test.txt", test)
+    print("Splitting data and converting to BERT format...")
+    hash_split(filename, 0.98, 0.01, 0.01)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,213 @@
+"""Builds a suffix array over the training corpus, which makes it possible to look up verbatim parallels of the context around a gap (e.g. the formulae of decrees) in milliseconds (see MLMPredicter.rank_supplements). The corpus is stored as an array of char ids (one line per sentence) next to the sorted start positions of all its suffixes. Both are memory-mapped when the index is loaded. Building the index needs roughly 40 bytes of memory per char of the corpus."""
+import numpy as np
+import argparse
+import json
+import os
+
+CORPUS_FILE = "corpus.npy"
+SUFFIX_ARRAY_FILE = "suffix_array.npy"
+ALPHABET_FILE = "alphabet.json"
+# separates the sentences in the corpus, so that no parallel spans two of them
+SEPARATOR = "\n"
+
+
+def read_corpus(filename):
+    """Reads the sentences in filename (skipping the empty lines between documents) and joins them with SEPARATOR."""
+    with open(filename, "r") as fp:
+        return SEPARATOR.join(line.rstrip("\n") for line in fp if line.strip())
+
+
+def build_suffix_array(ids):
+    """Returns the start positions of the suffixes of ids in sorted order. The suffixes are sorted by prefix doubling: in each round they are ranked by their first 2 * k chars, using the ranks of their first k chars and those of the suffixes k chars further on, until all the ranks are distinct."""
+    n = len(ids)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    # dense ranks, so that the ranks of the second halves are less than n + 1
+    rank = np.unique(ids, return_inverse=True)[1].astype(np.int64).reshape(-1)
+    k = 1
+    while True:
+        # suffixes which end before k chars sort before all the others
+        second = np.zeros(n, dtype=np.int64)
+        second[: n - k] = rank[k:] + 1
+        key = rank * (n + 1) + second
+        suffix_array = np.argsort(key, kind="stable")
+        sorted_key = key[suffix_array]
+        rank = np.empty(n, dtype=np.int64)
+        rank[suffix_array] = np.concatenate(
+            ([0], np.cumsum(sorted_key[1:] != sorted_key[:-1]))
+        )
+        if rank[suffix_array[-1]] == n - 1 or k >= n:
+            return suffix_array
+        k *= 2
+
+
+class SuffixArrayIndex:
+    """A suffix array over a corpus which finds the passages matching the context of a gap."""
+
+    def __init__(self, corpus, suffix_array, alphabet):
+        """
+        :param corpus: the ids of the chars of the corpus.
+        :type corpus: numpy.ndarray
+        :param suffix_array: the start positions of the suffixes of the corpus in sorted order.
+        :type suffix_array: numpy.ndarray
+        :param alphabet: the char of each id.
+        :type alphabet: [str]
+        """
+        self.corpus = corpus
+        self.suffix_array = suffix_array
+        self.alphabet = alphabet
+        self.char_ids = {c: i for i, c in enumerate(alphabet)}
+
+    @classmethod
+    def build(cls, filename):
+        text = read_corpus(filename)
+        alphabet = sorted(set(text) | {SEPARATOR})
+        char_ids = {c: i for i, c in enumerate(alphabet)}
+        dtype = np.uint16 if len(alphabet) <= np.iinfo(np.uint16).max else np.uint32
+        corpus = np.fromiter((char_ids[c] for c in text), dtype=dtype, count=len(text))
+        suffix_array = build_suffix_array(corpus)
+        if len(corpus) <= np.iinfo(np.int32).max:
+            suffix_array = suffix_array.astype(np.int32)
+        return cls(corpus, suffix_array, alphabet)
+
+    def save(self, save_dir):
+        os.makedirs(save_dir, exist_ok=True)
+        np.save(os.path.join(save_dir, CORPUS_FILE), self.corpus)
+        np.save(os.path.join(save_dir, SUFFIX_ARRAY_FILE), self.suffix_array)
+        with open(os.path.join(save_dir, ALPHABET_FILE), "w", encoding="utf-8") as fp:
+            json.dump(self.alphabet, fp, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, load_dir):
+        """Loads an index, memory-mapping the corpus and the suffix array."""
+        with open(os.path.join(load_dir, ALPHABET_FILE), "r", encoding="utf-8") as fp:
+            alphabet = json.load(fp)
+        corpus = np.load(os.path.join(load_dir, CORPUS_FILE), mmap_mode="r")
+        suffix_array = np.load(os.path.join(load_dir, SUFFIX_ARRAY_FILE), mmap_mode="r")
+        return cls(corpus, suffix_array, alphabet)
+
+    def encode(self, text):
+        """Returns the ids of the chars of text, which have to be in the corpus."""
+        return np.array([self.char_ids[c] for c in text], dtype=self.corpus.dtype)
+
+    def decode(self, ids):
+        return "".join(self.alphabet[i] for i in ids)
+
+    def _compare(self, position, pattern):
+        """Compares the suffix starting at position with pattern, only looking at as many chars as pattern has. Returns -1, 0 or 1."""
+        prefix = self.corpus[position : position + len(pattern)]
+        differences = np.flatnonzero(prefix != pattern[: len(prefix)])
+        if len(differences):
+            return -1 if prefix[differences[0]] < pattern[differences[0]] else 1
+        return 0 if len(prefix) == len(pattern) else -1
+
+    def _bound(self, pattern, upper):
+        """Binary searches the suffix array for the first suffix which doesn't sort before pattern (or, if upper is True, which sorts after every suffix starting with pattern)."""
+        low, high = 0, len(self.suffix_array)
+        while low < high:
+            middle = (low + high) // 2
+            comparison = self._compare(int(self.suffix_array[middle]), pattern)
+            if comparison < 0 or (upper and comparison == 0):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def occurrences(self, pattern):
+        """Returns the start positions of all the occurrences of pattern (an array of char ids) in the corpus."""
+        return self.suffix_array[
+            self._bound(pattern, upper=False) : self._bound(pattern, upper=True)
+        ]
+
+    def _matches(self, positions, pattern):
+        """Returns a boolean array which is True for the positions at which pattern occurs."""
+        offsets = positions[:, None] + np.arange(len(pattern))
+        in_corpus = (positions >= 0) & (positions + len(pattern) <= len(self.corpus))
+        offsets = np.clip(offsets, 0, len(self.corpus) - 1)
+        return in_corpus & np.all(self.corpus[offsets] == pattern, axis=1)
+
+    def find_parallels(
+        self,
+        left,
+        right,
+        gap_len,
+        min_context=5,
+        max_results=100,
+        max_occurrences=100000,
+        passage_context=40,
+    ):
+        """
+        Finds the passages of the corpus in which left is followed by gap_len chars and then right. Only the last (first) k chars of left (right) are used, starting with the longest context and halving k until there are matches or k is less than min_context. The context is cut off at the first char next to the gap which isn't in the corpus.
+
+        :param max_occurrences: the maximum number of occurrences of the rarer side of the context which are checked against the other side.
+        :type max_occurrences: int
+        :return: a dict per match with its "position" (of the gap) in the corpus, the "fill" (the chars in the gap), the "context_len" k and the "passage" around it (with the fill in square brackets).
+        :rtype: [dict]
+        """
+        unknown = [i for i, c in enumerate(left) if c not in self.char_ids]
+        left = left[max(unknown, default=-1) + 1 :]
+        unknown = [i for i, c in enumerate(right) if c not in self.char_ids]
+        right = right[: min(unknown, default=len(right))]
+        k = max(len(left), len(right))
+        while k >= min_context:
+            left_ids = self.encode(left[len(left) - min(k, len(left)) :])
+            right_ids = self.encode(right[:k])
+            parallels = self._find(left_ids, right_ids, gap_len, max_occurrences)
+            if len(parallels):
+                return [
+                    self._parallel(position, gap_len, k, passage_context)
+                    for position in parallels[:max_results]
+                ]
+            k //= 2
+        return []
+
+    def _find(self, left_ids, right_ids, gap_len, max_occurrences):
+        """Returns the start positions of the gaps which are preceded by left_ids and followed by right_ids, looking up the rarer of the two in the suffix array."""
+        left_occurrences = self.occurrences(left_ids) if len(left_ids) else None
+        right_occurrences = self.occurrences(right_ids) if len(right_ids) else None
+        if right_occurrences is None or (
+            left_occurrences is not None
+            and len(left_occurrences) <= len(right_occurrences)
+        ):
+            gaps = np.sort(left_occurrences[:max_occurrences]).astype(np.int64)
+            gaps += len(left_ids)
+            if len(right_ids):
+                gaps = gaps[self._matches(gaps + gap_len, right_ids)]
+        else:
+            gaps = np.sort(right_occurrences[:max_occurrences]).astype(np.int64)
+            gaps -= gap_len
+            if len(left_ids):
+                gaps = gaps[self._matches(gaps - len(left_ids), left_ids)]
+        # the gap has to lie within a sentence
+        gaps = gaps[(gaps >= 0) & (gaps + gap_len <= len(self.corpus))]
+        if gap_len:
+            fills = self.corpus[gaps[:, None] + np.arange(gap_len)]
+            gaps = gaps[~np.any(fills == self.char_ids[SEPARATOR], axis=1)]
+        return gaps
+
+    def _parallel(self, position, gap_len, context_len, passage_context):
+        position = int(position)
+        start = max(0, position - passage_context)
+        end = min(len(self.corpus), position + gap_len + passage_context)
+        fill = self.decode(self.corpus[position : position + gap_len])
+        # only show the sentence the parallel is in
+        before = self.decode(self.corpus[start:position]).split(SEPARATOR)[-1]
+        after = self.decode(self.corpus[position + gap_len : end]).split(SEPARATOR)[0]
+        return {
+            "position": position,
+            "fill": fill,
+            "context_len": context_len,
+            "passage": f"{before}[{fill}]{after}",
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build a suffix array index over train.txt to look up parallel passages around gaps."
+    )
+    parser.add_argument("-f", "--file", default="../../data/train.txt")
+    parser.add_argument("-o", "--output_dir", default="../../data/suffix_array")
+    args = parser.parse_args()
+    index = SuffixArrayIndex.build(args.file)
+    index.save(args.output_dir)
+    print(f"Indexed {len(index.corpus)} chars in {args.output_dir}")
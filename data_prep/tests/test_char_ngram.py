@@ -0,0 +1,24 @@
+from greek_data_prep.char_ngram import CharNgramModel, MASK
+import numpy as np
+
+
+def test_char_ngram_model(tmp_path):
+    data = tmp_path / 'train.txt'
+    data.write_text('καὶ_ὁ_λόγος\nκαὶ τὸ ἔργον\n\nκαὶ_ὁ_λόγος\n' * 5)
+    model = CharNgramModel.train(
+        str(data), order=2, nb_of_bits=16, min_count=3, processes=2, lines_per_chunk=3
+    )
+    # it should treat spaces as underscores
+    assert ' ' not in model.chars and '_' in model.chars
+    model.save(str(tmp_path / 'model'))
+    model = CharNgramModel.load(str(tmp_path / 'model'))
+    # it should memory-map the counts
+    assert isinstance(model.counts, np.memmap)
+    # it should predict a masked char from its context
+    char, prob = model.predict(list('κ') + [MASK] + list('ὶ_ὁ'), 1)
+    assert char == 'α' and prob == 1.0
+    # it should back off to a shorter context when the longer one contains a mask
+    assert model.predict(list('λόγ') + [MASK] + list('ς') + [MASK], 3)[0] == 'ο'
+    # it should not predict without any context or from rare contexts
+    assert model.predict([MASK] + list('αὶ'), 0) is None
+    assert model.predict(list('ξ') + [MASK] + list('ξ'), 1) is None
@@ -0,0 +1,41 @@
+from greek_data_prep.deduplicate import band_keys, deduplicate_file, split_lines
+
+
+def test_band_keys():
+    sent = 'τὸν δὲ ταμίαν τοῦ δήμου δοῦναι εἰς τὴν στήλην'
+    keys, nb_of_bytes = band_keys(sent + '\n' + sent + '\n\n', 5, 16, 8)
+    # it should compute a key per band for every line, including empty ones
+    assert keys.shape == (3, 16)
+    # it should give identical lines identical keys
+    assert (keys[0] == keys[1]).all() and not (keys[0] == keys[2]).any()
+    # it should count the bytes of each line including its newline
+    assert nb_of_bytes.tolist() == [len(sent.encode('utf-8')) + 1] * 2 + [1]
+
+
+def test_split_lines():
+    # it should only split on newlines
+    assert split_lines('α β\nγ\n') == ['α β', 'γ']
+    assert split_lines('α\nβ') == ['α', 'β']
+
+
+def test_deduplicate_file(tmp_path):
+    sentences = [
+        'ἔδοξεν τῇ βουλῇ καὶ τῷ δήμῳ, Κεκροπὶς ἐπρυτάνευε, Μνησίθεος ἐγραμμάτευε',
+        'μῆνιν ἄειδε θεὰ Πηληϊάδεω Ἀχιλῆος οὐλομένην',
+        '',
+        # a different edition of the first sentence
+        'ἔδοξεν τῇ βουλῇ καὶ τῷ δήμῳ· Κεκροπὶς ἐπρυτάνευε, Μνησίθεος ἐγραμμάτευε',
+        'ἄνδρα μοι ἔννεπε, μοῦσα, πολύτροπον',
+        '',
+        'μῆνιν ἄειδε θεὰ Πηληϊάδεω Ἀχιλῆος οὐλομένην',
+    ]
+    data = tmp_path / 'char_BERT_dataset.txt'
+    data.write_text('\n'.join(sentences) + '\n')
+    nb_of_lines, nb_of_duplicates, nb_of_bytes = deduplicate_file(
+        str(data), lines_per_chunk=2
+    )
+    # it should remove exact and near duplicates but keep their first occurrence and the empty lines
+    assert data.read_text().splitlines() == sentences[:3] + sentences[4:6]
+    # it should report the number of duplicates and the bytes saved
+    assert (nb_of_lines, nb_of_duplicates) == (7, 2)
+    assert nb_of_bytes == sum(len(sentences[i].encode('utf-8')) + 1 for i in [3, 6])
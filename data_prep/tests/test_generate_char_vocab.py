@@ -0,0 +1,22 @@
+from greek_data_prep.generate_char_vocab import count_chars, create_vocab, SPECIAL_CHARS
+
+
+def test_count_chars(tmp_path):
+    data = tmp_path / 'data.txt'
+    data.write_text('αβ γ\nαα\n' * 50)
+    # it should count chunks in parallel and treat spaces as underscores
+    counts = count_chars(str(data), processes=2, lines_per_chunk=7)
+    assert counts == {'α': 150, 'β': 50, 'γ': 50, '_': 50}
+
+
+def test_create_vocab(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'char_BERT_dataset.txt').write_text('αβ γ\nαα_\nδ\n')
+    create_vocab(min_count=2, processes=1)
+    vocab = (tmp_path / 'greek_char_vocab.txt').read_text().splitlines()
+    # it should leave out chars below min_count and not duplicate the underscore
+    assert vocab == SPECIAL_CHARS + ['_', 'α']
+    freqs = (tmp_path / 'greek_char_freqs.tsv').read_text().splitlines()
+    # it should write every char to the frequency table, most frequent first
+    assert freqs[0] == 'α\t3'
+    assert sorted(freqs[1:]) == ['_\t2', 'β\t1', 'γ\t1', 'δ\t1']
@@ -1,4 +1,4 @@
-from greek_data_prep.sentence_tokenization import my_split
+from greek_data_prep.sentence_tokenization import my_split, split_on_delimiters, additional_tokenization
 
 def test_my_split():
     # it should correctly tokenize strings with intermediate semicola
@@ -33,3 +33,11 @@ def test_my_split():
 
 
 
+
+def test_split_on_delimiters():
+    # it should match the two pass tokenization on semicola and middle dots
+    texts = ['Ἁ δὲ ΜΓ τᾷ ΦΧ ἴσα · δῆλον οὖν ὅτι μείζων; ἢ μή τις ὕμνος Βακχίῳ κωμάζεται;', '; Ποινῶν καὶ Σικελιωτῶν·', 'Ἔστω τμᾶμα οἷον εἴρηται']
+    assert split_on_delimiters(texts) == additional_tokenization(texts)
+
+    # it should drop the empty sentences left behind by trailing delimiters
+    assert split_on_delimiters(['ἴσα; ', ' · ']) == ['ἴσα;', '·']
@@ -0,0 +1,43 @@
+from greek_data_prep.split_data import assign_split, hash_split
+
+
+def test_assign_split():
+    # it should always assign a sentence to the same set
+    sent = 'μῆνιν ἄειδε θεὰ Πηληϊάδεω Ἀχιλῆος'
+    assert assign_split(sent, 0.98, 0.01) == assign_split(sent, 0.98, 0.01)
+    # it should respect the proportions
+    assert assign_split(sent, 1.0, 0.0) == 'train'
+    assert assign_split(sent, 0.0, 1.0) == 'dev'
+    assert assign_split(sent, 0.0, 0.0) == 'test'
+
+
+def test_hash_split(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    sentences = ['λόγος %d ἐστὶν' % i for i in range(3000)]
+    with open('char_BERT_dataset.txt', 'w') as fp:
+        fp.write('\n'.join(sentences) + '\n\n')
+    nb_of_chars = hash_split('char_BERT_dataset.txt', 0.5, 0.25, 0.25)
+    assert sum(nb_of_chars.values()) == sum(len(s) for s in sentences)
+
+    split_sentences = {}
+    for name in ['train', 'dev', 'test']:
+        with open(f'{name}.txt') as fp:
+            lines = fp.read().splitlines()
+        # it should replace spaces with underscores
+        assert all(' ' not in l for l in lines)
+        # it should insert an empty line after every 1000 sentences
+        assert all(l == '' for l in lines[1000::1001])
+        split_sentences[name] = [l for l in lines if l]
+    # it should write every sentence exactly once
+    all_sentences = sum(split_sentences.values(), [])
+    assert sorted(all_sentences) == sorted(s.replace(' ', '_') for s in sentences)
+    # it should roughly respect the proportions
+    assert 1300 < len(split_sentences['train']) < 1700
+
+    # it should keep existing sentences in the same set when sentences are added
+    with open('char_BERT_dataset.txt', 'a') as fp:
+        fp.write('νέος λόγος\n')
+    hash_split('char_BERT_dataset.txt', 0.5, 0.25, 0.25)
+    with open('dev.txt') as fp:
+        dev = [l for l in fp.read().splitlines() if l]
+    assert set(split_sentences['dev']) <= set(dev)
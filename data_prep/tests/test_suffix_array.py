@@ -0,0 +1,32 @@
+from greek_data_prep.suffix_array import SuffixArrayIndex, build_suffix_array
+import numpy as np
+
+
+def test_build_suffix_array():
+    text = 'ἔδοξε_τῇ_βουλῇ_καὶ_τῷ_δήμῳ_ἔδοξε'
+    ids = np.array([ord(c) for c in text])
+    # it should sort the suffixes like a naive sort
+    expected = sorted(range(len(text)), key=lambda i: text[i:])
+    assert build_suffix_array(ids).tolist() == expected
+    assert build_suffix_array(np.array([1, 1, 1, 1])).tolist() == [3, 2, 1, 0]
+
+
+def test_find_parallels(tmp_path):
+    data = tmp_path / 'train.txt'
+    data.write_text(
+        'ἔδοξε_τῇ_βουλῇ_καὶ_τῷ_δήμῳ\nἔδοξε_τῇ_βουλῇ\n\nἔδοξε_τῷ_δήμῳ\nτῇ_βουλῇ_καὶ_τῷ_δήμῳ\n'
+    )
+    SuffixArrayIndex.build(str(data)).save(str(tmp_path / 'index'))
+    index = SuffixArrayIndex.load(str(tmp_path / 'index'))
+    # it should memory-map the corpus and the suffix array
+    assert isinstance(index.suffix_array, np.memmap)
+    parallels = index.find_parallels('βουλῇ_', '_τῷ_δήμῳ', 3, min_context=3)
+    # it should find every passage with the context and return the chars in the gap
+    assert [p['fill'] for p in parallels] == ['καὶ', 'καὶ']
+    assert parallels[0]['passage'] == 'ἔδοξε_τῇ_βουλῇ_[καὶ]_τῷ_δήμῳ'
+    # it should back off to a shorter context
+    parallels = index.find_parallels('ἔδοξε_', '_βουλῇ_ἔδοξε', 2, min_context=3)
+    assert {p['fill'] for p in parallels} == {'τῇ'} and parallels[0]['context_len'] == 6
+    # it should not return gaps which span two sentences or contexts with unknown chars
+    assert index.find_parallels('δήμῳ', 'δοξε', 2, min_context=4) == []
+    assert index.find_parallels('ξξξξ', 'ξξξξ', 2, min_context=4) == []